@@ -1,21 +1,40 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, BackgroundTasks, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, BackgroundTasks, Request, Header, Response, UploadFile, File
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.concurrency import run_in_threadpool
 from dotenv import load_dotenv
+from fastapi.responses import JSONResponse, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, CursorType, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr, ConfigDict
+from urllib.parse import urlsplit
+from pydantic import BaseModel, Field, EmailStr, ConfigDict, ValidationError
 from typing import List, Optional, Dict, Any
 import uuid
 from datetime import datetime, timezone, timedelta
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 import secrets
+import string
+import hashlib
+import hmac
+import base64
+import csv
+import io
+import random
+import heapq
+import itertools
+import socket
 import httpx
 import asyncio
 import json
+import time
+import math
+import zlib
+from collections import OrderedDict, deque
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -29,11 +48,167 @@ db = client[os.environ['DB_NAME']]
 JWT_SECRET = os.environ.get('JWT_SECRET', 'telenexus_secret_key')
 JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES', 1440))
+# Embed immutable user fields in the token so get_current_user needs no DB lookup.
+# Deactivation then only takes effect once issued tokens expire.
+JWT_EMBED_USER_CLAIMS = os.environ.get('JWT_EMBED_USER_CLAIMS', 'false').lower() == 'true'
 
 # Evolution API Configuration
 EVOLUTION_API_URL = os.environ.get('EVOLUTION_API_URL', '').rstrip('/')
 EVOLUTION_API_KEY = os.environ.get('EVOLUTION_API_KEY', '')
 
+# Evolution HTTP connection pool
+EVOLUTION_HTTP_MAX_CONNECTIONS = int(os.environ.get('EVOLUTION_HTTP_MAX_CONNECTIONS', 100))
+EVOLUTION_HTTP_MAX_KEEPALIVE = int(os.environ.get('EVOLUTION_HTTP_MAX_KEEPALIVE', 20))
+EVOLUTION_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('EVOLUTION_HTTP_KEEPALIVE_EXPIRY', 30))
+EVOLUTION_HTTP2 = os.environ.get('EVOLUTION_HTTP2', 'false').lower() == 'true'
+EVOLUTION_POOL_TIMEOUT = float(os.environ.get('EVOLUTION_POOL_TIMEOUT', 5))
+# Max concurrent per-instance Evolution calls when refreshing many instances
+EVOLUTION_FANOUT_CONCURRENCY = int(os.environ.get('EVOLUTION_FANOUT_CONCURRENCY', 10))
+
+# Background reconciliation of instance status with Evolution (0 disables)
+EVOLUTION_RECONCILE_INTERVAL_SECONDS = float(os.environ.get('EVOLUTION_RECONCILE_INTERVAL_SECONDS', 30))
+# Stored status is served without calling Evolution while lag stays under this many intervals
+EVOLUTION_RECONCILE_STALE_AFTER = float(os.environ.get('EVOLUTION_RECONCILE_STALE_AFTER', 3))
+
+# Connection state cache
+CONNECTION_STATE_TTL_SECONDS = float(os.environ.get('CONNECTION_STATE_TTL_SECONDS', 30))
+CONNECTION_STATE_CACHE_SIZE = int(os.environ.get('CONNECTION_STATE_CACHE_SIZE', 10000))
+
+# API key verification cache
+API_KEY_CACHE_TTL_SECONDS = float(os.environ.get('API_KEY_CACHE_TTL_SECONDS', 60))
+API_KEY_CACHE_SIZE = int(os.environ.get('API_KEY_CACHE_SIZE', 10000))
+API_KEY_LAST_USED_FLUSH_SECONDS = float(os.environ.get('API_KEY_LAST_USED_FLUSH_SECONDS', 10))
+
+# Principal cache for get_current_user
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', 30))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+
+# Public batch send
+BATCH_SEND_MAX_MESSAGES = int(os.environ.get('BATCH_SEND_MAX_MESSAGES', 100))
+
+# Outbound message queue
+OUTBOUND_WORKERS = int(os.environ.get('OUTBOUND_WORKERS', 4))
+OUTBOUND_MAX_ATTEMPTS = int(os.environ.get('OUTBOUND_MAX_ATTEMPTS', 5))
+OUTBOUND_RETRY_BASE_SECONDS = float(os.environ.get('OUTBOUND_RETRY_BASE_SECONDS', 2))
+OUTBOUND_RETRY_MAX_SECONDS = float(os.environ.get('OUTBOUND_RETRY_MAX_SECONDS', 300))
+OUTBOUND_LOCK_SECONDS = float(os.environ.get('OUTBOUND_LOCK_SECONDS', 120))
+OUTBOUND_POLL_INTERVAL_SECONDS = float(os.environ.get('OUTBOUND_POLL_INTERVAL_SECONDS', 1))
+OUTBOUND_SHUTDOWN_GRACE_SECONDS = float(os.environ.get('OUTBOUND_SHUTDOWN_GRACE_SECONDS', 10))
+
+# Streaming exports
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+# Webhook delivery
+WEBHOOK_TIMEOUT_SECONDS = float(os.environ.get('WEBHOOK_TIMEOUT_SECONDS', 10))
+WEBHOOK_MAX_CONCURRENCY = int(os.environ.get('WEBHOOK_MAX_CONCURRENCY', 100))
+WEBHOOK_MAX_KEEPALIVE = int(os.environ.get('WEBHOOK_MAX_KEEPALIVE', 20))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 4))
+WEBHOOK_RETRY_BASE_SECONDS = float(os.environ.get('WEBHOOK_RETRY_BASE_SECONDS', 1))
+WEBHOOK_RETRY_MAX_SECONDS = float(os.environ.get('WEBHOOK_RETRY_MAX_SECONDS', 30))
+WEBHOOK_BREAKER_THRESHOLD = int(os.environ.get('WEBHOOK_BREAKER_THRESHOLD', 5))
+WEBHOOK_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('WEBHOOK_BREAKER_COOLDOWN_SECONDS', 60))
+WEBHOOK_LAST_TRIGGERED_FLUSH_SECONDS = float(os.environ.get('WEBHOOK_LAST_TRIGGERED_FLUSH_SECONDS', 5))
+
+# Latest QR code per instance, fed by qrcode.updated events (WhatsApp rotates QRs within a minute)
+QR_CACHE_TTL_SECONDS = float(os.environ.get('QR_CACHE_TTL_SECONDS', 45))
+
+# Billing message templates (built-in per locale, overridable per user or instance)
+BILLING_DEFAULT_LOCALE = os.environ.get('BILLING_DEFAULT_LOCALE', 'en')
+BILLING_TEMPLATE_CACHE_TTL_SECONDS = float(os.environ.get('BILLING_TEMPLATE_CACHE_TTL_SECONDS', 300))
+BILLING_TEMPLATE_CACHE_SIZE = int(os.environ.get('BILLING_TEMPLATE_CACHE_SIZE', 5000))
+
+# Bulk billing campaigns
+CAMPAIGN_IMPORT_BATCH_SIZE = int(os.environ.get('CAMPAIGN_IMPORT_BATCH_SIZE', 1000))
+CAMPAIGN_SEND_RATE_PER_SECOND = float(os.environ.get('CAMPAIGN_SEND_RATE_PER_SECOND', 5))
+CAMPAIGN_MAX_IN_FLIGHT = int(os.environ.get('CAMPAIGN_MAX_IN_FLIGHT', 100))
+CAMPAIGN_POLL_SECONDS = float(os.environ.get('CAMPAIGN_POLL_SECONDS', 1))
+CAMPAIGN_LEASE_SECONDS = float(os.environ.get('CAMPAIGN_LEASE_SECONDS', 30))
+# A row claimed this long ago without a send job is handed back; an import this quiet has died
+CAMPAIGN_CLAIM_SECONDS = float(os.environ.get('CAMPAIGN_CLAIM_SECONDS', 300))
+CAMPAIGN_IMPORT_STALE_SECONDS = float(os.environ.get('CAMPAIGN_IMPORT_STALE_SECONDS', 600))
+
+# Scheduled messages: jobs due within the window are held in memory, the rest stay in Mongo
+SCHEDULER_WINDOW_SECONDS = float(os.environ.get('SCHEDULER_WINDOW_SECONDS', 300))
+SCHEDULER_WINDOW_SIZE = int(os.environ.get('SCHEDULER_WINDOW_SIZE', 1000))
+SCHEDULER_CLAIM_SECONDS = float(os.environ.get('SCHEDULER_CLAIM_SECONDS', 120))
+
+# Per-instance send rate (token bucket shared by all workers through Mongo; "memory" keeps it per process)
+SEND_RATE_LIMITER_BACKEND = os.environ.get('SEND_RATE_LIMITER_BACKEND', 'mongo')
+SEND_RATE_BILLING_PER_MINUTE = float(os.environ.get('SEND_RATE_BILLING_PER_MINUTE', 20))
+SEND_RATE_BILLING_BURST = int(os.environ.get('SEND_RATE_BILLING_BURST', 5))
+SEND_RATE_BOTPRESS_PER_MINUTE = float(os.environ.get('SEND_RATE_BOTPRESS_PER_MINUTE', 60))
+SEND_RATE_BOTPRESS_BURST = int(os.environ.get('SEND_RATE_BOTPRESS_BURST', 10))
+# Dashboard sends wait this long for a slot; a later slot queues the message for it instead
+SEND_RATE_INLINE_WAIT_SECONDS = float(os.environ.get('SEND_RATE_INLINE_WAIT_SECONDS', 5))
+
+# Instance lookup cache for the Evolution webhook receiver
+INSTANCE_CACHE_TTL_SECONDS = float(os.environ.get('INSTANCE_CACHE_TTL_SECONDS', 60))
+INSTANCE_CACHE_SIZE = int(os.environ.get('INSTANCE_CACHE_SIZE', 10000))
+
+# Evolution event ingestion pipeline (0 consumers processes events inline)
+INBOUND_CONSUMERS = int(os.environ.get('INBOUND_CONSUMERS', 8))
+INBOUND_QUEUE_SIZE = int(os.environ.get('INBOUND_QUEUE_SIZE', 10000))
+INBOUND_ENQUEUE_TIMEOUT_SECONDS = float(os.environ.get('INBOUND_ENQUEUE_TIMEOUT_SECONDS', 2))
+INBOUND_RETRY_AFTER_SECONDS = float(os.environ.get('INBOUND_RETRY_AFTER_SECONDS', 5))
+INBOUND_SPILL_TO_MONGO = os.environ.get('INBOUND_SPILL_TO_MONGO', 'false').lower() == 'true'
+INBOUND_SPILL_POLL_SECONDS = float(os.environ.get('INBOUND_SPILL_POLL_SECONDS', 5))
+INBOUND_SPILL_ORPHAN_SECONDS = float(os.environ.get('INBOUND_SPILL_ORPHAN_SECONDS', 300))
+INBOUND_SHUTDOWN_GRACE_SECONDS = float(os.environ.get('INBOUND_SHUTDOWN_GRACE_SECONDS', 10))
+
+# Botpress forwarding
+BOTPRESS_TIMEOUT_SECONDS = float(os.environ.get('BOTPRESS_TIMEOUT_SECONDS', 30))
+BOTPRESS_MAX_CONCURRENCY = int(os.environ.get('BOTPRESS_MAX_CONCURRENCY', 50))
+BOTPRESS_MAX_CONNECTIONS_PER_HOST = int(os.environ.get('BOTPRESS_MAX_CONNECTIONS_PER_HOST', 20))
+BOTPRESS_MAX_KEEPALIVE_PER_HOST = int(os.environ.get('BOTPRESS_MAX_KEEPALIVE_PER_HOST', 10))
+BOTPRESS_SHUTDOWN_GRACE_SECONDS = float(os.environ.get('BOTPRESS_SHUTDOWN_GRACE_SECONDS', 10))
+# Per-host clients unused this long, or beyond the newest BOTPRESS_MAX_HOSTS, are closed
+BOTPRESS_MAX_HOSTS = int(os.environ.get('BOTPRESS_MAX_HOSTS', 100))
+BOTPRESS_CLIENT_IDLE_SECONDS = float(os.environ.get('BOTPRESS_CLIENT_IDLE_SECONDS', 300))
+
+# Buffered activity log; durable actions are written before the request returns
+AUDIT_LOG_BUFFER_SIZE = int(os.environ.get('AUDIT_LOG_BUFFER_SIZE', 10000))
+AUDIT_LOG_FLUSH_BATCH = int(os.environ.get('AUDIT_LOG_FLUSH_BATCH', 200))
+AUDIT_LOG_FLUSH_SECONDS = float(os.environ.get('AUDIT_LOG_FLUSH_SECONDS', 2))
+AUDIT_LOG_DURABLE_ACTIONS = {
+    action.strip()
+    for action in os.environ.get('AUDIT_LOG_DURABLE_ACTIONS', 'api_key.created,api_key.revoked').split(',')
+    if action.strip()
+}
+
+# Server-Sent Events stream of instance updates
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+SSE_SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('SSE_SUBSCRIBER_QUEUE_SIZE', 100))
+# Events reach streams on every worker through a capped collection ("false" keeps them per process)
+SSE_SHARED_STREAM = os.environ.get('SSE_SHARED_STREAM', 'true').lower() == 'true'
+SSE_STREAM_SIZE_BYTES = int(os.environ.get('SSE_STREAM_SIZE_BYTES', 16 * 1024 * 1024))
+# Single-use tickets that authenticate an EventSource connection
+SSE_TICKET_TTL_SECONDS = float(os.environ.get('SSE_TICKET_TTL_SECONDS', 60))
+
+# Admission control for the public /api/v1 API (sliding window per API key and per client IP)
+RATE_LIMIT_PER_KEY_PER_MINUTE = int(os.environ.get('RATE_LIMIT_PER_KEY_PER_MINUTE', 600))
+RATE_LIMIT_PER_IP_PER_MINUTE = int(os.environ.get('RATE_LIMIT_PER_IP_PER_MINUTE', 1200))
+RATE_LIMIT_SYNC_SECONDS = float(os.environ.get('RATE_LIMIT_SYNC_SECONDS', 5))
+# Use the first X-Forwarded-For address as the client IP (only behind a trusted proxy)
+RATE_LIMIT_TRUST_FORWARDED = os.environ.get('RATE_LIMIT_TRUST_FORWARDED', 'false').lower() == 'true'
+# Shed /api/v1 send requests with 503 while this many Evolution calls are in flight (0 disables).
+# The count is per worker process, like the EVOLUTION_HTTP_MAX_CONNECTIONS pool it protects,
+# so size it per worker rather than for the whole deployment.
+ADMISSION_MAX_EVOLUTION_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_EVOLUTION_IN_FLIGHT', int(EVOLUTION_HTTP_MAX_CONNECTIONS * 0.9)))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get('ADMISSION_RETRY_AFTER_SECONDS', 5))
+
+# Replays for Idempotency-Key headers and automatic billing invoice de-duplication (0 disables dedupe)
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+# How long an unfinished request holds its keys before a retry may take them over
+IDEMPOTENCY_PENDING_SECONDS = float(os.environ.get('IDEMPOTENCY_PENDING_SECONDS', OUTBOUND_LOCK_SECONDS))
+INVOICE_DEDUPE_TTL_SECONDS = float(os.environ.get('INVOICE_DEDUPE_TTL_SECONDS', 86400))
+
+# Cross-worker cache invalidation
+CACHE_INVALIDATION_POLL_SECONDS = float(os.environ.get('CACHE_INVALIDATION_POLL_SECONDS', 2))
+
+# Admin API (operational endpoints are disabled unless a key is configured)
+ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY', '')
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -104,6 +279,9 @@ class MessageSend(BaseModel):
     message: str
     message_type: str = "text"
 
+class BatchMessageSend(BaseModel):
+    messages: List[MessageSend]
+
 class ButtonItem(BaseModel):
     id: str
     text: str
@@ -125,6 +303,34 @@ class BillingNotificationSend(BaseModel):
     message_type: str = "payment_reminder"  # payment_reminder, invoice, overdue, confirmation
     payment_url: Optional[str] = None
     invoice_url: Optional[str] = None
+    locale: Optional[str] = None  # en, sw, or any locale with a stored override
+
+class BillingTemplateUpsert(BaseModel):
+    message_type: str  # payment_reminder, invoice, overdue, confirmation
+    locale: str = "en"
+    instance_id: Optional[str] = None  # None applies to all of the user's instances
+    title: Optional[str] = None
+    description: Optional[str] = None
+    footer: Optional[str] = None
+
+class ScheduledMessageCreate(BaseModel):
+    send_at: datetime  # naive values are taken as UTC
+    phone_number: Optional[str] = None
+    message: Optional[str] = None
+    billing: Optional[BillingNotificationSend] = None  # send a billing notification instead of text
+
+class ScheduledMessageResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    instance_id: str
+    kind: str  # text, billing
+    phone_number: str
+    payload: Dict[str, Any]
+    send_at: str
+    status: str  # scheduled, claimed, dispatched, cancelled, failed
+    message_id: Optional[str] = None
+    error: Optional[str] = None
+    created_at: str
 
 class BotpressConfig(BaseModel):
     webhook_url: str
@@ -155,7 +361,7 @@ class MessageResponse(BaseModel):
 
 class WebhookCreate(BaseModel):
     url: str
-    events: List[str]  # message.received, message.sent, instance.connected, etc.
+    events: List[str]  # message.received, message.sent, instance.connected, etc.; message.*.batch for batched delivery
     is_active: bool = True
 
 class WebhookResponse(BaseModel):
@@ -204,7 +410,20 @@ class DashboardStats(BaseModel):
 # ===================== EVOLUTION API CLIENT =====================
 
 class EvolutionAPIClient:
-    """Client for interacting with Evolution API"""
+    """Client for interacting with Evolution API over a shared, pooled HTTP connection"""
+    
+    # Default timeout (seconds) per operation, overridable with EVOLUTION_TIMEOUT_<OPERATION>
+    DEFAULT_TIMEOUTS = {
+        "default": 30.0,
+        "create": 30.0,
+        "state": 10.0,
+        "qr": 15.0,
+        "delete": 15.0,
+        "logout": 15.0,
+        "send": 30.0,
+        "fetch": 20.0,
+        "health": 5.0
+    }
     
     def __init__(self):
         self.base_url = EVOLUTION_API_URL
@@ -213,178 +432,891 @@ class EvolutionAPIClient:
             "apikey": self.api_key,
             "Content-Type": "application/json"
         }
+        self.limits = httpx.Limits(
+            max_connections=EVOLUTION_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=EVOLUTION_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=EVOLUTION_HTTP_KEEPALIVE_EXPIRY
+        )
+        self.timeouts = {
+            operation: float(os.environ.get(f"EVOLUTION_TIMEOUT_{operation.upper()}", default))
+            for operation, default in self.DEFAULT_TIMEOUTS.items()
+        }
+        self._client: Optional[httpx.AsyncClient] = None
+        # Serializes opening and closing so concurrent first requests share one client
+        self._client_lock = asyncio.Lock()
+        self._in_flight = 0
+        self._counters = {
+            "requests": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "pool_timeouts": 0,
+            "saturated": 0,
+            "peak_in_flight": 0
+        }
+    
+    async def start(self):
+        """Open the shared HTTP client (called from app startup)"""
+        async with self._client_lock:
+            if self._client is None:
+                self._client = self._open_client()
+    
+    def _open_client(self) -> httpx.AsyncClient:
+        http2 = EVOLUTION_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("EVOLUTION_HTTP2 is enabled but the 'h2' package is not installed; using HTTP/1.1")
+                http2 = False
+        client = httpx.AsyncClient(
+            headers=self.headers,
+            limits=self.limits,
+            http2=http2,
+            timeout=httpx.Timeout(self.timeouts["default"], pool=EVOLUTION_POOL_TIMEOUT)
+        )
+        logger.info(
+            f"Evolution HTTP client started (max_connections={self.limits.max_connections}, "
+            f"keepalive={self.limits.max_keepalive_connections}, http2={http2})"
+        )
+        return client
+    
+    async def close(self):
+        """Close the shared HTTP client (called from app shutdown)"""
+        async with self._client_lock:
+            client, self._client = self._client, None
+            if client is not None:
+                await client.aclose()
+    
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+    
+    def stats(self) -> Dict[str, Any]:
+        """Pool saturation counters"""
+        return {
+            **self._counters,
+            "in_flight": self._in_flight,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections
+        }
+    
+    async def _request(self, method: str, path: str, operation: str, **kwargs) -> httpx.Response:
+        """Issue a request on the shared client with the timeout for the given operation"""
+        client = self._client
+        if client is None:
+            # Used outside the app lifespan (scripts, tests); open lazily
+            await self.start()
+            client = self._client
+        timeout = httpx.Timeout(self.timeouts.get(operation, self.timeouts["default"]), pool=EVOLUTION_POOL_TIMEOUT)
+        
+        self._in_flight += 1
+        self._counters["requests"] += 1
+        self._counters["peak_in_flight"] = max(self._counters["peak_in_flight"], self._in_flight)
+        if self._in_flight > self.limits.max_connections:
+            self._counters["saturated"] += 1
+        try:
+            return await client.request(method, f"{self.base_url}{path}", timeout=timeout, **kwargs)
+        except httpx.PoolTimeout:
+            self._counters["pool_timeouts"] += 1
+            raise
+        except httpx.TimeoutException:
+            self._counters["timeouts"] += 1
+            raise
+        except httpx.HTTPError:
+            self._counters["errors"] += 1
+            raise
+        finally:
+            self._in_flight -= 1
+    
+    async def ping(self) -> httpx.Response:
+        """Check Evolution API connectivity"""
+        return await self._request("GET", "/", "health")
     
     async def create_instance(self, instance_name: str) -> Dict[str, Any]:
         """Create a new WhatsApp instance in Evolution API"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            payload = {
-                "instanceName": instance_name,
-                "qrcode": True,
-                "integration": "WHATSAPP-BAILEYS"
-            }
-            response = await client.post(
-                f"{self.base_url}/instance/create",
-                json=payload,
-                headers=self.headers
-            )
-            logger.info(f"Evolution API create instance response: {response.status_code}")
-            if response.status_code not in [200, 201]:
-                logger.error(f"Evolution API error: {response.text}")
-                raise HTTPException(status_code=response.status_code, detail=f"Evolution API error: {response.text}")
-            return response.json()
+        payload = {
+            "instanceName": instance_name,
+            "qrcode": True,
+            "integration": "WHATSAPP-BAILEYS"
+        }
+        response = await self._request("POST", "/instance/create", "create", json=payload)
+        logger.info(f"Evolution API create instance response: {response.status_code}")
+        if response.status_code not in [200, 201]:
+            logger.error(f"Evolution API error: {response.text}")
+            raise HTTPException(status_code=response.status_code, detail=f"Evolution API error: {response.text}")
+        return response.json()
     
     async def get_instance_connection_state(self, instance_name: str) -> Dict[str, Any]:
         """Get connection state of an instance"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(
-                f"{self.base_url}/instance/connectionState/{instance_name}",
-                headers=self.headers
-            )
-            if response.status_code == 200:
-                return response.json()
-            return {"state": "close"}
+        response = await self._request("GET", f"/instance/connectionState/{instance_name}", "state")
+        if response.status_code == 200:
+            return response.json()
+        return {"state": "close"}
     
     async def get_qr_code(self, instance_name: str) -> Dict[str, Any]:
         """Get QR code for an instance"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(
-                f"{self.base_url}/instance/connect/{instance_name}",
-                headers=self.headers
-            )
-            logger.info(f"Evolution API QR code response: {response.status_code}")
-            if response.status_code == 200:
-                return response.json()
-            return None
+        response = await self._request("GET", f"/instance/connect/{instance_name}", "qr")
+        logger.info(f"Evolution API QR code response: {response.status_code}")
+        if response.status_code == 200:
+            return response.json()
+        return None
     
     async def delete_instance(self, instance_name: str) -> bool:
         """Delete an instance from Evolution API"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.delete(
-                f"{self.base_url}/instance/delete/{instance_name}",
-                headers=self.headers
-            )
-            return response.status_code in [200, 204]
+        response = await self._request("DELETE", f"/instance/delete/{instance_name}", "delete")
+        return response.status_code in [200, 204]
     
     async def logout_instance(self, instance_name: str) -> bool:
         """Logout/disconnect an instance"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.delete(
-                f"{self.base_url}/instance/logout/{instance_name}",
-                headers=self.headers
-            )
-            return response.status_code in [200, 204]
+        response = await self._request("DELETE", f"/instance/logout/{instance_name}", "logout")
+        return response.status_code in [200, 204]
     
     async def send_text_message(self, instance_name: str, phone_number: str, message: str) -> Dict[str, Any]:
         """Send a text message via Evolution API"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Format phone number - remove any non-numeric chars and ensure proper format
-            clean_number = ''.join(filter(str.isdigit, phone_number))
-            if not clean_number.endswith("@s.whatsapp.net"):
-                clean_number = f"{clean_number}@s.whatsapp.net"
-            
-            payload = {
-                "number": clean_number.replace("@s.whatsapp.net", ""),
-                "text": message
-            }
-            response = await client.post(
-                f"{self.base_url}/message/sendText/{instance_name}",
-                json=payload,
-                headers=self.headers
-            )
-            logger.info(f"Evolution API send message response: {response.status_code}")
-            if response.status_code not in [200, 201]:
-                logger.error(f"Evolution API send error: {response.text}")
-                raise HTTPException(status_code=response.status_code, detail=f"Failed to send message: {response.text}")
-            return response.json()
+        # Format phone number - remove any non-numeric chars and ensure proper format
+        clean_number = ''.join(filter(str.isdigit, phone_number))
+        if not clean_number.endswith("@s.whatsapp.net"):
+            clean_number = f"{clean_number}@s.whatsapp.net"
+        
+        payload = {
+            "number": clean_number.replace("@s.whatsapp.net", ""),
+            "text": message
+        }
+        response = await self._request("POST", f"/message/sendText/{instance_name}", "send", json=payload)
+        logger.info(f"Evolution API send message response: {response.status_code}")
+        if response.status_code not in [200, 201]:
+            logger.error(f"Evolution API send error: {response.text}")
+            raise HTTPException(status_code=response.status_code, detail=f"Failed to send message: {response.text}")
+        return response.json()
     
     async def send_button_message(self, instance_name: str, phone_number: str, title: str, description: str, footer: str, buttons: List[Dict]) -> Dict[str, Any]:
         """Send an interactive button message via Evolution API"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            clean_number = ''.join(filter(str.isdigit, phone_number))
-            
-            # Format buttons for Evolution API
-            formatted_buttons = []
-            for btn in buttons:
-                formatted_buttons.append({
-                    "type": "reply",
-                    "reply": {
-                        "id": btn.get("id", str(uuid.uuid4())),
-                        "title": btn.get("text", "Button")[:20]  # WhatsApp limits button text to 20 chars
-                    }
-                })
-            
-            payload = {
-                "number": clean_number,
-                "title": title[:60],  # WhatsApp limits
-                "description": description[:1024],
-                "footer": footer[:60] if footer else "",
-                "buttons": formatted_buttons
-            }
-            
-            response = await client.post(
-                f"{self.base_url}/message/sendButtons/{instance_name}",
-                json=payload,
-                headers=self.headers
-            )
-            logger.info(f"Evolution API send buttons response: {response.status_code}")
-            if response.status_code not in [200, 201]:
-                logger.error(f"Evolution API send buttons error: {response.text}")
-                raise HTTPException(status_code=response.status_code, detail=f"Failed to send button message: {response.text}")
-            return response.json()
+        clean_number = ''.join(filter(str.isdigit, phone_number))
+        
+        # Format buttons for Evolution API
+        formatted_buttons = []
+        for btn in buttons:
+            formatted_buttons.append({
+                "type": "reply",
+                "reply": {
+                    "id": btn.get("id", str(uuid.uuid4())),
+                    "title": btn.get("text", "Button")[:20]  # WhatsApp limits button text to 20 chars
+                }
+            })
+        
+        payload = {
+            "number": clean_number,
+            "title": title[:60],  # WhatsApp limits
+            "description": description[:1024],
+            "footer": footer[:60] if footer else "",
+            "buttons": formatted_buttons
+        }
+        
+        response = await self._request("POST", f"/message/sendButtons/{instance_name}", "send", json=payload)
+        logger.info(f"Evolution API send buttons response: {response.status_code}")
+        if response.status_code not in [200, 201]:
+            logger.error(f"Evolution API send buttons error: {response.text}")
+            raise HTTPException(status_code=response.status_code, detail=f"Failed to send button message: {response.text}")
+        return response.json()
     
     async def send_list_message(self, instance_name: str, phone_number: str, title: str, description: str, button_text: str, sections: List[Dict]) -> Dict[str, Any]:
         """Send a list message via Evolution API"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            clean_number = ''.join(filter(str.isdigit, phone_number))
-            
-            payload = {
-                "number": clean_number,
-                "title": title,
-                "description": description,
-                "buttonText": button_text,
-                "sections": sections
-            }
-            
-            response = await client.post(
-                f"{self.base_url}/message/sendList/{instance_name}",
-                json=payload,
-                headers=self.headers
-            )
-            logger.info(f"Evolution API send list response: {response.status_code}")
-            if response.status_code not in [200, 201]:
-                logger.error(f"Evolution API send list error: {response.text}")
-                raise HTTPException(status_code=response.status_code, detail=f"Failed to send list message: {response.text}")
+        clean_number = ''.join(filter(str.isdigit, phone_number))
+        
+        payload = {
+            "number": clean_number,
+            "title": title,
+            "description": description,
+            "buttonText": button_text,
+            "sections": sections
+        }
+        
+        response = await self._request("POST", f"/message/sendList/{instance_name}", "send", json=payload)
+        logger.info(f"Evolution API send list response: {response.status_code}")
+        if response.status_code not in [200, 201]:
+            logger.error(f"Evolution API send list error: {response.text}")
+            raise HTTPException(status_code=response.status_code, detail=f"Failed to send list message: {response.text}")
+        return response.json()
+    
+    async def fetch_instances(self, strict: bool = False) -> List[Dict[str, Any]]:
+        """Fetch all instances from Evolution API.
+        
+        An error answer reads as no instances unless strict, which raises instead.
+        """
+        response = await self._request("GET", "/instance/fetchInstances", "fetch")
+        if response.status_code == 200:
             return response.json()
-    
-    async def fetch_instances(self) -> List[Dict[str, Any]]:
-        """Fetch all instances from Evolution API"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(
-                f"{self.base_url}/instance/fetchInstances",
-                headers=self.headers
-            )
-            if response.status_code == 200:
-                return response.json()
-            return []
+        if strict:
+            response.raise_for_status()
+        return []
     
     async def get_instance_info(self, instance_name: str) -> Dict[str, Any]:
         """Get instance information including connection details"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(
-                f"{self.base_url}/instance/fetchInstances",
-                headers=self.headers,
-                params={"instanceName": instance_name}
-            )
-            if response.status_code == 200:
-                instances = response.json()
-                for inst in instances:
-                    if inst.get("instance", {}).get("instanceName") == instance_name:
-                        return inst
-            return None
+        response = await self._request(
+            "GET",
+            "/instance/fetchInstances",
+            "fetch",
+            params={"instanceName": instance_name}
+        )
+        if response.status_code == 200:
+            instances = response.json()
+            for inst in instances:
+                if inst.get("instance", {}).get("instanceName") == instance_name:
+                    return inst
+        return None
 
 # Global Evolution API client
 evolution_client = EvolutionAPIClient()
 
+# ===================== CACHES =====================
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire after a fixed TTL"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return entry[0] if entry else default
+    
+    def clear(self):
+        self._data.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None
+        }
+
+# Raw Evolution connection state keyed by evolution_instance_name.
+# Fed by connection.update webhooks; send paths only go to Evolution on a miss.
+connection_state_cache = TTLCache(
+    maxsize=CONNECTION_STATE_CACHE_SIZE,
+    ttl=CONNECTION_STATE_TTL_SECONDS
+)
+
+class APIKeyCache:
+    """Verified API keys (key -> (key_doc, user)) with write-behind of last_used.
+    
+    last_used timestamps are coalesced in memory and flushed periodically with a
+    single bulk_write, so verification costs no Mongo round trip on a hit.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float, flush_interval: float):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.flush_interval = flush_interval
+        self._last_used: Dict[str, str] = {}
+        self._counters = {"flushes": 0, "flushed_keys": 0, "flush_errors": 0}
+        self._task: Optional[asyncio.Task] = None
+    
+    def get(self, api_key: str) -> Optional[tuple]:
+        return self.entries.get(api_key)
+    
+    def set(self, api_key: str, key_doc: dict, user: dict):
+        self.entries.set(api_key, (key_doc, user))
+    
+    def invalidate(self, api_key: str):
+        self.entries.pop(api_key)
+    
+    def touch(self, api_key: str):
+        """Record a use; persisted on the next flush"""
+        self._last_used[api_key] = datetime.now(timezone.utc).isoformat()
+    
+    async def flush(self):
+        pending, self._last_used = self._last_used, {}
+        if not pending:
+            return
+        # $max keeps the newest timestamp when several workers flush the same key
+        updates = [
+            UpdateOne({"key": api_key}, {"$max": {"last_used": last_used}})
+            for api_key, last_used in pending.items()
+        ]
+        try:
+            await db.api_keys.bulk_write(updates, ordered=False)
+            self._counters["flushes"] += 1
+            self._counters["flushed_keys"] += len(updates)
+        except Exception as e:
+            self._counters["flush_errors"] += 1
+            logger.error(f"Could not flush API key last_used: {e}")
+            for api_key, last_used in pending.items():
+                self._last_used[api_key] = max(last_used, self._last_used.get(api_key, last_used))
+    
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.entries.stats(),
+            **self._counters,
+            "pending_last_used": len(self._last_used)
+        }
+
+api_key_cache = APIKeyCache(
+    maxsize=API_KEY_CACHE_SIZE,
+    ttl=API_KEY_CACHE_TTL_SECONDS,
+    flush_interval=API_KEY_LAST_USED_FLUSH_SECONDS
+)
+
+# User documents (without password) keyed by token "sub". The API never updates or
+# deletes users, so changes made directly in Mongo show up within USER_CACHE_TTL_SECONDS.
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+user_cache_counters = {"token_claims": 0}
+
+# User fields that never change after registration and are safe to carry in a token
+TOKEN_USER_FIELDS = ("email", "name", "company", "created_at")
+
+class CacheInvalidator:
+    """Cross-worker cache invalidation through version counters in db.cache_versions.
+    
+    A worker that changes cached data bumps the named version; every worker polls the
+    versions and runs the handlers registered for any name that moved.
+    """
+    
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self._handlers: Dict[str, List[Any]] = {}
+        self._versions: Dict[str, int] = {}
+        self._counters = {"bumps": 0, "reloads": 0, "errors": 0}
+        self._task: Optional[asyncio.Task] = None
+    
+    def register(self, name: str, handler):
+        """handler is an async callable run when another worker bumps `name`"""
+        self._handlers.setdefault(name, []).append(handler)
+    
+    async def bump(self, name: str):
+        doc = await db.cache_versions.find_one_and_update(
+            {"_id": name},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        # Skip our own change, unless someone else bumped in between
+        if doc["version"] == self._versions.get(name, 0) + 1:
+            self._versions[name] = doc["version"]
+        self._counters["bumps"] += 1
+    
+    async def start(self):
+        if self._task is not None:
+            return
+        try:
+            await self.poll(run_handlers=False)
+        except Exception as e:
+            logger.error(f"Could not read cache versions: {e}")
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def poll(self, run_handlers: bool = True):
+        async for doc in db.cache_versions.find({"_id": {"$in": list(self._handlers)}}):
+            name = doc["_id"]
+            if doc["version"] == self._versions.get(name):
+                continue
+            self._versions[name] = doc["version"]
+            if run_handlers:
+                self._counters["reloads"] += 1
+                for handler in self._handlers.get(name, []):
+                    await handler()
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.error(f"Cache invalidation poll failed: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {**self._counters, "versions": dict(self._versions)}
+
+cache_invalidator = CacheInvalidator(CACHE_INVALIDATION_POLL_SECONDS)
+
+class WebhookSubscriptionIndex:
+    """Active webhook targets keyed by (instance_id, event), loaded at startup.
+    
+    Kept current by create_webhook / delete_webhook in this worker and reloaded
+    when another worker bumps the "webhooks" version.
+    """
+    
+    def __init__(self):
+        self.loaded = False
+        self._index: Dict[tuple, List[dict]] = {}
+        self._by_id: Dict[str, dict] = {}
+    
+    async def load(self):
+        index: Dict[tuple, List[dict]] = {}
+        by_id: Dict[str, dict] = {}
+        cursor = db.webhooks.find(
+            {"is_active": True},
+            {"_id": 0, "id": 1, "instance_id": 1, "url": 1, "events": 1}
+        )
+        async for webhook in cursor:
+            by_id[webhook["id"]] = webhook
+            for event in webhook.get("events", []):
+                index.setdefault((webhook["instance_id"], event), []).append(webhook)
+        self._index, self._by_id = index, by_id
+        self.loaded = True
+        logger.info(f"Webhook subscription index loaded ({len(by_id)} active webhooks)")
+    
+    def lookup(self, instance_id: str, event: str) -> List[dict]:
+        return self._index.get((instance_id, event), [])
+    
+    def add(self, webhook: dict):
+        if not webhook.get("is_active", True):
+            return
+        target = {key: webhook[key] for key in ("id", "instance_id", "url", "events")}
+        self._by_id[target["id"]] = target
+        for event in target["events"]:
+            self._index.setdefault((target["instance_id"], event), []).append(target)
+    
+    def remove(self, webhook_id: str):
+        webhook = self._by_id.pop(webhook_id, None)
+        if not webhook:
+            return
+        for event in webhook.get("events", []):
+            key = (webhook["instance_id"], event)
+            remaining = [target for target in self._index.get(key, []) if target["id"] != webhook_id]
+            if remaining:
+                self._index[key] = remaining
+            else:
+                self._index.pop(key, None)
+    
+    def remove_instance(self, instance_id: str):
+        for webhook_id in [wid for wid, webhook in self._by_id.items() if webhook["instance_id"] == instance_id]:
+            self.remove(webhook_id)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"loaded": self.loaded, "webhooks": len(self._by_id), "keys": len(self._index)}
+
+webhook_subscriptions = WebhookSubscriptionIndex()
+cache_invalidator.register("webhooks", webhook_subscriptions.load)
+
+async def _clear_api_key_cache():
+    api_key_cache.entries.clear()
+
+# Revocations in another worker take effect here on the next poll
+cache_invalidator.register("api_keys", _clear_api_key_cache)
+
+class QRCodeCache:
+    """Latest base64 QR code per evolution_instance_name, shared by all workers through db.qr_codes.
+    
+    Whichever worker receives a qrcode.updated event (or fetches a QR from Evolution)
+    writes it here, so every worker serves the code that is currently valid instead of
+    one that has already rotated. Entries expire after QR_CACHE_TTL_SECONDS.
+    """
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._counters = {"hits": 0, "misses": 0, "writes": 0}
+    
+    async def get(self, instance_name: str) -> Optional[str]:
+        doc = await db.qr_codes.find_one({"_id": instance_name, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+        self._counters["hits" if doc else "misses"] += 1
+        return doc["qr_code"] if doc else None
+    
+    async def set(self, instance_name: str, qr_code: str):
+        await db.qr_codes.update_one(
+            {"_id": instance_name},
+            {"$set": {"qr_code": qr_code, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl)}},
+            upsert=True
+        )
+        self._counters["writes"] += 1
+    
+    async def pop(self, instance_name: str):
+        await db.qr_codes.delete_one({"_id": instance_name})
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self._counters["hits"] + self._counters["misses"]
+        return {
+            **self._counters,
+            "ttl": self.ttl,
+            "hit_rate": round(self._counters["hits"] / lookups, 4) if lookups else None
+        }
+
+qr_code_cache = QRCodeCache(QR_CACHE_TTL_SECONDS)
+
+# Instance documents keyed by evolution_instance_name for the Evolution webhook receiver.
+# Unknown names are cached as False so foreign instances do not hit Mongo on every event.
+instance_name_cache = TTLCache(maxsize=INSTANCE_CACHE_SIZE, ttl=INSTANCE_CACHE_TTL_SECONDS)
+
+async def _clear_instance_name_cache():
+    instance_name_cache.clear()
+
+cache_invalidator.register("instances", _clear_instance_name_cache)
+
+class IdempotencyStore:
+    """Stored responses of public send calls, keyed by idempotency or dedupe key.
+    
+    A request first reserves its keys by inserting "pending" documents into
+    db.idempotency_keys (unique _id, TTL on expires_at). The reservation is a short
+    lease of IDEMPOTENCY_PENDING_SECONDS, so a request that died mid-flight blocks
+    retries only until it lapses; a finished request keeps its keys for their full
+    TTL. A duplicate whose original finished gets the stored response back without
+    touching Evolution; one whose original is still running gets a 409. Keys that
+    carry a request hash answer 422 when reused for a different request. Finished
+    responses are also kept in a TTLCache so repeated retries do not reach Mongo.
+    
+    Once the handler has queued the send its keys are never released: if storing the
+    response fails, the keys stay pending and the write is retried in the background,
+    so a client retry gets a 409 and then the replay rather than a second send.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.responses = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._counters = {"reserved": 0, "replayed": 0, "conflicts": 0, "mismatches": 0, "reclaimed": 0, "store_retries": 0}
+    
+    async def run(self, keys: List[tuple], handler, status_code: int = 202):
+        """Run handler once per set of (key, ttl_seconds, request_hash or None); duplicates get the original response"""
+        if not keys:
+            return await handler()
+        replay = await self._lookup(keys)
+        if replay is not None:
+            return self._replay(replay, status_code)
+        
+        reserved = []
+        try:
+            for key, _, request_hash in keys:
+                await self._reserve(key, request_hash)
+                reserved.append(key)
+        except DuplicateKeyError:
+            await self.release(reserved)
+            replay = await self._lookup(keys)
+            if replay is not None:
+                return self._replay(replay, status_code)
+            self._counters["conflicts"] += 1
+            raise HTTPException(status_code=409, detail="An identical request is still being processed")
+        self._counters["reserved"] += 1
+        
+        try:
+            response = await handler()
+        except BaseException:
+            # Let the caller retry a request that did not go through
+            await self.release(reserved)
+            raise
+        
+        for key, _, request_hash in keys:
+            self.responses.set(key, {"response": response, "request_hash": request_hash})
+        try:
+            await self._store(keys, response)
+        except Exception as e:
+            # The send is queued; answering with an error would only invite a duplicate
+            logger.error(f"Could not store idempotent response, retrying in the background: {e}")
+            spawn_background(self._store_later(keys, response))
+        return response
+    
+    async def _store(self, keys: List[tuple], response: dict):
+        now = datetime.now(timezone.utc)
+        await db.idempotency_keys.bulk_write([
+            UpdateOne(
+                {"_id": key},
+                {"$set": {"state": "done", "response": response, "expires_at": now + timedelta(seconds=ttl)}}
+            )
+            for key, ttl, _ in keys
+        ], ordered=False)
+    
+    async def _store_later(self, keys: List[tuple], response: dict):
+        """Keep trying to store a response; the keys stay pending (and block retries) meanwhile.
+        
+        A retry can only take over a lapsed lease while Mongo takes writes, and then
+        this write lands too, so giving up after the lease period is safe.
+        """
+        deadline = time.monotonic() + IDEMPOTENCY_PENDING_SECONDS
+        delay = 0.5
+        while True:
+            await asyncio.sleep(delay)
+            self._counters["store_retries"] += 1
+            try:
+                await self._store(keys, response)
+                return
+            except Exception as e:
+                if time.monotonic() >= deadline:
+                    logger.error(f"Gave up storing idempotent response for {[key for key, _, _ in keys]}: {e}")
+                    return
+            delay = min(delay * 2, 5)
+    
+    async def _reserve(self, key: str, request_hash: Optional[str]):
+        """Insert a pending lease on key, taking over one that has lapsed; DuplicateKeyError if it is held"""
+        now = datetime.now(timezone.utc)
+        lease = {
+            "state": "pending",
+            "request_hash": request_hash,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=IDEMPOTENCY_PENDING_SECONDS)
+        }
+        try:
+            await db.idempotency_keys.insert_one({"_id": key, **lease})
+        except DuplicateKeyError:
+            # The TTL monitor only runs once a minute; do not wait for it to drop a dead lease
+            taken = await db.idempotency_keys.find_one_and_update(
+                {"_id": key, "state": "pending", "expires_at": {"$lte": now}},
+                {"$set": lease}
+            )
+            if taken is None:
+                raise
+            self._counters["reclaimed"] += 1
+    
+    async def _lookup(self, keys: List[tuple]) -> Optional[dict]:
+        for key, _, request_hash in keys:
+            entry = self.responses.get(key)
+            if entry is not None:
+                self._check_request(entry, request_hash)
+                return entry["response"]
+        
+        request_hashes = {key: request_hash for key, _, request_hash in keys}
+        now = datetime.now(timezone.utc)
+        found = None
+        async for doc in db.idempotency_keys.find({"_id": {"$in": list(request_hashes)}}):
+            if doc["state"] == "pending" and as_utc(doc["expires_at"]) <= now:
+                continue  # a lapsed lease binds nothing
+            self._check_request(doc, request_hashes[doc["_id"]])
+            if doc["state"] == "done" and found is None:
+                found = doc
+        if found:
+            self.responses.set(found["_id"], {"response": found["response"], "request_hash": found.get("request_hash")})
+            return found["response"]
+        return None
+    
+    def _check_request(self, entry: dict, request_hash: Optional[str]):
+        """Reject an idempotency key reused with a different request body"""
+        if request_hash and entry.get("request_hash") and entry["request_hash"] != request_hash:
+            self._counters["mismatches"] += 1
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    
+    def _replay(self, response: dict, status_code: int) -> JSONResponse:
+        self._counters["replayed"] += 1
+        return JSONResponse(response, status_code=status_code, headers={"Idempotent-Replayed": "true"})
+    
+    async def release(self, keys: List[str]):
+        if keys:
+            await db.idempotency_keys.delete_many({"_id": {"$in": keys}, "state": "pending"})
+    
+    def stats(self) -> dict:
+        return {**self._counters, "cache": self.responses.stats()}
+
+# The front cache must not outlive the shorter of the two key lifetimes
+idempotency_store = IdempotencyStore(
+    IDEMPOTENCY_CACHE_SIZE,
+    min(IDEMPOTENCY_TTL_SECONDS, INVOICE_DEDUPE_TTL_SECONDS or IDEMPOTENCY_TTL_SECONDS)
+)
+
+# ===================== BILLING TEMPLATES =====================
+
+BILLING_MESSAGE_TYPES = ["payment_reminder", "invoice", "overdue", "confirmation"]
+
+# Placeholders available to billing templates (str.format syntax, e.g. {customer_name})
+BILLING_TEMPLATE_FIELDS = {
+    "customer_name", "amount", "currency", "invoice_id", "due_date", "due_date_line", "payment_url", "invoice_url"
+}
+
+BUILTIN_BILLING_TEMPLATES = {
+    "en": {
+        "due_date_line": "Due Date: {due_date}",
+        "buttons": {"paynow": "PayNow", "invoice": "Invoice", "view_invoice": "View Invoice"},
+        "payment_reminder": {
+            "title": "Payment Due Reminder",
+            "description": "Dear {customer_name},\n\nThis is a reminder that your payment of {currency} {amount} is due.\n\nInvoice: #{invoice_id}\n{due_date_line}\n\nPlease ignore if already paid.",
+            "footer": "Tap PayNow to pay instantly"
+        },
+        "invoice": {
+            "title": "New Invoice Generated",
+            "description": "Dear {customer_name},\n\nA new invoice has been generated for your account.\n\nAmount: {currency} {amount}\nInvoice: #{invoice_id}\n{due_date_line}",
+            "footer": "Tap PayNow to pay instantly"
+        },
+        "overdue": {
+            "title": "Payment Overdue Notice",
+            "description": "Dear {customer_name},\n\nYour account is now OVERDUE.\n\nOutstanding: {currency} {amount}\nInvoice: #{invoice_id}\n\nPlease settle immediately to avoid service interruption.",
+            "footer": "Pay now to restore service"
+        },
+        "confirmation": {
+            "title": "Payment Received",
+            "description": "Dear {customer_name},\n\nThank you! We have received your payment.\n\nAmount: {currency} {amount}\nInvoice: #{invoice_id}\n\nYour account is now up to date.",
+            "footer": "Thank you for your payment"
+        }
+    },
+    "sw": {
+        "due_date_line": "Tarehe ya Mwisho: {due_date}",
+        "buttons": {"paynow": "PayNow", "invoice": "Ankara", "view_invoice": "Angalia Ankara"},
+        "payment_reminder": {
+            "title": "Kikumbusho cha Malipo",
+            "description": "Mpendwa {customer_name},\n\nHiki ni kikumbusho kwamba malipo yako ya {currency} {amount} yanadaiwa.\n\nAnkara: #{invoice_id}\n{due_date_line}\n\nTafadhali puuza ujumbe huu kama umeshalipa.",
+            "footer": "Bonyeza PayNow kulipa sasa hivi"
+        },
+        "invoice": {
+            "title": "Ankara Mpya Imetolewa",
+            "description": "Mpendwa {customer_name},\n\nAnkara mpya imetolewa kwa akaunti yako.\n\nKiasi: {currency} {amount}\nAnkara: #{invoice_id}\n{due_date_line}",
+            "footer": "Bonyeza PayNow kulipa sasa hivi"
+        },
+        "overdue": {
+            "title": "Notisi ya Malipo Yaliyochelewa",
+            "description": "Mpendwa {customer_name},\n\nAkaunti yako sasa imechelewa kulipwa.\n\nKiasi kinachodaiwa: {currency} {amount}\nAnkara: #{invoice_id}\n\nTafadhali lipa mara moja ili kuepuka kusitishwa kwa huduma.",
+            "footer": "Lipa sasa kurejesha huduma"
+        },
+        "confirmation": {
+            "title": "Malipo Yamepokelewa",
+            "description": "Mpendwa {customer_name},\n\nAsante! Tumepokea malipo yako.\n\nKiasi: {currency} {amount}\nAnkara: #{invoice_id}\n\nAkaunti yako sasa iko sawa.",
+            "footer": "Asante kwa malipo yako"
+        }
+    }
+}
+
+class CompiledTemplate:
+    """A str.format template parsed once into (literal, field) parts"""
+    
+    def __init__(self, source: str):
+        self.source = source
+        self.parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(source):
+            if field is not None and (field not in BILLING_TEMPLATE_FIELDS or spec or conversion):
+                raise ValueError(f"Unsupported placeholder {{{field}}} in template")
+            self.parts.append((literal, field))
+    
+    def render(self, context: Dict[str, str]) -> str:
+        return "".join(literal + context[field] if field else literal for literal, field in self.parts)
+
+class BillingTemplateRegistry:
+    """Compiled billing templates with per-user and per-instance overrides from db.billing_templates.
+    
+    Built-in templates are compiled at import. An override document may replace any
+    of title/description/footer for one message type and locale; instance overrides
+    win over user overrides, which win over the built-in text. The merged, compiled
+    result is cached per (user, instance, locale, message type).
+    """
+    
+    def __init__(self):
+        self.builtin = {
+            locale: {
+                key: {field: CompiledTemplate(text) for field, text in value.items()}
+                if key in BILLING_MESSAGE_TYPES else value
+                for key, value in templates.items()
+            }
+            for locale, templates in BUILTIN_BILLING_TEMPLATES.items()
+        }
+        self.cache = TTLCache(maxsize=BILLING_TEMPLATE_CACHE_SIZE, ttl=BILLING_TEMPLATE_CACHE_TTL_SECONDS)
+        self._counters = {"renders": 0, "render_seconds_total": 0.0, "render_seconds_max": 0.0}
+    
+    async def get(self, user_id: str, instance_id: Optional[str], locale: str, message_type: str) -> dict:
+        key = (user_id, instance_id, locale, message_type)
+        compiled = self.cache.get(key)
+        if compiled is None:
+            compiled = await self._load(user_id, instance_id, locale, message_type)
+            self.cache.set(key, compiled)
+        return compiled
+    
+    async def _load(self, user_id: str, instance_id: Optional[str], locale: str, message_type: str) -> dict:
+        builtin_locale = self.builtin.get(locale) or self.builtin[BILLING_DEFAULT_LOCALE]
+        builtin_type = message_type if message_type in BILLING_MESSAGE_TYPES else "payment_reminder"
+        compiled = {
+            **builtin_locale[builtin_type],
+            "due_date_line": CompiledTemplate(builtin_locale["due_date_line"]),
+            "buttons": builtin_locale["buttons"]
+        }
+        
+        overrides = await db.billing_templates.find(
+            {"user_id": user_id, "locale": locale, "message_type": message_type, "instance_id": {"$in": [instance_id, None]}},
+            {"_id": 0}
+        ).to_list(2)
+        # User-wide first so the instance-specific override is applied last
+        for override in sorted(overrides, key=lambda doc: doc.get("instance_id") is not None):
+            for field in ("title", "description", "footer"):
+                if override.get(field) is not None:
+                    compiled[field] = CompiledTemplate(override[field])
+        return compiled
+    
+    def render(self, compiled: dict, billing_data: "BillingNotificationSend") -> dict:
+        """Render title/description/footer and button labels; pure CPU, timed for metrics"""
+        started = time.perf_counter()
+        context = {
+            "customer_name": billing_data.customer_name,
+            "amount": f"{billing_data.amount:,.2f}",
+            "currency": billing_data.currency,
+            "invoice_id": billing_data.invoice_id,
+            "due_date": billing_data.due_date or "",
+            "payment_url": billing_data.payment_url or "",
+            "invoice_url": billing_data.invoice_url or ""
+        }
+        context["due_date_line"] = compiled["due_date_line"].render(context) if billing_data.due_date else ""
+        rendered = {field: compiled[field].render(context) for field in ("title", "description", "footer")}
+        rendered["buttons"] = compiled["buttons"]
+        
+        elapsed = time.perf_counter() - started
+        self._counters["renders"] += 1
+        self._counters["render_seconds_total"] += elapsed
+        self._counters["render_seconds_max"] = max(self._counters["render_seconds_max"], elapsed)
+        return rendered
+    
+    def stats(self) -> dict:
+        renders = self._counters["renders"]
+        return {
+            **self._counters,
+            "render_seconds_avg": self._counters["render_seconds_total"] / renders if renders else None,
+            "cache": self.cache.stats()
+        }
+
+billing_templates = BillingTemplateRegistry()
+
+async def _clear_billing_template_cache():
+    billing_templates.cache.clear()
+
+cache_invalidator.register("billing_templates", _clear_billing_template_cache)
+
 # ===================== HELPERS =====================
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -393,6 +1325,13 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+def build_token_claims(user: dict) -> dict:
+    """JWT claims for a user, optionally embedding the immutable profile fields"""
+    claims = {"sub": user["id"]}
+    if JWT_EMBED_USER_CLAIMS:
+        claims["usr"] = {field: user.get(field) for field in TOKEN_USER_FIELDS}
+    return claims
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -409,7 +1348,10 @@ def generate_instance_name(user_id: str, instance_name: str) -> str:
     return f"tnx_{short_id}_{clean_name}"
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+    return await resolve_token_user(credentials.credentials)
+
+async def resolve_token_user(token: str) -> dict:
+    """Resolve a JWT to its user (claims, then cache, then Mongo)"""
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user_id = payload.get("sub")
@@ -418,26 +1360,55 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
+    # Signed claims carry everything the routes need
+    claims = payload.get("usr")
+    if JWT_EMBED_USER_CLAIMS and isinstance(claims, dict):
+        user_cache_counters["token_claims"] += 1
+        return {"id": user_id, "is_active": True, **claims}
+    
+    user = user_cache.get(user_id)
     if user is None:
-        raise HTTPException(status_code=401, detail="User not found")
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        user_cache.set(user_id, user)
     return user
 
 async def verify_api_key(api_key: str):
     """Verify API key and return associated user"""
-    key_doc = await db.api_keys.find_one({"key": api_key, "is_active": True}, {"_id": 0})
-    if not key_doc:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
-    # Update last used
-    await db.api_keys.update_one(
-        {"key": api_key},
-        {"$set": {"last_used": datetime.now(timezone.utc).isoformat()}}
-    )
+    cached = api_key_cache.get(api_key)
+    if cached:
+        key_doc, user = cached
+    else:
+        key_doc = await db.api_keys.find_one({"key": api_key, "is_active": True}, {"_id": 0})
+        if not key_doc:
+            raise HTTPException(status_code=401, detail="Invalid API key")
+        user = await db.users.find_one({"id": key_doc["user_id"]}, {"_id": 0})
+        api_key_cache.set(api_key, key_doc, user)
+    
+    # Update last used (flushed in the background)
+    api_key_cache.touch(api_key)
+    return user, key_doc
+
+async def verify_api_key_header(authorization: Optional[str], permission: str) -> tuple:
+    """Resolve a "Bearer <api key>" value and check the key has permission; returns (user, key_doc)"""
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="API key required")
     
-    user = await db.users.find_one({"id": key_doc["user_id"]}, {"_id": 0})
+    user, key_doc = await verify_api_key(authorization.replace("Bearer ", ""))
+    if permission not in key_doc.get("permissions", []):
+        raise HTTPException(status_code=403, detail="Permission denied")
     return user, key_doc
 
+def idempotency_keys_for(user_id: str, operation: str, idempotency_key: Optional[str], request: dict) -> List[tuple]:
+    """(key, ttl, request_hash) for a client-supplied Idempotency-Key, scoped to the user and operation"""
+    if not idempotency_key:
+        return []
+    if len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key must be at most 255 characters")
+    request_hash = hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+    return [(f"idem:{user_id}:{operation}:{idempotency_key}", IDEMPOTENCY_TTL_SECONDS, request_hash)]
+
 async def log_activity(user_id: str, action: str, instance_id: str = None, details: dict = None, ip_address: str = None):
     """Log user activity"""
     log_entry = {
@@ -449,40 +1420,2285 @@ async def log_activity(user_id: str, action: str, instance_id: str = None, detai
         "ip_address": ip_address,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
-    await db.logs.insert_one(log_entry)
+    if action in AUDIT_LOG_DURABLE_ACTIONS:
+        await audit_logger.write(log_entry)
+    else:
+        audit_logger.append(log_entry)
+
+async def webhook_targets(instance_id: str, event: str) -> List[dict]:
+    """Active webhooks subscribed to an event"""
+    if webhook_subscriptions.loaded:
+        return webhook_subscriptions.lookup(instance_id, event)
+    return await db.webhooks.find({
+        "instance_id": instance_id,
+        "is_active": True,
+        "events": event
+    }, {"_id": 0, "id": 1, "url": 1}).to_list(100)
+
+async def trigger_webhooks(instance_id: str, event: str, data: dict):
+    """Trigger webhooks for an event"""
+    webhooks = await webhook_targets(instance_id, event)
+    if webhooks:
+        await webhook_engine.dispatch(instance_id, event, data, webhooks)
+
+async def trigger_webhooks_batch(instance_id: str, event: str, items: List[dict]):
+    """Trigger webhooks for many events of the same type.
+    
+    Subscribers of `event` get one delivery per item in the usual shape. Batching is
+    opt-in: subscribers of "<event>.batch" get a single {"count", "items"} delivery.
+    """
+    if not items:
+        return
+    webhooks = await webhook_targets(instance_id, event)
+    if webhooks:
+        await asyncio.gather(*(webhook_engine.dispatch(instance_id, event, item, webhooks) for item in items))
+    batch_webhooks = await webhook_targets(instance_id, f"{event}.batch")
+    if batch_webhooks:
+        await webhook_engine.dispatch(
+            instance_id, f"{event}.batch", {"count": len(items), "items": items}, batch_webhooks
+        )
+
+def _cursor_signature(raw: bytes) -> str:
+    digest = hmac.new(JWT_SECRET.encode(), raw, hashlib.sha256).digest()[:12]
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+def encode_cursor(doc: dict) -> str:
+    """Opaque keyset cursor for the position just after doc in (created_at, id) order.
+    
+    It is signed, so a client cannot edit it to start a page somewhere else.
+    """
+    raw = json.dumps([doc["created_at"], doc["id"]], separators=(",", ":")).encode()
+    return f"{base64.urlsafe_b64encode(raw).decode().rstrip('=')}.{_cursor_signature(raw)}"
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        body, signature = cursor.split(".")
+        raw = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+        if not hmac.compare_digest(signature, _cursor_signature(raw)):
+            raise ValueError
+        created_at, doc_id = json.loads(raw)
+        if not isinstance(created_at, str) or not isinstance(doc_id, str):
+            raise ValueError
+        return created_at, doc_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def as_utc(value: datetime) -> datetime:
+    """Attach UTC to naive datetimes (Mongo returns them without tzinfo)"""
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+def to_iso(value: datetime) -> str:
+    """Normalise a query timestamp to the UTC isoformat strings stored in created_at"""
+    return as_utc(value).isoformat()
+
+async def fetch_page(collection, query: dict, limit: int, offset: int = 0, cursor: Optional[str] = None,
+                     since: Optional[datetime] = None, until: Optional[datetime] = None) -> tuple:
+    """Newest-first page on (created_at, id); returns (docs, next_cursor or None).
+    
+    With a cursor the page starts right after it via an index range, so deep pages
+    cost the same as the first. offset is only applied when no cursor is given.
+    """
+    clauses = [time_range_query(query, since, until)]
+    if cursor:
+        created_at, doc_id = decode_cursor(cursor)
+        clauses.append({"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": doc_id}}
+        ]})
+    
+    find = collection.find(
+        clauses[0] if len(clauses) == 1 else {"$and": clauses},
+        {"_id": 0}
+    ).sort([("created_at", DESCENDING), ("id", DESCENDING)])
+    if offset and not cursor:
+        find = find.skip(offset)
+    # One extra document tells us whether there is a next page
+    docs = await find.limit(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        return docs, encode_cursor(docs[-1])
+    return docs, None
+
+def time_range_query(query: dict, since: Optional[datetime], until: Optional[datetime]) -> dict:
+    if since or until:
+        query = {**query, "created_at": {}}
+        if since:
+            query["created_at"]["$gte"] = to_iso(since)
+        if until:
+            query["created_at"]["$lt"] = to_iso(until)
+    return query
+
+async def export_rows(collection, query: dict, fields: List[str], fmt: str, compress: bool,
+                      sort: Optional[List[tuple]] = None):
+    """Stream matching documents (oldest first by default) as NDJSON or CSV, one chunk per cursor batch"""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # gzip container
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(fields)
+    
+    cursor = collection.find(query, {"_id": 0, **{field: 1 for field in fields}}).sort(
+        sort or [("created_at", ASCENDING), ("id", ASCENDING)]
+    ).batch_size(EXPORT_BATCH_SIZE)
+    rows = 0
+    async for doc in cursor:
+        if fmt == "csv":
+            writer.writerow([
+                json.dumps(doc[field]) if isinstance(doc.get(field), (dict, list)) else doc.get(field, "")
+                for field in fields
+            ])
+        else:
+            buffer.write(json.dumps(doc, default=str))
+            buffer.write("\n")
+        rows += 1
+        if rows % EXPORT_BATCH_SIZE == 0:
+            chunk = buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            yield compressor.compress(chunk) if compressor else chunk
+    
+    chunk = buffer.getvalue().encode()
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+def export_response(collection, query: dict, fields: List[str], fmt: str, compress: bool, filename: str,
+                    sort: Optional[List[tuple]] = None) -> StreamingResponse:
+    if fmt not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+    filename = f"{filename}.{fmt}" + (".gz" if compress else "")
+    media_type = "application/gzip" if compress else ("text/csv" if fmt == "csv" else "application/x-ndjson")
+    return StreamingResponse(
+        export_rows(collection, query, fields, fmt, compress, sort),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+async def build_billing_message(user_id: str, instance: dict, billing_data: BillingNotificationSend,
+                                message_id: str, message_status: str, now: str) -> tuple:
+    """Render a billing notification; returns (template, message_doc) shared by both billing endpoints"""
+    locale = billing_data.locale or BILLING_DEFAULT_LOCALE
+    compiled = await billing_templates.get(user_id, instance["id"], locale, billing_data.message_type)
+    template = billing_templates.render(compiled, billing_data)
+    
+    # Buttons for billing (except confirmation which doesn't need PayNow)
+    labels = template["buttons"]
+    if billing_data.message_type == "confirmation":
+        buttons = [{"id": f"invoice_{billing_data.invoice_id}", "text": labels["view_invoice"]}]
+    else:
+        buttons = [
+            {"id": f"paynow_{billing_data.invoice_id}", "text": labels["paynow"]},
+            {"id": f"invoice_{billing_data.invoice_id}", "text": labels["invoice"]}
+        ]
+    template["buttons"] = buttons
+    
+    message_doc = {
+        "id": message_id,
+        "instance_id": instance["id"],
+        "phone_number": billing_data.phone_number,
+        "message": f"{template['title']}\n{template['description']}",
+        "message_type": f"billing_{billing_data.message_type}",
+        "direction": "outgoing",
+        "status": message_status,
+        "billing_data": {
+            "customer_name": billing_data.customer_name,
+            "amount": billing_data.amount,
+            "currency": billing_data.currency,
+            "invoice_id": billing_data.invoice_id,
+            "due_date": billing_data.due_date,
+            "payment_url": billing_data.payment_url,
+            "invoice_url": billing_data.invoice_url,
+            "locale": locale
+        },
+        "buttons": buttons,
+        "created_at": now
+    }
+    return template, message_doc
+
+async def get_instance_by_evolution_name(instance_name: str) -> Optional[dict]:
+    """Instance document for an Evolution instance name, served from cache"""
+    instance = instance_name_cache.get(instance_name)
+    if instance is None:
+        instance = await db.instances.find_one({"evolution_instance_name": instance_name}, {"_id": 0})
+        instance_name_cache.set(instance_name, instance or False)
+    return instance or None
+
+async def invalidate_instance_cache(instance: dict):
+    """Drop a cached instance document here and in every other worker"""
+    if instance.get("evolution_instance_name"):
+        instance_name_cache.pop(instance["evolution_instance_name"])
+    await cache_invalidator.bump("instances")
+
+def extract_connection_state(state_response: Dict[str, Any]) -> str:
+    """Pull the raw Evolution state out of a connectionState response"""
+    return state_response.get("instance", {}).get("state") or state_response.get("state", "close")
+
+async def get_cached_connection_state(instance_name: str) -> str:
+    """Connection state from the webhook-fed cache, asking Evolution only on a miss or stale entry"""
+    state = connection_state_cache.get(instance_name)
+    if state is None:
+        state_response = await evolution_client.get_instance_connection_state(instance_name)
+        state = extract_connection_state(state_response)
+        connection_state_cache.set(instance_name, state)
+    return state
+
+def index_evolution_instances(evolution_instances: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Index a fetchInstances response by instance name (handles v1 and v2 payload shapes)"""
+    index = {}
+    for entry in evolution_instances or []:
+        if not isinstance(entry, dict):
+            continue
+        info = entry.get("instance") if isinstance(entry.get("instance"), dict) else entry
+        name = info.get("instanceName") or info.get("name")
+        if not name:
+            continue
+        owner = info.get("owner") or info.get("ownerJid")
+        index[name] = {
+            "state": info.get("status") or info.get("state") or info.get("connectionStatus"),
+            "phone_number": owner.replace("@s.whatsapp.net", "") if owner else None
+        }
+    return index
+
+async def refresh_instance_statuses(instances: List[dict]) -> List[tuple]:
+    """Resolve (status, phone_number) for many instances and persist changes in one bulk_write.
+    
+    One fetchInstances call covers every instance it lists; anything missing from it
+    falls back to a per-instance connectionState call, bounded by a semaphore.
+    """
+    if not instances:
+        return []
+    
+    try:
+        index = index_evolution_instances(await evolution_client.fetch_instances())
+    except Exception as e:
+        logger.warning(f"Could not fetch Evolution instances: {e}")
+        index = {}
+    
+    semaphore = asyncio.Semaphore(EVOLUTION_FANOUT_CONCURRENCY)
+    
+    async def resolve(inst: dict) -> tuple:
+        status = inst.get("status", "disconnected")
+        phone_number = inst.get("phone_number")
+        instance_name = inst.get("evolution_instance_name")
+        if not instance_name:
+            return status, phone_number
+        
+        entry = index.get(instance_name) or {}
+        try:
+            state = entry.get("state")
+            if not state:
+                async with semaphore:
+                    state_response = await evolution_client.get_instance_connection_state(instance_name)
+                state = extract_connection_state(state_response)
+            connection_state_cache.set(instance_name, state)
+            status = map_evolution_state_to_status(state)
+            if status == "connected" and entry.get("phone_number"):
+                phone_number = entry["phone_number"]
+        except Exception as e:
+            logger.warning(f"Could not get Evolution state for {instance_name}: {e}")
+        return status, phone_number
+    
+    results = await asyncio.gather(*(resolve(inst) for inst in instances))
+    
+    # Write back only what changed, in one round trip
+    now = datetime.now(timezone.utc).isoformat()
+    updates = [
+        UpdateOne(
+            {"id": inst["id"]},
+            {"$set": {"status": status, "phone_number": phone_number, "updated_at": now}}
+        )
+        for inst, (status, phone_number) in zip(instances, results)
+        if status != inst.get("status") or phone_number != inst.get("phone_number")
+    ]
+    if updates:
+        try:
+            await db.instances.bulk_write(updates, ordered=False)
+        except Exception as e:
+            logger.warning(f"Could not persist instance statuses: {e}")
+    return results
+
+def extract_qr_code(qr_response: Optional[dict]) -> Optional[str]:
+    if not qr_response:
+        return None
+    qrcode = qr_response.get("qrcode")
+    if isinstance(qrcode, str):
+        return qrcode
+    return qr_response.get("base64") or (qrcode or {}).get("base64")
+
+async def get_cached_qr_code(evolution_instance_name: str) -> Optional[str]:
+    """Latest QR for an instance; calls Evolution only when nothing is cached"""
+    qr_code = await qr_code_cache.get(evolution_instance_name)
+    if qr_code is None:
+        qr_code = extract_qr_code(await evolution_client.get_qr_code(evolution_instance_name))
+        if qr_code:
+            await qr_code_cache.set(evolution_instance_name, qr_code)
+    return qr_code
+
+def map_evolution_state_to_status(state: str) -> str:
+    """Map Evolution API connection state to our status"""
+    state_mapping = {
+        "open": "connected",
+        "connecting": "connecting",
+        "close": "disconnected",
+        "closed": "disconnected"
+    }
+    return state_mapping.get(state.lower(), "disconnected")
+
+# ===================== BACKGROUND SERVICES =====================
+
+# Identifies this process when coordinating with other workers through Mongo
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_background_tasks: set = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    """Run a coroutine detached from the request, keeping a reference until it finishes"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def acquire_lease(name: str, ttl: float) -> bool:
+    """Take or renew a named Mongo lease so only one worker runs a periodic job"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.leases.find_one_and_update(
+            {"_id": name, "$or": [{"holder": WORKER_ID}, {"expires_at": {"$lte": now}}]},
+            {"$set": {"holder": WORKER_ID, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lease
+        return False
+
+class SendRateLimiter:
+    """Per-instance send rate limit (GCRA token bucket) shared across workers.
+    
+    Each instance's bucket is a theoretical arrival time (tat) in Mongo server time,
+    kept in db.send_rate_buckets and updated with one atomic pipeline update.
+    reserve() books the next slot and says how far off it is; nothing is ever
+    rejected. The outbound queue parks a job until its slot comes up, and dashboard
+    sends wait for a near slot or queue the message for a later one (see
+    wait_for_send_slot). Billing and Botpress instances (instance_type) have their
+    own rate and burst. If Mongo is unavailable the limiter falls back to a
+    per-process bucket.
+    """
+    
+    def __init__(self, backend: str):
+        self.backend = backend
+        self._local_tat: Dict[str, float] = {}
+        self._counters = {"reserved": 0, "deferred": 0, "defer_seconds_max": 0.0, "fallbacks": 0}
+    
+    @staticmethod
+    def limits_for(instance_type: str) -> tuple:
+        """(seconds between sends, burst) for an instance_type"""
+        if instance_type == "botpress":
+            rate, burst = SEND_RATE_BOTPRESS_PER_MINUTE, SEND_RATE_BOTPRESS_BURST
+        else:
+            rate, burst = SEND_RATE_BILLING_PER_MINUTE, SEND_RATE_BILLING_BURST
+        # A rate of 0 disables limiting for that type
+        return (60.0 / rate if rate > 0 else 0.0), max(1, burst)
+    
+    async def reserve(self, instance_name: str, instance_type: str) -> float:
+        """Reserve this instance's next send slot; returns the seconds until it comes up"""
+        interval, burst = self.limits_for(instance_type)
+        if interval <= 0:
+            return 0.0
+        wait = None
+        if self.backend == "mongo":
+            try:
+                wait = await self._reserve_shared(instance_name, interval, burst)
+            except Exception as e:
+                self._counters["fallbacks"] += 1
+                logger.warning(f"Send rate limiter falling back to local bucket: {e}")
+        if wait is None:
+            wait = self._reserve_local(instance_name, interval, burst)
+        
+        self._counters["reserved"] += 1
+        if wait > 0:
+            self._counters["deferred"] += 1
+            self._counters["defer_seconds_max"] = max(self._counters["defer_seconds_max"], wait)
+        return wait
+    
+    async def _reserve_shared(self, instance_name: str, interval: float, burst: int) -> float:
+        # Whole milliseconds keep the date arithmetic exact
+        interval_ms = max(1, round(interval * 1000))
+        bucket = await db.send_rate_buckets.find_one_and_update(
+            {"_id": instance_name},
+            [{"$set": {
+                "now": "$$NOW",
+                "tat": {"$add": [{"$max": [{"$ifNull": ["$tat", "$$NOW"]}, "$$NOW"]}, interval_ms]},
+                "updated_at": "$$NOW"
+            }}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        # The slot starts one interval before the new tat; burst-1 intervals of credit are allowed
+        slot = bucket["tat"] - timedelta(milliseconds=interval_ms * burst)
+        return max(0.0, (slot - bucket["now"]).total_seconds())
+    
+    def _reserve_local(self, instance_name: str, interval: float, burst: int) -> float:
+        now = time.monotonic()
+        tat = max(self._local_tat.get(instance_name, now), now) + interval
+        self._local_tat[instance_name] = tat
+        return max(0.0, tat - interval * burst - now)
+    
+    def stats(self) -> dict:
+        return {**self._counters, "backend": self.backend}
+
+send_rate_limiter = SendRateLimiter(SEND_RATE_LIMITER_BACKEND)
+
+async def wait_for_send_slot(instance: dict) -> Optional[datetime]:
+    """Reserve the instance's next send slot for a dashboard send.
+    
+    Waits for the slot and returns None when it comes up within
+    SEND_RATE_INLINE_WAIT_SECONDS, so the caller sends right away. A later slot is
+    returned instead, and the caller queues the message for it with
+    outbound_queue.enqueue(rate_slot_at=...), which sends on that slot without
+    reserving another.
+    """
+    wait = await send_rate_limiter.reserve(instance["evolution_instance_name"], instance.get("instance_type", "billing"))
+    if wait <= 0:
+        return None
+    if wait <= SEND_RATE_INLINE_WAIT_SECONDS:
+        await asyncio.sleep(wait)
+        return None
+    return datetime.now(timezone.utc) + timedelta(seconds=wait)
+
+class EvolutionReconciler:
+    """Periodically syncs instance status and phone_number in Mongo with Evolution.
+    
+    One worker (holding the "evolution_reconciler" lease) pulls fetchInstances once per
+    interval, diffs it against db.instances and applies changes with status-guarded
+    updates. Instances Evolution no longer lists are marked disconnected. instance.* webhooks fire only for updates that were actually written, so
+    a webhook that got there first is not announced twice. Other workers only track how fresh the
+    stored state is, so read endpoints can serve it without calling Evolution.
+    """
+    
+    LEASE_NAME = "evolution_reconciler"
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last_completed_at: Optional[datetime] = None
+        self.last_duration: Optional[float] = None
+        self.is_leader = False
+        self._counters = {"runs": 0, "errors": 0, "updates": 0, "transitions": 0}
+        self._task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        if self.interval <= 0 or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    @property
+    def lag(self) -> Optional[float]:
+        """Seconds since the stored state was last reconciled by any worker"""
+        if self.last_completed_at is None:
+            return None
+        return (datetime.now(timezone.utc) - self.last_completed_at).total_seconds()
+    
+    def is_fresh(self) -> bool:
+        """Whether stored instance status is recent enough to serve without calling Evolution"""
+        lag = self.lag
+        return lag is not None and lag <= self.interval * EVOLUTION_RECONCILE_STALE_AFTER
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._counters,
+            "interval": self.interval,
+            "is_leader": self.is_leader,
+            "lag_seconds": self.lag,
+            "last_duration_seconds": self.last_duration,
+            "last_completed_at": self.last_completed_at.isoformat() if self.last_completed_at else None
+        }
+    
+    async def _run(self):
+        while True:
+            try:
+                self.is_leader = await acquire_lease(self.LEASE_NAME, self.interval * 3)
+                if self.is_leader:
+                    await self.reconcile_once()
+                else:
+                    lease = await db.leases.find_one({"_id": self.LEASE_NAME}, {"last_completed_at": 1})
+                    if lease and lease.get("last_completed_at"):
+                        self.last_completed_at = lease["last_completed_at"].replace(tzinfo=timezone.utc)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.error(f"Evolution reconciler run failed: {e}")
+            await asyncio.sleep(self.interval)
+    
+    async def reconcile_once(self):
+        """Pull fetchInstances once and apply any differences to db.instances"""
+        started = time.monotonic()
+        # Strict, so an Evolution error is not mistaken for every instance being gone
+        index = index_evolution_instances(await evolution_client.fetch_instances(strict=True))
+        
+        updates = []
+        now = datetime.now(timezone.utc).isoformat()
+        
+        cursor = db.instances.find(
+            {},
+            {"_id": 0, "id": 1, "evolution_instance_name": 1, "status": 1, "phone_number": 1}
+        )
+        async for inst in cursor:
+            entry = index.get(inst["evolution_instance_name"])
+            if entry is None:
+                # Deleted or lost on the Evolution side; it cannot be connected
+                connection_state_cache.set(inst["evolution_instance_name"], "close")
+                status = "disconnected"
+            elif not entry.get("state"):
+                continue
+            else:
+                connection_state_cache.set(inst["evolution_instance_name"], entry["state"])
+                status = map_evolution_state_to_status(entry["state"])
+            
+            phone_number = inst.get("phone_number")
+            if status == "connected" and entry.get("phone_number"):
+                phone_number = entry["phone_number"]
+            
+            if status == inst.get("status") and phone_number == inst.get("phone_number"):
+                continue
+            
+            updates.append((inst, status, phone_number))
+        
+        semaphore = asyncio.Semaphore(EVOLUTION_FANOUT_CONCURRENCY)
+        
+        async def apply(inst: dict, status: str, phone_number: Optional[str]) -> bool:
+            # Guard on the old status so a concurrent webhook update is not overwritten
+            async with semaphore:
+                result = await db.instances.update_one(
+                    {"id": inst["id"], "status": inst.get("status")},
+                    {"$set": {"status": status, "phone_number": phone_number, "updated_at": now}}
+                )
+            return result.modified_count > 0
+        
+        applied = await asyncio.gather(*(apply(*update) for update in updates))
+        
+        # Only announce transitions this run actually wrote; a webhook that moved the
+        # instance first has already fired its own event
+        transitions = [
+            (inst["id"], status)
+            for (inst, status, _), modified in zip(updates, applied)
+            if modified and status != inst.get("status")
+        ]
+        for instance_id, status in transitions:
+            spawn_background(trigger_webhooks(
+                instance_id,
+                f"instance.{status}",
+                {"instance_id": instance_id, "status": status}
+            ))
+        
+        self.last_completed_at = datetime.now(timezone.utc)
+        self.last_duration = time.monotonic() - started
+        self._counters["runs"] += 1
+        self._counters["updates"] += sum(applied)
+        self._counters["transitions"] += len(transitions)
+        await db.leases.update_one(
+            {"_id": self.LEASE_NAME, "holder": WORKER_ID},
+            {"$set": {"last_completed_at": self.last_completed_at}}
+        )
+
+evolution_reconciler = EvolutionReconciler(EVOLUTION_RECONCILE_INTERVAL_SECONDS)
+
+class OutboundQueue:
+    """Mongo-backed outbound message queue drained by an in-process worker pool.
+    
+    Jobs live in db.outbound_jobs and are claimed atomically with find_one_and_update,
+    so any number of uvicorn workers can drain the same queue. A claim holds a lock
+    until locked_until; a job whose worker died mid-send is picked up again after
+    that (delivery is at-least-once). Failed sends are retried with exponential
+    backoff until max attempts, then the job and its message are marked failed.
+    Sends are paced per instance by send_rate_limiter: a job whose slot is still in
+    the future goes back to queued until then rather than holding a worker.
+    """
+    
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._tasks: List[asyncio.Task] = []
+        self._counters = {"enqueued": 0, "sent": 0, "retried": 0, "failed": 0, "rate_deferred": 0}
+    
+    async def enqueue(self, instance: dict, message_doc: dict, kind: str, payload: dict,
+                      campaign_row: Optional[dict] = None, rate_slot_at: Optional[datetime] = None,
+                      job_id: Optional[str] = None) -> dict:
+        """Persist a queued message and its send job; returns the job.
+        
+        rate_slot_at is a send slot the caller already reserved; the job waits for it.
+        With a job_id (and a message id derived the same way) enqueue is idempotent:
+        repeating it returns the job already stored, or completes a half-done attempt.
+        """
+        job = self.build_job(instance, message_doc, kind, payload, campaign_row, rate_slot_at, job_id)
+        try:
+            await db.messages.insert_one({**message_doc, "status": "queued"})
+        except DuplicateKeyError:
+            if job_id is None:
+                raise
+            existing = await db.outbound_jobs.find_one({"id": job_id}, {"_id": 0})
+            if existing is not None:
+                return existing
+            # The message was stored by an attempt that died before its job
+        try:
+            await db.outbound_jobs.insert_one(job)
+        except DuplicateKeyError:
+            # Another attempt under the same job_id got there first
+            existing = await db.outbound_jobs.find_one({"id": job_id}, {"_id": 0}) if job_id else None
+            if existing is not None:
+                return existing
+            await db.messages.delete_one({"id": message_doc["id"], "status": "queued"})
+            raise
+        except BaseException:
+            # A message without a job would sit in "queued" forever
+            await db.messages.delete_one({"id": message_doc["id"], "status": "queued"})
+            raise
+        self._counters["enqueued"] += 1
+        self._wakeup.set()
+        return job
+    
+    async def enqueue_many(self, instance: dict, items: List[tuple]) -> List[Optional[str]]:
+        """Persist many (message_doc, kind, payload) sends with one insert_many per collection.
+        
+        Returns one entry per item: None when it was queued, otherwise the reason it was not.
+        """
+        errors: List[Optional[str]] = [None] * len(items)
+        messages = [{**message_doc, "status": "queued"} for message_doc, _, _ in items]
+        try:
+            await db.messages.insert_many(messages, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                errors[error["index"]] = error.get("errmsg", "Could not store message")
+        
+        stored = [index for index, error in enumerate(errors) if error is None]
+        try:
+            if stored:
+                await db.outbound_jobs.insert_many(
+                    [self.build_job(instance, *items[index]) for index in stored], ordered=False
+                )
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                errors[stored[error["index"]]] = error.get("errmsg", "Could not queue message")
+        except BaseException:
+            await db.messages.delete_many({"id": {"$in": [messages[index]["id"] for index in stored]}, "status": "queued"})
+            raise
+        
+        orphaned = [messages[index]["id"] for index in stored if errors[index]]
+        if orphaned:
+            await db.messages.delete_many({"id": {"$in": orphaned}, "status": "queued"})
+        queued = len(stored) - len(orphaned)
+        self._counters["enqueued"] += queued
+        if queued:
+            self._wakeup.set()
+        return errors
+    
+    def build_job(self, instance: dict, message_doc: dict, kind: str, payload: dict,
+                  campaign_row: Optional[dict] = None, rate_slot_at: Optional[datetime] = None,
+                  job_id: Optional[str] = None) -> dict:
+        now = datetime.now(timezone.utc)
+        job = {
+            "id": job_id or str(uuid.uuid4()),
+            "message_id": message_doc["id"],
+            "instance_id": instance["id"],
+            "user_id": instance.get("user_id"),
+            "evolution_instance_name": instance["evolution_instance_name"],
+            "instance_type": instance.get("instance_type", "billing"),
+            "kind": kind,  # text, buttons
+            "payload": payload,
+            "status": "queued",
+            "attempts": 0,
+            "max_attempts": OUTBOUND_MAX_ATTEMPTS,
+            "next_attempt_at": rate_slot_at or now,
+            "rate_slot_at": rate_slot_at,  # send slot already reserved with send_rate_limiter
+            "locked_by": None,
+            "locked_until": None,
+            "last_error": None,
+            "created_at": now,
+            "updated_at": now
+        }
+        if campaign_row:
+            job["campaign_id"] = campaign_row["campaign_id"]
+            job["campaign_row_id"] = campaign_row["id"]
+        return job
+    
+    async def start(self):
+        if self.workers <= 0 or self._tasks:
+            return
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        """Let in-flight sends finish (up to the grace period), then cancel the workers"""
+        if not self._tasks:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        _, pending = await asyncio.wait(self._tasks, timeout=OUTBOUND_SHUTDOWN_GRACE_SECONDS)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._tasks = []
+    
+    async def depth(self) -> int:
+        return await db.outbound_jobs.count_documents({"status": {"$in": ["queued", "processing"]}})
+    
+    def stats(self) -> Dict[str, Any]:
+        return {**self._counters, "workers": len(self._tasks)}
+    
+    async def claim(self) -> Optional[dict]:
+        """Atomically take the next due job (or one whose lock has expired)"""
+        now = datetime.now(timezone.utc)
+        return await db.outbound_jobs.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "next_attempt_at": {"$lte": now}},
+                {"status": "processing", "locked_until": {"$lte": now}}
+            ]},
+            {
+                "$set": {
+                    "status": "processing",
+                    "locked_by": WORKER_ID,
+                    "locked_until": now + timedelta(seconds=OUTBOUND_LOCK_SECONDS),
+                    "updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("next_attempt_at", ASCENDING)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def _worker(self):
+        while not self._stopping:
+            try:
+                job = await self.claim()
+                if job is None:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOUND_POLL_INTERVAL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self.process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbound worker error: {e}")
+                await asyncio.sleep(OUTBOUND_POLL_INTERVAL_SECONDS)
+    
+    async def defer_for_rate_limit(self, job: dict) -> bool:
+        """Reserve the job's send slot; if it is in the future, park the job until then"""
+        now = datetime.now(timezone.utc)
+        if job.get("rate_slot_at") and as_utc(job["rate_slot_at"]) <= now:
+            return False  # the slot reserved when the job was parked has come up
+        
+        wait = await send_rate_limiter.reserve(job["evolution_instance_name"], job.get("instance_type", "billing"))
+        if wait <= 0:
+            return False
+        slot = now + timedelta(seconds=wait)
+        # Waiting for a slot is not a send attempt, so hand back the one claim() counted
+        await db.outbound_jobs.update_one(
+            {"id": job["id"], "locked_by": WORKER_ID},
+            {
+                "$set": {"status": "queued", "next_attempt_at": slot, "rate_slot_at": slot, "locked_until": None, "updated_at": now},
+                "$inc": {"attempts": -1}
+            }
+        )
+        self._counters["rate_deferred"] += 1
+        return True
+    
+    async def process(self, job: dict):
+        payload = job["payload"]
+        instance_name = job["evolution_instance_name"]
+        if await self.defer_for_rate_limit(job):
+            return
+        try:
+            if job["kind"] == "buttons":
+                await evolution_client.send_button_message(
+                    instance_name,
+                    payload["phone_number"],
+                    payload["title"],
+                    payload["description"],
+                    payload["footer"],
+                    payload["buttons"]
+                )
+            else:
+                await evolution_client.send_text_message(instance_name, payload["phone_number"], payload["message"])
+        except Exception as e:
+            connection_state_cache.pop(instance_name)
+            await self._handle_failure(job, e)
+            return
+        
+        now = datetime.now(timezone.utc)
+        await db.outbound_jobs.update_one(
+            {"id": job["id"], "locked_by": WORKER_ID},
+            {"$set": {"status": "sent", "locked_until": None, "last_error": None, "updated_at": now}}
+        )
+        await db.messages.update_one(
+            {"id": job["message_id"]},
+            {"$set": {"status": "sent", "sent_at": now.isoformat()}}
+        )
+        self._counters["sent"] += 1
+        if job.get("campaign_id"):
+            await campaign_runner.record_result(job, "sent")
+        spawn_background(trigger_webhooks(
+            job["instance_id"],
+            "message.sent",
+            {"message_id": job["message_id"], "to": payload["phone_number"]}
+        ))
+    
+    async def _handle_failure(self, job: dict, error: Exception):
+        now = datetime.now(timezone.utc)
+        # Evolution rejecting the request itself (bad number, bad payload) will not succeed on retry
+        permanent = isinstance(error, HTTPException) and 400 <= error.status_code < 500 and error.status_code != 429
+        
+        if permanent or job["attempts"] >= job["max_attempts"]:
+            logger.error(f"Outbound message {job['message_id']} failed after {job['attempts']} attempt(s): {error}")
+            await db.outbound_jobs.update_one(
+                {"id": job["id"], "locked_by": WORKER_ID},
+                {"$set": {"status": "failed", "locked_until": None, "last_error": str(error), "updated_at": now}}
+            )
+            await db.messages.update_one(
+                {"id": job["message_id"]},
+                {"$set": {"status": "failed", "error": str(error)}}
+            )
+            self._counters["failed"] += 1
+            if job.get("campaign_id"):
+                await campaign_runner.record_result(job, "failed", str(error))
+            spawn_background(trigger_webhooks(
+                job["instance_id"],
+                "message.failed",
+                {"message_id": job["message_id"], "to": job["payload"]["phone_number"], "error": str(error)}
+            ))
+            return
+        
+        delay = min(OUTBOUND_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1), OUTBOUND_RETRY_MAX_SECONDS)
+        delay *= random.uniform(0.8, 1.2)
+        logger.warning(f"Outbound message {job['message_id']} attempt {job['attempts']} failed, retrying in {delay:.1f}s: {error}")
+        await db.outbound_jobs.update_one(
+            {"id": job["id"], "locked_by": WORKER_ID},
+            {"$set": {
+                "status": "queued",
+                "next_attempt_at": now + timedelta(seconds=delay),
+                "rate_slot_at": None,
+                "locked_until": None,
+                "last_error": str(error),
+                "updated_at": now
+            }}
+        )
+        self._counters["retried"] += 1
+
+outbound_queue = OutboundQueue(OUTBOUND_WORKERS)
+
+class WebhookDeliveryEngine:
+    """Delivers subscriber webhooks concurrently over a shared, pooled HTTP client.
+    
+    Each target is retried with exponential backoff and full jitter. A per-URL circuit
+    breaker stops dead endpoints from tying up connections: after the cooldown it is
+    half-open and lets exactly one delivery through as a probe, which closes it on
+    success or reopens it on failure. Anything that cannot be delivered is written
+    to db.webhook_deliveries. last_triggered updates are
+    coalesced and flushed periodically with one bulk_write.
+    """
+    
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore = asyncio.Semaphore(WEBHOOK_MAX_CONCURRENCY)
+        self._breakers: Dict[str, Dict[str, float]] = {}
+        self._last_triggered: Dict[str, str] = {}
+        self._counters = {"delivered": 0, "attempts_failed": 0, "dead_lettered": 0, "short_circuited": 0}
+        self._task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=WEBHOOK_MAX_CONCURRENCY,
+                    max_keepalive_connections=WEBHOOK_MAX_KEEPALIVE
+                ),
+                timeout=WEBHOOK_TIMEOUT_SECONDS
+            )
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def post(self, url: str, payload: dict) -> httpx.Response:
+        """Single POST on the shared client, with no retries"""
+        if self._client is None:
+            await self.start()
+        async with self._semaphore:
+            return await self._client.post(url, json=payload)
+    
+    async def dispatch(self, instance_id: str, event: str, data: dict, webhooks: List[dict]):
+        """Deliver one event to every subscriber at once"""
+        payload = {"event": event, "data": data}
+        await asyncio.gather(*(self.deliver(instance_id, webhook, payload) for webhook in webhooks))
+    
+    async def deliver(self, instance_id: str, webhook: dict, payload: dict) -> bool:
+        url = webhook["url"]
+        admitted = self._admit(url)
+        if admitted is None:
+            self._counters["short_circuited"] += 1
+            await self._dead_letter(instance_id, webhook, payload, "circuit open", 0)
+            return False
+        try:
+            return await self._attempt(instance_id, webhook, payload, probe=admitted)
+        finally:
+            if admitted and url in self._breakers:
+                self._breakers[url]["probing"] = False
+    
+    async def _attempt(self, instance_id: str, webhook: dict, payload: dict, probe: bool) -> bool:
+        url = webhook["url"]
+        error = None
+        attempt = 0
+        for attempt in range(1, WEBHOOK_MAX_ATTEMPTS + 1):
+            if attempt > 1 and not probe and self._is_tripped(url):
+                # Another delivery opened the breaker while this one was backing off
+                error = "circuit open"
+                attempt -= 1
+                break
+            try:
+                response = await self.post(url, payload)
+                if response.is_success:
+                    self._record_success(url)
+                    self._last_triggered[webhook["id"]] = datetime.now(timezone.utc).isoformat()
+                    self._counters["delivered"] += 1
+                    return True
+                error = f"HTTP {response.status_code}"
+                retryable = response.status_code >= 500 or response.status_code in (408, 429)
+            except httpx.HTTPError as e:
+                error = str(e) or e.__class__.__name__
+                retryable = True
+            
+            self._counters["attempts_failed"] += 1
+            if self._record_failure(url) or not retryable or attempt == WEBHOOK_MAX_ATTEMPTS:
+                break
+            backoff = min(WEBHOOK_RETRY_BASE_SECONDS * 2 ** (attempt - 1), WEBHOOK_RETRY_MAX_SECONDS)
+            await asyncio.sleep(random.uniform(0, backoff))
+        
+        logger.error(f"Webhook delivery to {url} failed after {attempt} attempt(s): {error}")
+        await self._dead_letter(instance_id, webhook, payload, error, attempt)
+        return False
+    
+    def _admit(self, url: str) -> Optional[bool]:
+        """None to short-circuit a delivery, True if it is the half-open probe, False otherwise"""
+        breaker = self._breakers.get(url)
+        if not breaker or breaker["failures"] < WEBHOOK_BREAKER_THRESHOLD:
+            return False  # closed
+        if breaker["open_until"] > time.monotonic() or breaker["probing"]:
+            return None
+        breaker["probing"] = True
+        return True
+    
+    def _is_tripped(self, url: str) -> bool:
+        """Open or half-open"""
+        breaker = self._breakers.get(url)
+        return bool(breaker) and breaker["failures"] >= WEBHOOK_BREAKER_THRESHOLD
+    
+    def _is_open(self, url: str) -> bool:
+        breaker = self._breakers.get(url)
+        return bool(breaker) and breaker["open_until"] > time.monotonic()
+    
+    def _record_success(self, url: str):
+        self._breakers.pop(url, None)
+    
+    def _record_failure(self, url: str) -> bool:
+        """Count a failed attempt; returns True when this opens the breaker"""
+        breaker = self._breakers.setdefault(url, {"failures": 0, "open_until": 0.0, "probing": False})
+        breaker["failures"] += 1
+        if breaker["failures"] >= WEBHOOK_BREAKER_THRESHOLD:
+            breaker["open_until"] = time.monotonic() + WEBHOOK_BREAKER_COOLDOWN_SECONDS
+            return True
+        return False
+    
+    async def _dead_letter(self, instance_id: str, webhook: dict, payload: dict, error: str, attempts: int):
+        self._counters["dead_lettered"] += 1
+        try:
+            await db.webhook_deliveries.insert_one({
+                "id": str(uuid.uuid4()),
+                "webhook_id": webhook["id"],
+                "instance_id": instance_id,
+                "url": webhook["url"],
+                "event": payload["event"],
+                "payload": payload,
+                "error": error,
+                "attempts": attempts,
+                "status": "dead",
+                "created_at": datetime.now(timezone.utc).isoformat()
+            })
+        except Exception as e:
+            logger.error(f"Could not dead-letter webhook delivery: {e}")
+    
+    async def flush(self):
+        """Persist coalesced last_triggered timestamps"""
+        pending, self._last_triggered = self._last_triggered, {}
+        if not pending:
+            return
+        updates = [
+            UpdateOne({"id": webhook_id}, {"$max": {"last_triggered": triggered_at}})
+            for webhook_id, triggered_at in pending.items()
+        ]
+        try:
+            await db.webhooks.bulk_write(updates, ordered=False)
+        except Exception as e:
+            logger.error(f"Could not flush webhook last_triggered: {e}")
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(WEBHOOK_LAST_TRIGGERED_FLUSH_SECONDS)
+            await self.flush()
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._counters,
+            "open_circuits": sum(1 for url in self._breakers if self._is_open(url)),
+            "pending_last_triggered": len(self._last_triggered)
+        }
+
+webhook_engine = WebhookDeliveryEngine()
+
+class EvolutionEventPipeline:
+    """Bounded queue between the Evolution webhook receiver and a pool of consumers.
+    
+    The receiver only validates and enqueues, so Evolution gets its 200 immediately.
+    Events are sharded by instance name onto one queue per consumer, which keeps
+    each instance's events in arrival order while different instances are processed
+    in parallel. When the queue is full, events either spill to db.inbound_events
+    (INBOUND_SPILL_TO_MONGO) or the receiver waits briefly and then rejects with 503
+    so Evolution backs off and retries.
+    """
+    
+    def __init__(self, consumers: int, max_size: int):
+        self.consumers = consumers
+        self.max_size = max_size
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._drainer: Optional[asyncio.Task] = None
+        self._spill_wakeup = asyncio.Event()
+        self._spill_seq = 0
+        # Instances with events waiting in Mongo; their new events spill too so order holds
+        self._spilled_instances: Dict[str, int] = {}
+        self._counters = {"accepted": 0, "processed": 0, "failed": 0, "spilled": 0, "dropped": 0}
+        self.last_lag: Optional[float] = None
+        self.max_lag = 0.0
+    
+    async def start(self):
+        if self.consumers <= 0 or self._tasks:
+            return
+        shard_size = max(1, self.max_size // self.consumers)
+        self._queues = [asyncio.Queue(maxsize=shard_size) for _ in range(self.consumers)]
+        self._tasks = [asyncio.create_task(self._consume(queue)) for queue in self._queues]
+        if INBOUND_SPILL_TO_MONGO:
+            self._drainer = asyncio.create_task(self._drain_spilled())
+    
+    async def stop(self):
+        """Finish queued events within the grace period; spill (or drop) whatever is left"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues)),
+                timeout=INBOUND_SHUTDOWN_GRACE_SECONDS
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Evolution event queue not drained before shutdown")
+        
+        tasks = self._tasks + ([self._drainer] if self._drainer else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        for queue in self._queues:
+            while not queue.empty():
+                _, instance_name, payload = queue.get_nowait()
+                if INBOUND_SPILL_TO_MONGO:
+                    await self._spill(instance_name, payload)
+                else:
+                    self._counters["dropped"] += 1
+        self._tasks, self._queues, self._drainer = [], [], None
+    
+    def _queue_for(self, instance_name: str) -> asyncio.Queue:
+        return self._queues[zlib.crc32(instance_name.encode()) % len(self._queues)]
+    
+    async def submit(self, instance_name: str, payload: dict) -> str:
+        """Accept an event; returns "queued", "spilled", "processed" (inline) or "rejected" """
+        if not self._tasks:
+            # No consumers configured: process inline as before
+            await process_evolution_event(instance_name, payload)
+            return "processed"
+        
+        if instance_name in self._spilled_instances:
+            await self._spill(instance_name, payload)
+            return "spilled"
+        
+        queue = self._queue_for(instance_name)
+        item = (time.monotonic(), instance_name, payload)
+        try:
+            queue.put_nowait(item)
+        except asyncio.QueueFull:
+            if INBOUND_SPILL_TO_MONGO:
+                await self._spill(instance_name, payload)
+                return "spilled"
+            # Backpressure: hold the request briefly, then ask Evolution to retry
+            try:
+                await asyncio.wait_for(queue.put(item), timeout=INBOUND_ENQUEUE_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                self._counters["dropped"] += 1
+                return "rejected"
+        self._counters["accepted"] += 1
+        return "queued"
+    
+    async def _spill(self, instance_name: str, payload: dict):
+        self._spill_seq += 1
+        await db.inbound_events.insert_one({
+            "worker_id": WORKER_ID,
+            "seq": self._spill_seq,
+            "instance_name": instance_name,
+            "payload": payload,
+            "created_at": datetime.now(timezone.utc)
+        })
+        self._spilled_instances[instance_name] = self._spilled_instances.get(instance_name, 0) + 1
+        self._counters["spilled"] += 1
+        self._spill_wakeup.set()
+    
+    async def _consume(self, queue: asyncio.Queue):
+        while True:
+            enqueued_at, instance_name, payload = await queue.get()
+            self.last_lag = time.monotonic() - enqueued_at
+            self.max_lag = max(self.max_lag, self.last_lag)
+            try:
+                await process_evolution_event(instance_name, payload)
+                self._counters["processed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._counters["failed"] += 1
+                logger.error(f"Error processing Evolution webhook: {e}")
+            finally:
+                queue.task_done()
+    
+    async def _drain_spilled(self):
+        """Move spilled events back onto the queues, oldest first, as room frees up"""
+        while True:
+            try:
+                # Adopt events left behind by a worker that exited before draining them
+                orphaned_before = datetime.now(timezone.utc) - timedelta(seconds=INBOUND_SPILL_ORPHAN_SECONDS)
+                await db.inbound_events.update_many(
+                    {"worker_id": {"$ne": WORKER_ID}, "created_at": {"$lte": orphaned_before}},
+                    {"$set": {"worker_id": WORKER_ID, "claimed": False}}
+                )
+                while True:
+                    # Claim, queue, then delete, so a crash in between leaves the event in Mongo
+                    event = await db.inbound_events.find_one_and_update(
+                        {"worker_id": WORKER_ID, "claimed": {"$ne": True}},
+                        {"$set": {"claimed": True}},
+                        sort=[("created_at", ASCENDING), ("seq", ASCENDING)]
+                    )
+                    if event is None:
+                        break
+                    instance_name = event["instance_name"]
+                    await self._queue_for(instance_name).put((time.monotonic(), instance_name, event["payload"]))
+                    await db.inbound_events.delete_one({"_id": event["_id"]})
+                    self._counters["accepted"] += 1
+                    remaining = self._spilled_instances.get(instance_name, 0) - 1
+                    if remaining > 0:
+                        self._spilled_instances[instance_name] = remaining
+                    else:
+                        self._spilled_instances.pop(instance_name, None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Could not drain spilled Evolution events: {e}")
+            
+            self._spill_wakeup.clear()
+            try:
+                await asyncio.wait_for(self._spill_wakeup.wait(), timeout=INBOUND_SPILL_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._counters,
+            "consumers": len(self._tasks),
+            "depth": sum(queue.qsize() for queue in self._queues),
+            "max_size": self.max_size,
+            "spilled_pending": sum(self._spilled_instances.values()),
+            "last_lag_seconds": self.last_lag,
+            "max_lag_seconds": self.max_lag
+        }
+
+evolution_events = EvolutionEventPipeline(INBOUND_CONSUMERS, INBOUND_QUEUE_SIZE)
+
+class BotpressDispatcher:
+    """Forwards inbound messages to Botpress over shared keep-alive clients.
+    
+    There is one pooled client per webhook host and a global cap on in-flight
+    requests. Clients are kept in least-recently-used order; ones idle for
+    BOTPRESS_CLIENT_IDLE_SECONDS or beyond BOTPRESS_MAX_HOSTS are closed once no
+    request is using them. Messages are queued per conversation and sent one at a
+    time, so a customer's messages reach Botpress in order while other
+    conversations proceed in parallel; a conversation's queue is dropped once it
+    drains.
+    """
+    
+    def __init__(self):
+        self._clients: "OrderedDict[str, httpx.AsyncClient]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._in_use: Dict[str, int] = {}
+        self._semaphore = asyncio.Semaphore(BOTPRESS_MAX_CONCURRENCY)
+        self._conversations: Dict[str, deque] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._instance_stats: Dict[str, Dict[str, float]] = {}
+        self._counters = {"clients_opened": 0, "clients_evicted": 0, "drain_errors": 0}
+    
+    def _client_for(self, host: str) -> httpx.AsyncClient:
+        self._last_used[host] = time.monotonic()
+        client = self._clients.get(host)
+        if client is not None:
+            self._clients.move_to_end(host)
+        else:
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=BOTPRESS_MAX_CONNECTIONS_PER_HOST,
+                    max_keepalive_connections=BOTPRESS_MAX_KEEPALIVE_PER_HOST
+                ),
+                timeout=BOTPRESS_TIMEOUT_SECONDS
+            )
+            self._clients[host] = client
+            self._counters["clients_opened"] += 1
+        return client
+    
+    async def _evict_clients(self):
+        """Close idle clients and, past BOTPRESS_MAX_HOSTS, the least recently used ones"""
+        now = time.monotonic()
+        for host in list(self._clients):
+            if len(self._clients) <= BOTPRESS_MAX_HOSTS and now - self._last_used[host] < BOTPRESS_CLIENT_IDLE_SECONDS:
+                break  # everything after this was used more recently
+            if self._in_use.get(host):
+                continue
+            client = self._clients.pop(host)
+            del self._last_used[host]
+            self._counters["clients_evicted"] += 1
+            await client.aclose()
+    
+    async def stop(self):
+        """Let queued conversations finish within the grace period, then close the pools"""
+        workers = list(self._workers.values())
+        if workers:
+            _, pending = await asyncio.wait(workers, timeout=BOTPRESS_SHUTDOWN_GRACE_SECONDS)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning(f"Dropped {sum(len(q) for q in self._conversations.values())} queued Botpress message(s) on shutdown")
+                await asyncio.gather(*pending, return_exceptions=True)
+        self._conversations.clear()
+        self._workers.clear()
+        clients = list(self._clients.values())
+        self._clients.clear()
+        self._last_used.clear()
+        for client in clients:
+            await client.aclose()
+    
+    async def post(self, instance_id: str, url: str, token: Optional[str], payload: dict,
+                   timeout: Optional[float] = None) -> httpx.Response:
+        """POST to a Botpress webhook, recording latency and failures for the instance"""
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}" if token else ""
+        }
+        stats = self._instance_stats.setdefault(
+            instance_id, {"sent": 0, "failed": 0, "total_latency": 0.0, "max_latency": 0.0}
+        )
+        kwargs = {"timeout": timeout} if timeout is not None else {}
+        parts = urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+        started = time.monotonic()
+        try:
+            async with self._semaphore:
+                client = self._client_for(host)
+                self._in_use[host] = self._in_use.get(host, 0) + 1
+                try:
+                    response = await client.post(url, json=payload, headers=headers, **kwargs)
+                finally:
+                    self._in_use[host] -= 1
+                    if not self._in_use[host]:
+                        del self._in_use[host]
+        except Exception:
+            stats["failed"] += 1
+            raise
+        finally:
+            latency = time.monotonic() - started
+            stats["total_latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+            await self._evict_clients()
+        if response.is_success:
+            stats["sent"] += 1
+        else:
+            stats["failed"] += 1
+        return response
+    
+    def enqueue(self, instance: dict, phone_number: str, message: str, message_id: str):
+        """Queue a message behind any earlier ones from the same conversation"""
+        conversation_id = f"{instance['id']}_{phone_number}"
+        self._conversations.setdefault(conversation_id, deque()).append((instance, phone_number, message, message_id))
+        if conversation_id not in self._workers:
+            self._workers[conversation_id] = asyncio.create_task(self._drain(conversation_id))
+    
+    async def _drain(self, conversation_id: str):
+        try:
+            queue = self._conversations[conversation_id]
+            while queue:
+                instance, phone_number, message, message_id = queue.popleft()
+                try:
+                    await forward_to_botpress(instance, phone_number, message, message_id)
+                except Exception as e:
+                    # Keep going so one bad message does not drop the rest of the conversation
+                    self._counters["drain_errors"] += 1
+                    logger.error(f"Could not forward message {message_id} to Botpress: {e}")
+        finally:
+            self._conversations.pop(conversation_id, None)
+            self._workers.pop(conversation_id, None)
+    
+    def stats(self) -> dict:
+        instances = {}
+        for instance_id, stats in self._instance_stats.items():
+            calls = stats["sent"] + stats["failed"]
+            instances[instance_id] = {
+                "sent": stats["sent"],
+                "failed": stats["failed"],
+                "avg_latency_seconds": stats["total_latency"] / calls if calls else None,
+                "max_latency_seconds": stats["max_latency"]
+            }
+        return {
+            **self._counters,
+            "hosts": len(self._clients),
+            "active_conversations": len(self._workers),
+            "queued": sum(len(queue) for queue in self._conversations.values()),
+            "instances": instances
+        }
+
+botpress_dispatcher = BotpressDispatcher()
+
+class AuditLogger:
+    """Write-behind buffer for db.logs.
+    
+    Entries go into a bounded in-memory ring and are written with insert_many once
+    AUDIT_LOG_FLUSH_BATCH are waiting or every AUDIT_LOG_FLUSH_SECONDS, so request
+    handlers do not wait on Mongo for activity logging. When the ring is full the
+    oldest entry is dropped and counted.
+    """
+    
+    def __init__(self, maxsize: int, flush_batch: int, flush_interval: float):
+        self._buffer: deque = deque(maxlen=maxsize)
+        self.flush_batch = flush_batch
+        self.flush_interval = flush_interval
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"buffered": 0, "written": 0, "durable": 0, "dropped": 0, "flushes": 0, "flush_errors": 0}
+        self.last_flush_latency: Optional[float] = None
+        self.max_flush_latency = 0.0
+    
+    def append(self, entry: dict):
+        if len(self._buffer) == self._buffer.maxlen:
+            self._counters["dropped"] += 1
+        self._buffer.append(entry)
+        self._counters["buffered"] += 1
+        if len(self._buffer) >= self.flush_batch:
+            self._wakeup.set()
+    
+    async def write(self, entry: dict):
+        """Insert immediately, bypassing the buffer"""
+        await db.logs.insert_one(entry)
+        self._counters["durable"] += 1
+    
+    async def flush(self):
+        async with self._lock:
+            while self._buffer:
+                batch = [self._buffer.popleft() for _ in range(min(self.flush_batch, len(self._buffer)))]
+                started = time.monotonic()
+                try:
+                    await db.logs.insert_many(batch, ordered=False)
+                except Exception as e:
+                    self._counters["flush_errors"] += 1
+                    logger.error(f"Could not flush activity log: {e}")
+                    # Put the batch back in front; the ring drops the oldest if it is full
+                    keep = batch[max(0, len(batch) - (self._buffer.maxlen - len(self._buffer))):]
+                    self._counters["dropped"] += len(batch) - len(keep)
+                    self._buffer.extendleft(reversed(keep))
+                    return
+                latency = time.monotonic() - started
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+                self._counters["flushes"] += 1
+                self._counters["written"] += len(batch)
+    
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+    
+    def stats(self) -> dict:
+        return {
+            **self._counters,
+            "pending": len(self._buffer),
+            "max_size": self._buffer.maxlen,
+            "last_flush_latency_seconds": self.last_flush_latency,
+            "max_flush_latency_seconds": self.max_flush_latency
+        }
+
+audit_logger = AuditLogger(AUDIT_LOG_BUFFER_SIZE, AUDIT_LOG_FLUSH_BATCH, AUDIT_LOG_FLUSH_SECONDS)
+
+class EventBroker:
+    """Pub/sub fanning instance events out to a user's open SSE streams on every worker.
+    
+    publish() appends events to the capped db.event_stream collection, numbered from
+    a shared counter. Every worker tails it with a tailable cursor and hands each
+    event to its own subscribers, so a stream gets the event whichever worker
+    processed it. If the stream cannot be written (or SSE_SHARED_STREAM is off),
+    events only reach streams on this worker. Each subscriber has a bounded queue;
+    a slow client loses its oldest pending event rather than blocking delivery.
+    
+    Numbers are handed out before the insert, so a worker can insert seq 5 after
+    another inserted seq 6. The tail remembers the numbers it skipped for
+    REORDER_SECONDS and asks for them again when it reopens its cursor.
+    """
+    
+    REORDER_SECONDS = 30
+    MAX_MISSING = 1000
+    
+    def __init__(self, queue_size: int, shared: bool):
+        self.queue_size = queue_size
+        self.shared = shared
+        self._last_seq = 0
+        # Skipped seq -> when it was first missed; it may still be inserted late
+        self._missing: Dict[int, float] = {}
+        self._subscribers: Dict[str, set] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"published": 0, "delivered": 0, "dropped": 0, "tailed": 0, "publish_errors": 0, "tail_errors": 0}
+    
+    async def start(self):
+        if not self.shared or self._task is not None:
+            return
+        try:
+            await db.create_collection("event_stream", capped=True, size=SSE_STREAM_SIZE_BYTES)
+        except CollectionInvalid:
+            pass  # already there
+        except Exception as e:
+            logger.error(f"Could not create the event stream collection: {e}")
+        self._task = asyncio.create_task(self._tail(await self._current_seq()))
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+    
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+    
+    async def publish(self, user_id: str, event: str, data: dict):
+        await self.publish_many(user_id, [(event, data)])
+    
+    async def publish_many(self, user_id: str, events: List[tuple]):
+        """Publish (event, data) pairs for one user in order"""
+        if not events:
+            return
+        self._counters["published"] += len(events)
+        if self._task is not None:
+            try:
+                counter = await db.counters.find_one_and_update(
+                    {"_id": "event_stream"},
+                    {"$inc": {"seq": len(events)}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                first_seq = counter["seq"] - len(events) + 1
+                await db.event_stream.insert_many([
+                    {"seq": first_seq + offset, "user_id": user_id, "event": event, "data": data}
+                    for offset, (event, data) in enumerate(events)
+                ])
+                return
+            except Exception as e:
+                self._counters["publish_errors"] += 1
+                logger.error(f"Could not publish to the event stream, delivering locally: {e}")
+        for event, data in events:
+            self._deliver(user_id, event, data)
+    
+    async def _current_seq(self) -> int:
+        try:
+            counter = await db.counters.find_one({"_id": "event_stream"})
+        except Exception as e:
+            logger.error(f"Could not read the event stream position: {e}")
+            return 0
+        return counter["seq"] if counter else 0
+    
+    async def _tail(self, last_seq: int):
+        """Deliver every event published after last_seq to local subscribers"""
+        self._last_seq = last_seq
+        while True:
+            try:
+                cursor = db.event_stream.find(self._resume_filter(), cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for doc in cursor:
+                        if not self._accept(doc["seq"]):
+                            continue
+                        self._counters["tailed"] += 1
+                        self._deliver(doc["user_id"], doc["event"], doc["data"])
+                    await asyncio.sleep(0.1)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._counters["tail_errors"] += 1
+                logger.error(f"Event stream tail failed: {e}")
+            # The cursor dies on an empty collection or when it falls behind the cap; reopen
+            await asyncio.sleep(1)
+    
+    def _accept(self, seq: int) -> bool:
+        """Whether a tailed event has not been delivered yet; notes any numbers it skips past"""
+        if seq > self._last_seq:
+            now = time.monotonic()
+            for skipped in range(max(self._last_seq + 1, seq - self.MAX_MISSING), seq):
+                self._missing[skipped] = now
+            for oldest in list(self._missing)[:max(0, len(self._missing) - self.MAX_MISSING)]:
+                del self._missing[oldest]
+            self._last_seq = seq
+            return True
+        return self._missing.pop(seq, None) is not None
+    
+    def _resume_filter(self) -> dict:
+        """Events after the last one seen, plus skipped ones recent enough to still turn up"""
+        cutoff = time.monotonic() - self.REORDER_SECONDS
+        self._missing = {seq: missed_at for seq, missed_at in self._missing.items() if missed_at > cutoff}
+        newer = {"seq": {"$gt": self._last_seq}}
+        if not self._missing:
+            return newer
+        return {"$or": [newer, {"seq": {"$in": sorted(self._missing)}}]}
+    
+    def _deliver(self, user_id: str, event: str, data: dict):
+        for queue in self._subscribers.get(user_id, ()):
+            self._put(queue, (event, data))
+    
+    def _put(self, queue: asyncio.Queue, item):
+        if queue.full():
+            queue.get_nowait()
+            self._counters["dropped"] += 1
+        queue.put_nowait(item)
+        self._counters["delivered"] += 1
+    
+    def close(self):
+        """End every open stream (None tells the stream to finish)"""
+        for queues in self._subscribers.values():
+            for queue in queues:
+                self._put(queue, None)
+    
+    def stats(self) -> dict:
+        return {
+            **self._counters,
+            "shared": self._task is not None,
+            "users": len(self._subscribers),
+            "streams": sum(len(queues) for queues in self._subscribers.values())
+        }
+
+event_broker = EventBroker(SSE_SUBSCRIBER_QUEUE_SIZE, SSE_SHARED_STREAM)
+
+class CampaignRunner:
+    """Feeds running billing campaigns into the outbound queue at a throttled rate.
+    
+    Rows wait in db.campaign_rows until the worker holding the "campaign_runner"
+    lease picks them up in seq order, CAMPAIGN_SEND_RATE_PER_SECOND per campaign and
+    never more than CAMPAIGN_MAX_IN_FLIGHT unfinished sends at a time. The outbound
+    workers report each send back through record_result, which keeps the row and the
+    campaign counters in db.campaigns up to date.
+    
+    A claimed row holds claim_expires_at until its send job exists. The leader hands
+    back rows whose claim expired without a job (the claiming leader died), and fails
+    imports that stopped making progress because their worker died.
+    """
+    
+    LEASE_NAME = "campaign_runner"
+    
+    def __init__(self):
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"ticks": 0, "rows_queued": 0, "rows_reclaimed": 0, "imports_failed": 0, "errors": 0}
+    
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            try:
+                self.is_leader = await acquire_lease(self.LEASE_NAME, CAMPAIGN_LEASE_SECONDS)
+                if self.is_leader:
+                    await self.recover()
+                    async for campaign in db.campaigns.find({"status": "running"}, {"_id": 0}):
+                        await self.tick(campaign)
+                    self._counters["ticks"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.error(f"Campaign runner error: {e}")
+            await asyncio.sleep(CAMPAIGN_POLL_SECONDS)
+    
+    async def tick(self, campaign: dict):
+        """Queue the next slice of one campaign's rows, or mark it completed"""
+        in_flight = campaign["queued"] - campaign["sent"] - campaign["failed"]
+        budget = min(
+            max(1, int(CAMPAIGN_SEND_RATE_PER_SECOND * CAMPAIGN_POLL_SECONDS)),
+            CAMPAIGN_MAX_IN_FLIGHT - in_flight
+        )
+        if budget <= 0:
+            return
+        
+        rows = await db.campaign_rows.find(
+            {"campaign_id": campaign["id"], "status": "pending"}, {"_id": 0}
+        ).sort("seq", ASCENDING).limit(budget).to_list(budget)
+        if not rows:
+            # Rows still queued are either sending or claimed by a leader that may have died
+            unfinished = await db.campaign_rows.find_one(
+                {"campaign_id": campaign["id"], "status": {"$in": ["pending", "queued"]}}, {"_id": 1}
+            )
+            if unfinished is None:
+                await db.campaigns.update_one(
+                    {"id": campaign["id"], "status": "running"},
+                    {"$set": {"status": "completed", "completed_at": datetime.now(timezone.utc).isoformat()}}
+                )
+            return
+        
+        instance = await db.instances.find_one({"id": campaign["instance_id"]}, {"_id": 0})
+        if not instance or not instance.get("evolution_instance_name"):
+            await db.campaigns.update_one(
+                {"id": campaign["id"]},
+                {"$set": {"status": "failed", "error": "Instance no longer exists"}}
+            )
+            return
+        # Hold rows back while the instance is offline instead of burning their retries
+        if await get_cached_connection_state(instance["evolution_instance_name"]) != "open":
+            return
+        
+        queued = 0
+        withdrawn = 0
+        try:
+            for row in rows:
+                message_id = str(uuid.uuid4())
+                now = datetime.now(timezone.utc)
+                # Claim the row before enqueueing it. A leader that crashes or loses its lease
+                # after this point leaves the row "queued" until recover() hands it back.
+                claim = await db.campaign_rows.update_one(
+                    {"id": row["id"], "status": "pending"},
+                    {"$set": {
+                        "status": "queued",
+                        "message_id": message_id,
+                        "claim_expires_at": now + timedelta(seconds=CAMPAIGN_CLAIM_SECONDS),
+                        "updated_at": now.isoformat()
+                    }}
+                )
+                if claim.modified_count == 0:
+                    continue  # cancelled, or taken by another leader
+                
+                try:
+                    billing_data = BillingNotificationSend(**{field: row.get(field) for field in CAMPAIGN_ROW_FIELDS if row.get(field) is not None})
+                    template, message_doc = await build_billing_message(
+                        campaign["user_id"], instance, billing_data, message_id, "queued", datetime.now(timezone.utc).isoformat()
+                    )
+                    message_doc["campaign_id"] = campaign["id"]
+                    job = await outbound_queue.enqueue(instance, message_doc, "buttons", {
+                        "phone_number": billing_data.phone_number,
+                        "title": template["title"],
+                        "description": template["description"],
+                        "footer": template["footer"],
+                        "buttons": template["buttons"]
+                    }, campaign_row=row)
+                except BaseException:
+                    # Nothing was queued; hand the row back for the next tick
+                    await db.campaign_rows.update_one(
+                        {"id": row["id"], "status": "queued", "message_id": message_id},
+                        {"$set": {"status": "pending", "message_id": None}, "$unset": {"claim_expires_at": ""}}
+                    )
+                    raise
+                # The job exists now, so the claim no longer needs to expire
+                await db.campaign_rows.update_one(
+                    {"id": row["id"], "message_id": message_id}, {"$unset": {"claim_expires_at": ""}}
+                )
+                if await self.withdraw_if_cancelled(campaign["id"], job):
+                    withdrawn += 1
+                    continue
+                queued += 1
+        finally:
+            if queued or withdrawn:
+                await db.campaigns.update_one(
+                    {"id": campaign["id"]},
+                    {"$inc": {"queued": queued, "cancelled": withdrawn}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+                )
+                self._counters["rows_queued"] += queued
+    
+    async def withdraw_if_cancelled(self, campaign_id: str, job: dict) -> bool:
+        """Cancel a job just queued for a campaign that was cancelled meanwhile.
+        
+        The cancel endpoint sets the status before it sweeps queued jobs, and this reads
+        the status after the job was inserted, so one of the two always sees the job.
+        """
+        campaign = await db.campaigns.find_one({"id": campaign_id}, {"_id": 0, "status": 1})
+        if not campaign or campaign["status"] != "cancelled":
+            return False
+        now = datetime.now(timezone.utc)
+        result = await db.outbound_jobs.update_one(
+            {"id": job["id"], "status": "queued"},
+            {"$set": {"status": "cancelled", "updated_at": now}}
+        )
+        if result.modified_count == 0:
+            return False  # the cancel sweep or a worker got to it first
+        await db.messages.update_one({"id": job["message_id"]}, {"$set": {"status": "cancelled"}})
+        await db.campaign_rows.update_one(
+            {"id": job["campaign_row_id"]},
+            {"$set": {"status": "cancelled", "updated_at": now.isoformat()}}
+        )
+        return True
+    
+    async def recover(self):
+        """Hand back rows whose claim expired without a send job and fail abandoned imports"""
+        now = datetime.now(timezone.utc)
+        stale_rows = await db.campaign_rows.find(
+            {"status": "queued", "claim_expires_at": {"$lte": now}}, {"_id": 0}
+        ).to_list(1000)
+        for row in stale_rows:
+            job = await db.outbound_jobs.find_one({"campaign_row_id": row["id"]}, {"_id": 0})
+            if job is not None:
+                # Queued after all; the claim was just never cleared. The outbound worker reports its result
+                await db.campaign_rows.update_one(
+                    {"id": row["id"], "message_id": row["message_id"]}, {"$unset": {"claim_expires_at": ""}}
+                )
+                continue
+            
+            # The message may have been stored before the leader died
+            await db.messages.delete_one({"id": row["message_id"], "status": "queued"})
+            campaign = await db.campaigns.find_one({"id": row["campaign_id"]}, {"_id": 0, "status": 1})
+            status = "cancelled" if campaign and campaign["status"] == "cancelled" else "pending"
+            result = await db.campaign_rows.update_one(
+                {"id": row["id"], "status": "queued", "message_id": row["message_id"]},
+                {"$set": {"status": status, "message_id": None, "updated_at": now.isoformat()},
+                 "$unset": {"claim_expires_at": ""}}
+            )
+            if result.modified_count and status == "cancelled":
+                await db.campaigns.update_one({"id": row["campaign_id"]}, {"$inc": {"cancelled": 1}})
+            self._counters["rows_reclaimed"] += result.modified_count
+        
+        stale_before = (now - timedelta(seconds=CAMPAIGN_IMPORT_STALE_SECONDS)).isoformat()
+        result = await db.campaigns.update_many(
+            {"status": "importing", "updated_at": {"$lt": stale_before}},
+            {"$set": {"status": "failed", "error": "Import was interrupted", "updated_at": now.isoformat()}}
+        )
+        if result.modified_count:
+            logger.warning(f"Failed {result.modified_count} campaign import(s) that stopped making progress")
+            self._counters["imports_failed"] += result.modified_count
+    
+    async def record_result(self, job: dict, result: str, error: Optional[str] = None):
+        """Called by the outbound workers once a campaign send has succeeded or finally failed"""
+        now = datetime.now(timezone.utc).isoformat()
+        await db.campaign_rows.update_one(
+            {"id": job["campaign_row_id"]},
+            {"$set": {"status": result, "error": error, "updated_at": now}}
+        )
+        await db.campaigns.update_one(
+            {"id": job["campaign_id"]},
+            {"$inc": {result: 1}, "$set": {"updated_at": now}}
+        )
+    
+    def stats(self) -> dict:
+        return {**self._counters, "is_leader": self.is_leader}
+
+campaign_runner = CampaignRunner()
+
+class MessageScheduler:
+    """Sends scheduled messages from db.scheduled_messages when they fall due.
+    
+    Only the next window of due jobs (SCHEDULER_WINDOW_SECONDS, at most
+    SCHEDULER_WINDOW_SIZE) is loaded, through the (status, due_at) index, into a
+    heap; the loop sleeps until the earliest one is due, the window ends, or a
+    newly scheduled job lands inside the window. Every worker keeps the same window
+    and a job is claimed with find_one_and_update before it is handed to the
+    outbound queue, so it is sent once however many workers see it. The outbound
+    job and message ids are derived from the scheduled id, so a claim that expired
+    after the handoff (the worker died before recording it) is re-fired without a
+    second send.
+    """
+    
+    def __init__(self, window_seconds: float, window_size: int):
+        self.window_seconds = window_seconds
+        self.window_size = window_size
+        self._heap: List[tuple] = []
+        self._pending_ids: set = set()
+        self._window_end: Optional[datetime] = None
+        self._reload = True
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"scheduled": 0, "dispatched": 0, "lost_claims": 0, "failed": 0, "reloads": 0}
+    
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def schedule(self, doc: dict):
+        await db.scheduled_messages.insert_one(doc)
+        self._counters["scheduled"] += 1
+        if self.in_window(doc["due_at"]):
+            self._push(doc["id"], doc["due_at"])
+            self._wakeup.set()
+            # Other workers load it into their window too
+            await cache_invalidator.bump("scheduled_messages")
+    
+    def request_reload(self):
+        self._reload = True
+        self._wakeup.set()
+    
+    def in_window(self, due_at: datetime) -> bool:
+        return self._window_end is not None and due_at <= self._window_end
+    
+    def _push(self, job_id: str, due_at: datetime):
+        if job_id not in self._pending_ids:
+            self._pending_ids.add(job_id)
+            heapq.heappush(self._heap, (due_at, job_id))
+    
+    async def reload(self):
+        """Reload the window from Mongo and release claims left by dead workers"""
+        now = datetime.now(timezone.utc)
+        await db.scheduled_messages.update_many(
+            {"status": "claimed", "claimed_until": {"$lte": now}},
+            {"$set": {"status": "scheduled", "claimed_by": None}}
+        )
+        horizon = now + timedelta(seconds=self.window_seconds)
+        jobs = await db.scheduled_messages.find(
+            {"status": "scheduled", "due_at": {"$lte": horizon}},
+            {"_id": 0, "id": 1, "due_at": 1}
+        ).sort("due_at", ASCENDING).limit(self.window_size).to_list(self.window_size)
+        
+        self._heap, self._pending_ids = [], set()
+        for job in jobs:
+            self._push(job["id"], as_utc(job["due_at"]))
+        # A full window ends at its last job so nothing beyond it is skipped
+        self._window_end = as_utc(jobs[-1]["due_at"]) if len(jobs) >= self.window_size else horizon
+        self._reload = False
+        self._counters["reloads"] += 1
+    
+    async def _run(self):
+        while True:
+            try:
+                now = datetime.now(timezone.utc)
+                if self._reload or self._window_end is None or now >= self._window_end:
+                    await self.reload()
+                
+                while self._heap and self._heap[0][0] <= now:
+                    _, job_id = heapq.heappop(self._heap)
+                    self._pending_ids.discard(job_id)
+                    await self.fire(job_id)
+                
+                wake_at = min(self._heap[0][0], self._window_end) if self._heap else self._window_end
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(),
+                        timeout=max(0.0, (wake_at - datetime.now(timezone.utc)).total_seconds())
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Message scheduler error: {e}")
+                self._reload = True
+                await asyncio.sleep(1)
+    
+    async def fire(self, job_id: str):
+        """Claim a due job and hand it to the outbound queue"""
+        now = datetime.now(timezone.utc)
+        job = await db.scheduled_messages.find_one_and_update(
+            {"id": job_id, "status": "scheduled", "due_at": {"$lte": now}},
+            {"$set": {
+                "status": "claimed",
+                "claimed_by": WORKER_ID,
+                "claimed_until": now + timedelta(seconds=SCHEDULER_CLAIM_SECONDS)
+            }},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None:
+            # Another worker got it, or it was cancelled or rescheduled
+            self._counters["lost_claims"] += 1
+            return
+        
+        try:
+            message_id = await self.dispatch(job)
+        except Exception as e:
+            logger.error(f"Scheduled message {job_id} could not be queued: {e}")
+            await db.scheduled_messages.update_one(
+                {"id": job_id, "claimed_by": WORKER_ID},
+                {"$set": {"status": "failed", "error": str(e)}}
+            )
+            self._counters["failed"] += 1
+            return
+        
+        await db.scheduled_messages.update_one(
+            {"id": job_id, "claimed_by": WORKER_ID},
+            {"$set": {"status": "dispatched", "message_id": message_id, "dispatched_at": now}}
+        )
+        self._counters["dispatched"] += 1
+    
+    async def dispatch(self, job: dict) -> str:
+        instance = await db.instances.find_one({"id": job["instance_id"]}, {"_id": 0})
+        if not instance or not instance.get("evolution_instance_name"):
+            raise ValueError("Instance no longer exists")
+        
+        # Fixed per scheduled message, so firing it again finds the send already queued
+        message_id = str(uuid.uuid5(uuid.NAMESPACE_OID, job["id"]))
+        now = datetime.now(timezone.utc).isoformat()
+        if job["kind"] == "billing":
+            billing_data = BillingNotificationSend(**job["payload"])
+            template, message_doc = await build_billing_message(job["user_id"], instance, billing_data, message_id, "queued", now)
+            message_doc["scheduled_message_id"] = job["id"]
+            await outbound_queue.enqueue(instance, message_doc, "buttons", {
+                "phone_number": billing_data.phone_number,
+                "title": template["title"],
+                "description": template["description"],
+                "footer": template["footer"],
+                "buttons": template["buttons"]
+            }, job_id=job["id"])
+        else:
+            payload = job["payload"]
+            await outbound_queue.enqueue(instance, {
+                "id": message_id,
+                "instance_id": instance["id"],
+                "phone_number": payload["phone_number"],
+                "message": payload["message"],
+                "message_type": "text",
+                "direction": "outgoing",
+                "status": "queued",
+                "scheduled_message_id": job["id"],
+                "created_at": now
+            }, "text", {"phone_number": payload["phone_number"], "message": payload["message"]}, job_id=job["id"])
+        return message_id
+    
+    def stats(self) -> dict:
+        return {
+            **self._counters,
+            "window_jobs": len(self._heap),
+            "window_end": self._window_end.isoformat() if self._window_end else None,
+            "next_due_at": self._heap[0][0].isoformat() if self._heap else None
+        }
+
+message_scheduler = MessageScheduler(SCHEDULER_WINDOW_SECONDS, SCHEDULER_WINDOW_SIZE)
+
+async def _reload_message_scheduler():
+    message_scheduler.request_reload()
+
+cache_invalidator.register("scheduled_messages", _reload_message_scheduler)
+
+class SlidingWindowLimiter:
+    """Approximate sliding-window request counts per (scope, identity), checked in memory.
+    
+    Counts are kept per fixed one-minute window and the estimate weights the previous
+    window by how much of it still overlaps the last 60 seconds. Every
+    RATE_LIMIT_SYNC_SECONDS each worker adds its local increments to
+    db.rate_limit_counters and reads back the cluster-wide totals, so limits hold
+    across workers (up to one sync interval of lag) without a Mongo round trip
+    per request.
+    """
+    
+    WINDOW = 60
+    
+    def __init__(self, sync_interval: float):
+        self.sync_interval = sync_interval
+        # (scope, identity, window_start) -> [local increments not yet synced, cluster total at last sync]
+        self._counts: Dict[tuple, List[int]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"admitted": 0, "limited": 0, "shed": 0, "syncs": 0, "sync_errors": 0}
+    
+    def estimate(self, scope: str, identity: str, now: float) -> tuple:
+        """(estimated requests in the last minute, seconds until the current window ends)"""
+        window = int(now // self.WINDOW) * self.WINDOW
+        current = sum(self._counts.get((scope, identity, window), (0, 0)))
+        previous = sum(self._counts.get((scope, identity, window - self.WINDOW), (0, 0)))
+        elapsed = now - window
+        return current + previous * (1 - elapsed / self.WINDOW), self.WINDOW - elapsed
+    
+    def check(self, checks: List[tuple]) -> Optional[int]:
+        """Count one request against every (scope, identity, limit); returns Retry-After seconds if over any limit"""
+        now = time.time()
+        for scope, identity, limit in checks:
+            estimated, remaining = self.estimate(scope, identity, now)
+            if estimated + 1 > limit:
+                self._counters["limited"] += 1
+                return max(1, math.ceil(remaining))
+        
+        window = int(now // self.WINDOW) * self.WINDOW
+        for scope, identity, _ in checks:
+            self._counts.setdefault((scope, identity, window), [0, 0])[0] += 1
+        self._counters["admitted"] += 1
+        return None
+    
+    def record_shed(self):
+        self._counters["shed"] += 1
+    
+    async def sync(self):
+        window = int(time.time() // self.WINDOW) * self.WINDOW
+        # Drop windows that no longer affect the estimate
+        for key in [key for key in self._counts if key[2] < window - self.WINDOW]:
+            del self._counts[key]
+        
+        if not self._counts:
+            return
+        deltas = {key: counts[0] for key, counts in self._counts.items() if counts[0]}
+        doc_ids = {key: f"{key[0]}:{key[1]}:{key[2]}" for key in self._counts}
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.WINDOW * 3)
+        try:
+            if deltas:
+                await db.rate_limit_counters.bulk_write([
+                    UpdateOne(
+                        {"_id": doc_ids[key]},
+                        {"$inc": {"count": delta}, "$setOnInsert": {"expires_at": expires_at}},
+                        upsert=True
+                    )
+                    for key, delta in deltas.items()
+                ], ordered=False)
+            totals = {
+                doc["_id"]: doc["count"]
+                async for doc in db.rate_limit_counters.find({"_id": {"$in": list(doc_ids.values())}})
+            }
+        except Exception as e:
+            self._counters["sync_errors"] += 1
+            logger.error(f"Could not sync rate limit counters: {e}")
+            return
+        
+        for key, doc_id in doc_ids.items():
+            counts = self._counts.get(key)
+            if counts is None:
+                continue
+            # Requests admitted while the sync was in flight stay local until the next one
+            counts[0] -= deltas.get(key, 0)
+            counts[1] = totals.get(doc_id, counts[1])
+        self._counters["syncs"] += 1
+    
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.sync()
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            await self.sync()
+    
+    def stats(self) -> dict:
+        return {**self._counters, "tracked": len(self._counts)}
 
-async def trigger_webhooks(instance_id: str, event: str, data: dict):
-    """Trigger webhooks for an event"""
-    webhooks = await db.webhooks.find({
-        "instance_id": instance_id,
-        "is_active": True,
-        "events": event
-    }, {"_id": 0}).to_list(100)
+request_limiter = SlidingWindowLimiter(RATE_LIMIT_SYNC_SECONDS)
+
+# ===================== INDEXES =====================
+
+class IndexManager:
+    """Declares the indexes each collection needs and creates them idempotently at startup"""
     
-    for webhook in webhooks:
-        try:
-            async with httpx.AsyncClient() as client:
-                await client.post(
-                    webhook["url"],
-                    json={"event": event, "data": data},
-                    timeout=10.0
-                )
-            await db.webhooks.update_one(
-                {"id": webhook["id"]},
-                {"$set": {"last_triggered": datetime.now(timezone.utc).isoformat()}}
-            )
-        except Exception as e:
-            logger.error(f"Webhook delivery failed: {e}")
+    def __init__(self):
+        self.declarations: Dict[str, List[IndexModel]] = {}
+        self.errors: Dict[str, str] = {}
+        self.last_ensured_at: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def declare(self, collection: str, keys: List[tuple], **options):
+        """Register an index; options are passed through to IndexModel (unique, expireAfterSeconds, ...)"""
+        self.declarations.setdefault(collection, []).append(IndexModel(keys, background=True, **options))
+    
+    async def start(self):
+        # Build in the background so startup is never blocked by a long index build
+        if self._task is None:
+            self._task = asyncio.create_task(self.ensure_indexes())
+    
+    async def stop(self):
+        """Cancel a bootstrap that is still running; Mongo finishes any build it already started"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def ensure_indexes(self):
+        """Create every declared index; existing ones with the same spec are a no-op"""
+        for collection, models in self.declarations.items():
+            for model in models:
+                name = model.document["name"]
+                try:
+                    await db[collection].create_indexes([model])
+                    self.errors.pop(f"{collection}.{name}", None)
+                except Exception as e:
+                    # e.g. duplicates blocking a unique index; keep going with the rest
+                    self.errors[f"{collection}.{name}"] = str(e)
+                    logger.error(f"Could not create index {collection}.{name}: {e}")
+        self.last_ensured_at = datetime.now(timezone.utc).isoformat()
+        logger.info(f"Index bootstrap finished ({len(self.errors)} errors)")
+    
+    async def report(self) -> Dict[str, Any]:
+        """Missing, unused and undeclared indexes per collection"""
+        collections = {}
+        for collection, models in self.declarations.items():
+            existing = await db[collection].index_information()
+            declared = {model.document["name"] for model in models}
+            
+            usage = {}
+            try:
+                async for stat in db[collection].aggregate([{"$indexStats": {}}]):
+                    usage[stat["name"]] = stat.get("accesses", {}).get("ops", 0)
+            except Exception as e:
+                logger.warning(f"Could not read index stats for {collection}: {e}")
+            
+            collections[collection] = {
+                "missing": sorted(declared - set(existing)),
+                "unused": sorted(name for name, ops in usage.items() if ops == 0 and name != "_id_"),
+                "undeclared": sorted(set(existing) - declared - {"_id_"}),
+                "usage": usage
+            }
+        return {
+            "last_ensured_at": self.last_ensured_at,
+            "errors": self.errors,
+            "collections": collections
+        }
 
-def map_evolution_state_to_status(state: str) -> str:
-    """Map Evolution API connection state to our status"""
-    state_mapping = {
-        "open": "connected",
-        "connecting": "connecting",
-        "close": "disconnected",
-        "closed": "disconnected"
-    }
-    return state_mapping.get(state.lower(), "disconnected")
+index_manager = IndexManager()
+index_manager.declare("users", [("id", ASCENDING)], unique=True)
+index_manager.declare("users", [("email", ASCENDING)], unique=True)
+index_manager.declare("api_keys", [("id", ASCENDING)], unique=True)
+index_manager.declare("api_keys", [("key", ASCENDING)], unique=True)
+index_manager.declare("api_keys", [("user_id", ASCENDING), ("is_active", ASCENDING)])
+index_manager.declare("instances", [("id", ASCENDING)], unique=True)
+index_manager.declare("instances", [("user_id", ASCENDING), ("id", ASCENDING)])
+index_manager.declare("instances", [("evolution_instance_name", ASCENDING)])
+index_manager.declare("webhooks", [("id", ASCENDING)], unique=True)
+index_manager.declare("webhooks", [("instance_id", ASCENDING), ("events", ASCENDING), ("is_active", ASCENDING)])
+index_manager.declare("webhooks", [("user_id", ASCENDING), ("is_active", ASCENDING)])
+index_manager.declare("messages", [("id", ASCENDING)], unique=True)
+# Evolution redelivers webhooks; the same WhatsApp message is stored once
+index_manager.declare("messages", [("instance_id", ASCENDING), ("evolution_message_id", ASCENDING)], unique=True,
+                      partialFilterExpression={"evolution_message_id": {"$exists": True}})
+# Keyset pagination: every filter combination pages on a (created_at, id) suffix
+index_manager.declare("messages", [("instance_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)])
+for message_filter in ("direction", "status", "phone_number"):
+    index_manager.declare("messages", [
+        ("instance_id", ASCENDING), (message_filter, ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)
+    ])
+index_manager.declare("logs", [("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)])
+index_manager.declare("logs", [
+    ("user_id", ASCENDING), ("instance_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)
+])
+index_manager.declare("billing_templates", [("id", ASCENDING)], unique=True)
+index_manager.declare("billing_templates", [
+    ("user_id", ASCENDING), ("locale", ASCENDING), ("message_type", ASCENDING), ("instance_id", ASCENDING)
+], unique=True)
+index_manager.declare("campaigns", [("id", ASCENDING)], unique=True)
+index_manager.declare("campaigns", [("status", ASCENDING)])
+index_manager.declare("campaign_rows", [("id", ASCENDING)], unique=True)
+index_manager.declare("campaign_rows", [("campaign_id", ASCENDING), ("status", ASCENDING), ("seq", ASCENDING)])
+index_manager.declare("campaign_rows", [("campaign_id", ASCENDING), ("seq", ASCENDING)])
+index_manager.declare("campaign_rows", [("status", ASCENDING), ("claim_expires_at", ASCENDING)])
+index_manager.declare("scheduled_messages", [("id", ASCENDING)], unique=True)
+index_manager.declare("scheduled_messages", [("status", ASCENDING), ("due_at", ASCENDING)])
+index_manager.declare("scheduled_messages", [("instance_id", ASCENDING), ("status", ASCENDING), ("due_at", ASCENDING)])
+# Idle buckets carry no state worth keeping
+index_manager.declare("send_rate_buckets", [("updated_at", ASCENDING)], expireAfterSeconds=86400)
+index_manager.declare("rate_limit_counters", [("expires_at", ASCENDING)], expireAfterSeconds=0)
+index_manager.declare("idempotency_keys", [("expires_at", ASCENDING)], expireAfterSeconds=0)
+index_manager.declare("event_tickets", [("expires_at", ASCENDING)], expireAfterSeconds=0)
+index_manager.declare("qr_codes", [("expires_at", ASCENDING)], expireAfterSeconds=0)
+index_manager.declare("webhook_deliveries", [("instance_id", ASCENDING), ("created_at", DESCENDING)])
+index_manager.declare("inbound_events", [("worker_id", ASCENDING), ("created_at", ASCENDING), ("seq", ASCENDING)])
+index_manager.declare("outbound_jobs", [("id", ASCENDING)], unique=True)
+index_manager.declare("outbound_jobs", [("campaign_id", ASCENDING), ("status", ASCENDING)], sparse=True)
+# One send per campaign row, even if a reclaimed row races the leader that claimed it first
+index_manager.declare("outbound_jobs", [("campaign_row_id", ASCENDING)], unique=True,
+                      partialFilterExpression={"campaign_row_id": {"$exists": True}})
+index_manager.declare("outbound_jobs", [("status", ASCENDING), ("next_attempt_at", ASCENDING)])
+index_manager.declare("outbound_jobs", [("status", ASCENDING), ("locked_until", ASCENDING)])
 
 # ===================== AUTH ROUTES =====================
 
@@ -510,7 +3726,7 @@ async def register(user_data: UserCreate):
     await db.users.insert_one(user_doc)
     await log_activity(user_id, "user.registered")
     
-    access_token = create_access_token({"sub": user_id})
+    access_token = create_access_token(build_token_claims(user_doc))
     
     user_response = UserResponse(
         id=user_id,
@@ -534,7 +3750,7 @@ async def login(credentials: UserLogin):
     
     await log_activity(user["id"], "user.login")
     
-    access_token = create_access_token({"sub": user["id"]})
+    access_token = create_access_token(build_token_claims(user))
     
     user_response = UserResponse(
         id=user["id"],
@@ -582,13 +3798,9 @@ async def create_instance(instance_data: InstanceCreate, current_user: dict = De
         raise HTTPException(status_code=500, detail=f"Failed to create WhatsApp instance: {str(e)}")
     
     # Extract QR code from response
-    qr_code = None
-    if evolution_response:
-        qr_data = evolution_response.get("qrcode", {})
-        if isinstance(qr_data, dict):
-            qr_code = qr_data.get("base64")
-        elif isinstance(qr_data, str):
-            qr_code = qr_data
+    qr_code = extract_qr_code(evolution_response)
+    if qr_code:
+        await qr_code_cache.set(evolution_instance_name, qr_code)
     
     instance_doc = {
         "id": instance_id,
@@ -604,6 +3816,7 @@ async def create_instance(instance_data: InstanceCreate, current_user: dict = De
     }
     
     await db.instances.insert_one(instance_doc)
+    await invalidate_instance_cache(instance_doc)
     await log_activity(current_user["id"], "instance.created", instance_id, {
         "evolution_name": evolution_instance_name,
         "instance_type": instance_data.instance_type
@@ -630,36 +3843,15 @@ async def get_instances(current_user: dict = Depends(get_current_user)):
         {"_id": 0}
     ).to_list(100)
     
-    # Update status from Evolution API for each instance
+    # Serve stored status while the reconciler keeps it fresh; otherwise refresh
+    # every instance from a single fetchInstances call
+    if evolution_reconciler.is_fresh():
+        statuses = [(inst.get("status", "disconnected"), inst.get("phone_number")) for inst in instances]
+    else:
+        statuses = await refresh_instance_statuses(instances)
+    
     result = []
-    for inst in instances:
-        status = inst.get("status", "disconnected")
-        phone_number = inst.get("phone_number")
-        
-        if inst.get("evolution_instance_name"):
-            try:
-                state_response = await evolution_client.get_instance_connection_state(inst["evolution_instance_name"])
-                if state_response:
-                    state = state_response.get("instance", {}).get("state") or state_response.get("state", "close")
-                    status = map_evolution_state_to_status(state)
-                    
-                    # Get phone number if connected
-                    if status == "connected":
-                        info = await evolution_client.get_instance_info(inst["evolution_instance_name"])
-                        if info:
-                            owner = info.get("instance", {}).get("owner")
-                            if owner:
-                                phone_number = owner.replace("@s.whatsapp.net", "")
-            except Exception as e:
-                logger.warning(f"Could not get Evolution state for {inst.get('evolution_instance_name')}: {e}")
-        
-        # Update local status if changed
-        if status != inst.get("status") or phone_number != inst.get("phone_number"):
-            await db.instances.update_one(
-                {"id": inst["id"]},
-                {"$set": {"status": status, "phone_number": phone_number, "updated_at": datetime.now(timezone.utc).isoformat()}}
-            )
-        
+    for inst, (status, phone_number) in zip(instances, statuses):
         result.append(InstanceResponse(
             id=inst["id"],
             name=inst["name"],
@@ -690,27 +3882,27 @@ async def get_instance(instance_id: str, current_user: dict = Depends(get_curren
     phone_number = instance.get("phone_number")
     qr_code = None
     
-    # Get current status and QR from Evolution API
+    # Get current status (unless the reconciler keeps it fresh) and QR from Evolution API
     if instance.get("evolution_instance_name"):
         try:
-            state_response = await evolution_client.get_instance_connection_state(instance["evolution_instance_name"])
-            if state_response:
-                state = state_response.get("instance", {}).get("state") or state_response.get("state", "close")
-                status = map_evolution_state_to_status(state)
+            if not evolution_reconciler.is_fresh():
+                state_response = await evolution_client.get_instance_connection_state(instance["evolution_instance_name"])
+                if state_response:
+                    state = extract_connection_state(state_response)
+                    connection_state_cache.set(instance["evolution_instance_name"], state)
+                    status = map_evolution_state_to_status(state)
                 
-                # Get phone number if connected
-                if status == "connected":
-                    info = await evolution_client.get_instance_info(instance["evolution_instance_name"])
-                    if info:
-                        owner = info.get("instance", {}).get("owner")
-                        if owner:
-                            phone_number = owner.replace("@s.whatsapp.net", "")
+                    # Get phone number if connected
+                    if status == "connected":
+                        info = await evolution_client.get_instance_info(instance["evolution_instance_name"])
+                        if info:
+                            owner = info.get("instance", {}).get("owner")
+                            if owner:
+                                phone_number = owner.replace("@s.whatsapp.net", "")
             
             # Get QR code if not connected
             if status != "connected":
-                qr_response = await evolution_client.get_qr_code(instance["evolution_instance_name"])
-                if qr_response:
-                    qr_code = qr_response.get("base64") or qr_response.get("qrcode", {}).get("base64")
+                qr_code = await get_cached_qr_code(instance["evolution_instance_name"])
         except Exception as e:
             logger.warning(f"Could not get Evolution data for {instance.get('evolution_instance_name')}: {e}")
     
@@ -746,15 +3938,20 @@ async def delete_instance(instance_id: str, current_user: dict = Depends(get_cur
     if instance.get("evolution_instance_name"):
         try:
             await evolution_client.delete_instance(instance["evolution_instance_name"])
+            connection_state_cache.pop(instance["evolution_instance_name"])
+            await qr_code_cache.pop(instance["evolution_instance_name"])
         except Exception as e:
             logger.warning(f"Could not delete Evolution instance: {e}")
     
     # Delete from local database
     await db.instances.delete_one({"id": instance_id})
+    await invalidate_instance_cache(instance)
     
     # Delete related data
     await db.messages.delete_many({"instance_id": instance_id})
     await db.webhooks.delete_many({"instance_id": instance_id})
+    webhook_subscriptions.remove_instance(instance_id)
+    await cache_invalidator.bump("webhooks")
     
     await log_activity(current_user["id"], "instance.deleted", instance_id)
     
@@ -770,12 +3967,15 @@ async def connect_instance(instance_id: str, current_user: dict = Depends(get_cu
     if not instance.get("evolution_instance_name"):
         raise HTTPException(status_code=400, detail="Instance not properly configured")
     
-    # Get QR code from Evolution API
+    # Always call Evolution's connect: that is what starts pairing. The cached QR is only
+    # a fallback when Evolution answers without one.
     try:
-        qr_response = await evolution_client.get_qr_code(instance["evolution_instance_name"])
-        qr_code = None
-        if qr_response:
-            qr_code = qr_response.get("base64") or qr_response.get("qrcode", {}).get("base64")
+        instance_name = instance["evolution_instance_name"]
+        qr_code = extract_qr_code(await evolution_client.get_qr_code(instance_name))
+        if qr_code:
+            await qr_code_cache.set(instance_name, qr_code)
+        else:
+            qr_code = await qr_code_cache.get(instance_name)
         
         now = datetime.now(timezone.utc).isoformat()
         await db.instances.update_one(
@@ -800,6 +4000,8 @@ async def disconnect_instance(instance_id: str, current_user: dict = Depends(get
     if instance.get("evolution_instance_name"):
         try:
             await evolution_client.logout_instance(instance["evolution_instance_name"])
+            connection_state_cache.set(instance["evolution_instance_name"], "close")
+            await qr_code_cache.pop(instance["evolution_instance_name"])
         except Exception as e:
             logger.warning(f"Could not logout Evolution instance: {e}")
     
@@ -815,8 +4017,12 @@ async def disconnect_instance(instance_id: str, current_user: dict = Depends(get
     return {"message": "Instance disconnected successfully"}
 
 @api_router.get("/instances/{instance_id}/qr")
-async def get_qr_code(instance_id: str, current_user: dict = Depends(get_current_user)):
-    """Get QR code for an instance"""
+async def get_qr_code(
+    instance_id: str,
+    if_none_match: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get QR code for an instance; unchanged codes answer If-None-Match with 304"""
     instance = await db.instances.find_one(
         {"id": instance_id, "user_id": current_user["id"]},
         {"_id": 0}
@@ -825,27 +4031,33 @@ async def get_qr_code(instance_id: str, current_user: dict = Depends(get_current
         raise HTTPException(status_code=404, detail="Instance not found")
     
     # Check if already connected
-    if instance.get("evolution_instance_name"):
+    if instance.get("evolution_instance_name") and evolution_reconciler.is_fresh():
+        if instance.get("status") == "connected":
+            return {"qr_code": None, "message": "Instance already connected"}
+    elif instance.get("evolution_instance_name"):
         try:
-            state_response = await evolution_client.get_instance_connection_state(instance["evolution_instance_name"])
-            if state_response:
-                state = state_response.get("instance", {}).get("state") or state_response.get("state", "close")
-                if state == "open":
-                    return {"qr_code": None, "message": "Instance already connected"}
+            state = await get_cached_connection_state(instance["evolution_instance_name"])
+            if state == "open":
+                return {"qr_code": None, "message": "Instance already connected"}
         except Exception as e:
             logger.warning(f"Could not check Evolution state: {e}")
     
-    # Get QR code from Evolution API
+    # Serve the cached QR; Evolution is only asked on a cold miss
     qr_code = None
     if instance.get("evolution_instance_name"):
         try:
-            qr_response = await evolution_client.get_qr_code(instance["evolution_instance_name"])
-            if qr_response:
-                qr_code = qr_response.get("base64") or qr_response.get("qrcode", {}).get("base64")
+            qr_code = await get_cached_qr_code(instance["evolution_instance_name"])
         except Exception as e:
             logger.warning(f"Could not get QR code: {e}")
     
-    return {"qr_code": qr_code}
+    if not qr_code:
+        return {"qr_code": None}
+    
+    etag = f'"{hashlib.sha1(qr_code.encode()).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse({"qr_code": qr_code}, headers=headers)
 
 # ===================== MESSAGE ROUTES =====================
 
@@ -865,8 +4077,7 @@ async def send_message(
     
     # Check connection status
     try:
-        state_response = await evolution_client.get_instance_connection_state(instance["evolution_instance_name"])
-        state = state_response.get("instance", {}).get("state") or state_response.get("state", "close")
+        state = await get_cached_connection_state(instance["evolution_instance_name"])
         if state != "open":
             raise HTTPException(status_code=400, detail="Instance is not connected. Please scan QR code first.")
     except HTTPException:
@@ -876,6 +4087,26 @@ async def send_message(
     
     message_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
+    message_doc = {
+        "id": message_id,
+        "instance_id": instance_id,
+        "phone_number": message_data.phone_number,
+        "message": message_data.message,
+        "message_type": message_data.message_type,
+        "direction": "outgoing",
+        "status": "queued",
+        "created_at": now
+    }
+    
+    # Over the instance's send rate: the outbound workers send it when its slot comes up
+    rate_slot_at = await wait_for_send_slot(instance)
+    if rate_slot_at:
+        await outbound_queue.enqueue(instance, message_doc, "text", {
+            "phone_number": message_data.phone_number,
+            "message": message_data.message
+        }, rate_slot_at=rate_slot_at)
+        await log_activity(current_user["id"], "message.queued", instance_id, {"to": message_data.phone_number})
+        return MessageResponse(**message_doc)
     
     # Send message via Evolution API
     try:
@@ -884,24 +4115,13 @@ async def send_message(
             message_data.phone_number,
             message_data.message
         )
-        message_status = "sent"
+        message_doc["status"] = "sent"
         logger.info(f"Message sent via Evolution API: {evolution_response}")
     except Exception as e:
         logger.error(f"Failed to send message via Evolution API: {e}")
-        message_status = "failed"
+        connection_state_cache.pop(instance["evolution_instance_name"])
         raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
     
-    message_doc = {
-        "id": message_id,
-        "instance_id": instance_id,
-        "phone_number": message_data.phone_number,
-        "message": message_data.message,
-        "message_type": message_data.message_type,
-        "direction": "outgoing",
-        "status": message_status,
-        "created_at": now
-    }
-    
     await db.messages.insert_one(message_doc)
     await log_activity(current_user["id"], "message.sent", instance_id, {"to": message_data.phone_number})
     
@@ -918,21 +4138,59 @@ async def send_message(
 @api_router.get("/instances/{instance_id}/messages", response_model=List[MessageResponse])
 async def get_messages(
     instance_id: str,
+    response: Response,
     limit: int = 50,
     offset: int = 0,
+    cursor: Optional[str] = None,
+    direction: Optional[str] = None,
+    status: Optional[str] = None,
+    phone_number: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
     current_user: dict = Depends(get_current_user)
 ):
+    """List messages newest first; pass X-Next-Cursor back as cursor for the next page"""
     instance = await db.instances.find_one({"id": instance_id, "user_id": current_user["id"]})
     if not instance:
         raise HTTPException(status_code=404, detail="Instance not found")
     
-    messages = await db.messages.find(
-        {"instance_id": instance_id},
-        {"_id": 0}
-    ).sort("created_at", -1).skip(offset).limit(limit).to_list(limit)
+    query = {"instance_id": instance_id}
+    if direction:
+        query["direction"] = direction
+    if status:
+        query["status"] = status
+    if phone_number:
+        query["phone_number"] = phone_number
+    
+    messages, next_cursor = await fetch_page(db.messages, query, limit, offset, cursor, since, until)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     
     return [MessageResponse(**msg) for msg in messages]
 
+@api_router.get("/instances/{instance_id}/messages/export")
+async def export_messages(
+    instance_id: str,
+    format: str = "ndjson",
+    compress: bool = False,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream an instance's message history as NDJSON or CSV, optionally gzipped"""
+    instance = await db.instances.find_one({"id": instance_id, "user_id": current_user["id"]})
+    if not instance:
+        raise HTTPException(status_code=404, detail="Instance not found")
+    
+    return export_response(
+        db.messages,
+        time_range_query({"instance_id": instance_id}, since, until),
+        list(MessageResponse.model_fields),
+        format,
+        compress,
+        f"messages_{instance_id}"
+    )
+
 # ===================== INTERACTIVE MESSAGE ROUTES =====================
 
 @api_router.post("/instances/{instance_id}/messages/send-buttons")
@@ -952,8 +4210,7 @@ async def send_button_message(
     
     # Check connection status
     try:
-        state_response = await evolution_client.get_instance_connection_state(instance["evolution_instance_name"])
-        state = state_response.get("instance", {}).get("state") or state_response.get("state", "close")
+        state = await get_cached_connection_state(instance["evolution_instance_name"])
         if state != "open":
             raise HTTPException(status_code=400, detail="Instance is not connected")
     except HTTPException:
@@ -963,10 +4220,34 @@ async def send_button_message(
     
     message_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
+    buttons = [{"id": btn.id, "text": btn.text} for btn in message_data.buttons]
+    message_doc = {
+        "id": message_id,
+        "instance_id": instance_id,
+        "phone_number": message_data.phone_number,
+        "message": f"{message_data.title}\n{message_data.description}",
+        "message_type": "buttons",
+        "direction": "outgoing",
+        "status": "queued",
+        "buttons": buttons,
+        "created_at": now
+    }
+    
+    # Over the instance's send rate: the outbound workers send it when its slot comes up
+    rate_slot_at = await wait_for_send_slot(instance)
+    if rate_slot_at:
+        await outbound_queue.enqueue(instance, message_doc, "buttons", {
+            "phone_number": message_data.phone_number,
+            "title": message_data.title,
+            "description": message_data.description,
+            "footer": message_data.footer or "",
+            "buttons": buttons
+        }, rate_slot_at=rate_slot_at)
+        await log_activity(current_user["id"], "message.buttons_queued", instance_id, {"to": message_data.phone_number})
+        return {"success": True, "message_id": message_id, "status": "queued"}
     
     # Send button message via Evolution API
     try:
-        buttons = [{"id": btn.id, "text": btn.text} for btn in message_data.buttons]
         await evolution_client.send_button_message(
             instance["evolution_instance_name"],
             message_data.phone_number,
@@ -975,28 +4256,17 @@ async def send_button_message(
             message_data.footer or "",
             buttons
         )
-        message_status = "sent"
+        message_doc["status"] = "sent"
     except Exception as e:
         logger.error(f"Failed to send button message: {e}")
+        connection_state_cache.pop(instance["evolution_instance_name"])
         raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
     
     # Store in database
-    message_doc = {
-        "id": message_id,
-        "instance_id": instance_id,
-        "phone_number": message_data.phone_number,
-        "message": f"{message_data.title}\n{message_data.description}",
-        "message_type": "buttons",
-        "direction": "outgoing",
-        "status": message_status,
-        "buttons": [{"id": btn.id, "text": btn.text} for btn in message_data.buttons],
-        "created_at": now
-    }
-    
     await db.messages.insert_one(message_doc)
     await log_activity(current_user["id"], "message.buttons_sent", instance_id, {"to": message_data.phone_number})
     
-    return {"success": True, "message_id": message_id}
+    return {"success": True, "message_id": message_id, "status": "sent"}
 
 @api_router.post("/instances/{instance_id}/messages/send-billing")
 async def send_billing_notification(
@@ -1015,8 +4285,7 @@ async def send_billing_notification(
     
     # Check connection status
     try:
-        state_response = await evolution_client.get_instance_connection_state(instance["evolution_instance_name"])
-        state = state_response.get("instance", {}).get("state") or state_response.get("state", "close")
+        state = await get_cached_connection_state(instance["evolution_instance_name"])
         if state != "open":
             raise HTTPException(status_code=400, detail="Instance is not connected")
     except HTTPException:
@@ -1027,40 +4296,24 @@ async def send_billing_notification(
     message_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
     
-    # Build message based on type
-    message_templates = {
-        "payment_reminder": {
-            "title": "Payment Due Reminder",
-            "description": f"Dear {billing_data.customer_name},\n\nThis is a reminder that your payment of {billing_data.currency} {billing_data.amount:,.2f} is due.\n\nInvoice: #{billing_data.invoice_id}\n{f'Due Date: {billing_data.due_date}' if billing_data.due_date else ''}\n\nPlease ignore if already paid.",
-            "footer": "Tap PayNow to pay instantly"
-        },
-        "invoice": {
-            "title": "New Invoice Generated",
-            "description": f"Dear {billing_data.customer_name},\n\nA new invoice has been generated for your account.\n\nAmount: {billing_data.currency} {billing_data.amount:,.2f}\nInvoice: #{billing_data.invoice_id}\n{f'Due Date: {billing_data.due_date}' if billing_data.due_date else ''}",
-            "footer": "Tap PayNow to pay instantly"
-        },
-        "overdue": {
-            "title": "Payment Overdue Notice",
-            "description": f"Dear {billing_data.customer_name},\n\nYour account is now OVERDUE.\n\nOutstanding: {billing_data.currency} {billing_data.amount:,.2f}\nInvoice: #{billing_data.invoice_id}\n\nPlease settle immediately to avoid service interruption.",
-            "footer": "Pay now to restore service"
-        },
-        "confirmation": {
-            "title": "Payment Received",
-            "description": f"Dear {billing_data.customer_name},\n\nThank you! We have received your payment.\n\nAmount: {billing_data.currency} {billing_data.amount:,.2f}\nInvoice: #{billing_data.invoice_id}\n\nYour account is now up to date.",
-            "footer": "Thank you for your payment"
-        }
-    }
-    
-    template = message_templates.get(billing_data.message_type, message_templates["payment_reminder"])
-    
-    # Buttons for billing (except confirmation which doesn't need PayNow)
-    if billing_data.message_type == "confirmation":
-        buttons = [{"id": f"invoice_{billing_data.invoice_id}", "text": "View Invoice"}]
-    else:
-        buttons = [
-            {"id": f"paynow_{billing_data.invoice_id}", "text": "PayNow"},
-            {"id": f"invoice_{billing_data.invoice_id}", "text": "Invoice"}
-        ]
+    template, message_doc = await build_billing_message(current_user["id"], instance, billing_data, message_id, "sent", now)
+    
+    # Over the instance's send rate: the outbound workers send it when its slot comes up
+    rate_slot_at = await wait_for_send_slot(instance)
+    if rate_slot_at:
+        await outbound_queue.enqueue(instance, message_doc, "buttons", {
+            "phone_number": billing_data.phone_number,
+            "title": template["title"],
+            "description": template["description"],
+            "footer": template["footer"],
+            "buttons": template["buttons"]
+        }, rate_slot_at=rate_slot_at)
+        await log_activity(current_user["id"], f"billing.{billing_data.message_type}_queued", instance_id, {
+            "to": billing_data.phone_number,
+            "invoice_id": billing_data.invoice_id,
+            "amount": billing_data.amount
+        })
+        return {"success": True, "message_id": message_id, "invoice_id": billing_data.invoice_id, "status": "queued"}
     
     # Send via Evolution API
     try:
@@ -1070,35 +4323,14 @@ async def send_billing_notification(
             template["title"],
             template["description"],
             template["footer"],
-            buttons
+            template["buttons"]
         )
-        message_status = "sent"
     except Exception as e:
         logger.error(f"Failed to send billing notification: {e}")
+        connection_state_cache.pop(instance["evolution_instance_name"])
         raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
     
     # Store in database
-    message_doc = {
-        "id": message_id,
-        "instance_id": instance_id,
-        "phone_number": billing_data.phone_number,
-        "message": f"{template['title']}\n{template['description']}",
-        "message_type": f"billing_{billing_data.message_type}",
-        "direction": "outgoing",
-        "status": message_status,
-        "billing_data": {
-            "customer_name": billing_data.customer_name,
-            "amount": billing_data.amount,
-            "currency": billing_data.currency,
-            "invoice_id": billing_data.invoice_id,
-            "due_date": billing_data.due_date,
-            "payment_url": billing_data.payment_url,
-            "invoice_url": billing_data.invoice_url
-        },
-        "buttons": buttons,
-        "created_at": now
-    }
-    
     await db.messages.insert_one(message_doc)
     await log_activity(current_user["id"], f"billing.{billing_data.message_type}_sent", instance_id, {
         "to": billing_data.phone_number,
@@ -1106,18 +4338,175 @@ async def send_billing_notification(
         "amount": billing_data.amount
     })
     
-    return {"success": True, "message_id": message_id, "invoice_id": billing_data.invoice_id}
+    return {"success": True, "message_id": message_id, "invoice_id": billing_data.invoice_id, "status": "sent"}
+
+# ===================== SCHEDULED MESSAGE ROUTES =====================
+
+def scheduled_message_response(doc: dict) -> ScheduledMessageResponse:
+    return ScheduledMessageResponse(**{
+        **doc,
+        "send_at": as_utc(doc["due_at"]).isoformat()
+    })
+
+async def create_scheduled_message(user_id: str, instance: dict, data: ScheduledMessageCreate) -> ScheduledMessageResponse:
+    if data.billing:
+        kind, payload, phone_number = "billing", data.billing.model_dump(exclude_none=True), data.billing.phone_number
+    elif data.phone_number and data.message:
+        kind, payload, phone_number = "text", {"phone_number": data.phone_number, "message": data.message}, data.phone_number
+    else:
+        raise HTTPException(status_code=400, detail="Provide phone_number and message, or billing")
+    
+    due_at = as_utc(data.send_at)
+    if due_at <= datetime.now(timezone.utc) - timedelta(minutes=5):
+        raise HTTPException(status_code=400, detail="send_at is in the past")
+    
+    doc = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "instance_id": instance["id"],
+        "kind": kind,
+        "phone_number": phone_number,
+        "payload": payload,
+        "due_at": due_at,
+        "status": "scheduled",
+        "claimed_by": None,
+        "claimed_until": None,
+        "message_id": None,
+        "error": None,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    await message_scheduler.schedule(doc)
+    await log_activity(user_id, "message.scheduled", instance["id"], {"to": phone_number, "send_at": due_at.isoformat()})
+    return scheduled_message_response(doc)
+
+@api_router.post("/instances/{instance_id}/messages/schedule", response_model=ScheduledMessageResponse, status_code=201)
+async def schedule_message(
+    instance_id: str,
+    data: ScheduledMessageCreate,
+    current_user: dict = Depends(get_current_user)
+):
+    """Schedule a text message or billing notification for later"""
+    instance = await db.instances.find_one({"id": instance_id, "user_id": current_user["id"]})
+    if not instance:
+        raise HTTPException(status_code=404, detail="Instance not found")
+    
+    return await create_scheduled_message(current_user["id"], instance, data)
+
+@api_router.get("/instances/{instance_id}/scheduled-messages", response_model=List[ScheduledMessageResponse])
+async def get_scheduled_messages(
+    instance_id: str,
+    status: Optional[str] = "scheduled",
+    limit: int = 50,
+    current_user: dict = Depends(get_current_user)
+):
+    """Scheduled messages for an instance, soonest first"""
+    query = {"instance_id": instance_id, "user_id": current_user["id"]}
+    if status:
+        query["status"] = status
+    docs = await db.scheduled_messages.find(query, {"_id": 0}).sort("due_at", ASCENDING).limit(limit).to_list(limit)
+    return [scheduled_message_response(doc) for doc in docs]
+
+@api_router.delete("/scheduled-messages/{scheduled_id}")
+async def cancel_scheduled_message(scheduled_id: str, current_user: dict = Depends(get_current_user)):
+    result = await db.scheduled_messages.update_one(
+        {"id": scheduled_id, "user_id": current_user["id"], "status": "scheduled"},
+        {"$set": {"status": "cancelled"}}
+    )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=404, detail="Scheduled message not found or already sent")
+    
+    await log_activity(current_user["id"], "message.schedule_cancelled", details={"scheduled_id": scheduled_id})
+    return {"message": "Scheduled message cancelled"}
+
+@api_router.post("/v1/schedule-message", response_model=ScheduledMessageResponse, status_code=201)
+async def api_schedule_message(instance_id: str, data: ScheduledMessageCreate, authorization: str = None):
+    """Public API endpoint for scheduling a message or billing reminder using API key"""
+    user, _ = await verify_api_key_header(authorization, "send_message")
+    
+    instance = await db.instances.find_one({"id": instance_id, "user_id": user["id"]})
+    if not instance:
+        raise HTTPException(status_code=404, detail="Instance not found")
+    
+    return await create_scheduled_message(user["id"], instance, data)
+
+# ===================== BILLING TEMPLATE ROUTES =====================
+
+@api_router.get("/billing/templates")
+async def get_billing_templates(current_user: dict = Depends(get_current_user)):
+    """Built-in billing templates per locale and the user's stored overrides"""
+    overrides = await db.billing_templates.find({"user_id": current_user["id"]}, {"_id": 0}).to_list(1000)
+    builtin = {
+        locale: {message_type: templates[message_type] for message_type in BILLING_MESSAGE_TYPES}
+        for locale, templates in BUILTIN_BILLING_TEMPLATES.items()
+    }
+    return {"placeholders": sorted(BILLING_TEMPLATE_FIELDS), "builtin": builtin, "overrides": overrides}
+
+@api_router.put("/billing/templates")
+async def upsert_billing_template(template: BillingTemplateUpsert, current_user: dict = Depends(get_current_user)):
+    """Override a billing template for all of the user's instances or for one instance"""
+    if template.message_type not in BILLING_MESSAGE_TYPES:
+        raise HTTPException(status_code=400, detail=f"message_type must be one of: {', '.join(BILLING_MESSAGE_TYPES)}")
+    if template.instance_id:
+        instance = await db.instances.find_one({"id": template.instance_id, "user_id": current_user["id"]})
+        if not instance:
+            raise HTTPException(status_code=404, detail="Instance not found")
+    
+    fields = {field: getattr(template, field) for field in ("title", "description", "footer") if getattr(template, field) is not None}
+    if not fields:
+        raise HTTPException(status_code=400, detail="Provide at least one of title, description or footer")
+    for field, text in fields.items():
+        try:
+            CompiledTemplate(text)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"{field}: {e}")
+    
+    now = datetime.now(timezone.utc).isoformat()
+    key = {
+        "user_id": current_user["id"],
+        "instance_id": template.instance_id,
+        "locale": template.locale,
+        "message_type": template.message_type
+    }
+    await db.billing_templates.update_one(
+        key,
+        {"$set": {**fields, "updated_at": now}, "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": now}},
+        upsert=True
+    )
+    billing_templates.cache.clear()
+    await cache_invalidator.bump("billing_templates")
+    
+    await log_activity(current_user["id"], "billing_template.updated", template.instance_id, {
+        "message_type": template.message_type, "locale": template.locale
+    })
+    
+    return await db.billing_templates.find_one(key, {"_id": 0})
+
+@api_router.delete("/billing/templates/{template_id}")
+async def delete_billing_template(template_id: str, current_user: dict = Depends(get_current_user)):
+    result = await db.billing_templates.delete_one({"id": template_id, "user_id": current_user["id"]})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Template not found")
+    
+    billing_templates.cache.clear()
+    await cache_invalidator.bump("billing_templates")
+    
+    return {"message": "Template override deleted"}
 
 # ===================== PUBLIC BILLING API (Using API Key) =====================
 
-@api_router.post("/v1/billing/send-notification")
+@api_router.post("/v1/billing/send-notification", status_code=202)
 async def api_send_billing_notification(
     instance_id: str,
     billing_data: BillingNotificationSend,
     background_tasks: BackgroundTasks,
-    authorization: str = None
+    authorization: str = None,
+    idempotency_key: Optional[str] = Header(None)
 ):
-    """Public API endpoint for sending billing notifications using API key (for WISPMAN integration)"""
+    """Public API endpoint for sending billing notifications using API key (for WISPMAN integration).
+    
+    The same (instance, invoice_id, message_type) within INVOICE_DEDUPE_TTL_SECONDS,
+    or a repeated Idempotency-Key, returns the first response without sending again.
+    """
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="API key required")
     
@@ -1134,10 +4523,22 @@ async def api_send_billing_notification(
     if not instance.get("evolution_instance_name"):
         raise HTTPException(status_code=400, detail="Instance not properly configured")
     
+    keys = idempotency_keys_for(
+        user["id"], "billing", idempotency_key, {"instance_id": instance_id, **billing_data.model_dump()}
+    )
+    if INVOICE_DEDUPE_TTL_SECONDS > 0:
+        # Resending an invoice with changed details is still a duplicate, so no request hash here
+        keys.append((
+            f"invoice:{instance_id}:{billing_data.invoice_id}:{billing_data.message_type}",
+            INVOICE_DEDUPE_TTL_SECONDS,
+            None
+        ))
+    return await idempotency_store.run(keys, lambda: queue_api_billing_notification(user, instance, billing_data))
+
+async def queue_api_billing_notification(user: dict, instance: dict, billing_data: BillingNotificationSend) -> dict:
     # Check connection status
     try:
-        state_response = await evolution_client.get_instance_connection_state(instance["evolution_instance_name"])
-        state = state_response.get("instance", {}).get("state") or state_response.get("state", "close")
+        state = await get_cached_connection_state(instance["evolution_instance_name"])
         if state != "open":
             raise HTTPException(status_code=400, detail="Instance is not connected")
     except HTTPException:
@@ -1148,72 +4549,239 @@ async def api_send_billing_notification(
     message_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
     
-    # Build message based on type
-    message_templates = {
-        "payment_reminder": {
-            "title": "Payment Due Reminder",
-            "description": f"Dear {billing_data.customer_name},\n\nThis is a reminder that your payment of {billing_data.currency} {billing_data.amount:,.2f} is due.\n\nInvoice: #{billing_data.invoice_id}\n{f'Due Date: {billing_data.due_date}' if billing_data.due_date else ''}\n\nPlease ignore if already paid.",
-            "footer": "Tap PayNow to pay instantly"
-        },
-        "invoice": {
-            "title": "New Invoice Generated",
-            "description": f"Dear {billing_data.customer_name},\n\nA new invoice has been generated for your account.\n\nAmount: {billing_data.currency} {billing_data.amount:,.2f}\nInvoice: #{billing_data.invoice_id}\n{f'Due Date: {billing_data.due_date}' if billing_data.due_date else ''}",
-            "footer": "Tap PayNow to pay instantly"
-        },
-        "overdue": {
-            "title": "Payment Overdue Notice",
-            "description": f"Dear {billing_data.customer_name},\n\nYour account is now OVERDUE.\n\nOutstanding: {billing_data.currency} {billing_data.amount:,.2f}\nInvoice: #{billing_data.invoice_id}\n\nPlease settle immediately to avoid service interruption.",
-            "footer": "Pay now to restore service"
-        },
-        "confirmation": {
-            "title": "Payment Received",
-            "description": f"Dear {billing_data.customer_name},\n\nThank you! We have received your payment.\n\nAmount: {billing_data.currency} {billing_data.amount:,.2f}\nInvoice: #{billing_data.invoice_id}\n\nYour account is now up to date.",
-            "footer": "Thank you for your payment"
+    template, message_doc = await build_billing_message(user["id"], instance, billing_data, message_id, "queued", now)
+    
+    # Queue for the outbound workers; the caller gets the message_id straight away
+    await outbound_queue.enqueue(instance, message_doc, "buttons", {
+        "phone_number": billing_data.phone_number,
+        "title": template["title"],
+        "description": template["description"],
+        "footer": template["footer"],
+        "buttons": template["buttons"]
+    })
+    
+    return {"success": True, "message_id": message_id, "invoice_id": billing_data.invoice_id, "status": "queued"}
+
+# ===================== BILLING CAMPAIGNS (Using API Key) =====================
+
+# Row columns accepted in a campaign upload (the BillingNotificationSend fields)
+CAMPAIGN_ROW_FIELDS = list(BillingNotificationSend.model_fields)
+
+CAMPAIGN_EXPORT_FIELDS = ["seq", *CAMPAIGN_ROW_FIELDS, "status", "message_id", "error", "updated_at"]
+
+def iter_campaign_upload(upload: UploadFile, fmt: str):
+    """Yield raw row dicts from an uploaded CSV or NDJSON file, one at a time"""
+    text = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        yield from csv.DictReader(text)
+        return
+    for line in text:
+        if line.strip():
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield row if isinstance(row, dict) else {"_error": "Invalid JSON line"}
+
+def read_campaign_batch(rows, campaign_id: str, counts: Dict[str, int]) -> List[dict]:
+    """Parse and validate the next CAMPAIGN_IMPORT_BATCH_SIZE upload rows (runs in a worker thread)"""
+    batch = []
+    for raw in itertools.islice(rows, CAMPAIGN_IMPORT_BATCH_SIZE):
+        counts["total"] += 1
+        values = {
+            field: raw[field] for field in CAMPAIGN_ROW_FIELDS
+            if raw.get(field) not in (None, "")
         }
-    }
+        row = {"id": str(uuid.uuid4()), "campaign_id": campaign_id, "seq": counts["total"], "error": None}
+        try:
+            error = raw.get("_error")
+            if not error:
+                row.update(BillingNotificationSend(**values).model_dump(exclude_none=True), status="pending")
+        except ValidationError as e:
+            error = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+        if error:
+            counts["invalid"] += 1
+            row.update({field: str(value) for field, value in values.items()}, status="invalid", error=error)
+        batch.append(row)
+    return batch
+
+async def import_campaign_rows(campaign: dict, upload: UploadFile, fmt: str) -> Dict[str, int]:
+    """Validate and store upload rows in batches so a large file is never held in memory.
+    
+    Reading and validating a batch is CPU-bound, so it runs in the threadpool and the
+    event loop keeps serving other requests during a large import.
+    """
+    counts = {"total": 0, "invalid": 0}
+    rows = iter_campaign_upload(upload, fmt)
+    while True:
+        batch = await run_in_threadpool(read_campaign_batch, rows, campaign["id"], counts)
+        if not batch:
+            break
+        await db.campaign_rows.insert_many(batch, ordered=False)
+        # Progress, so the campaign runner does not take this import for a dead one
+        await db.campaigns.update_one(
+            {"id": campaign["id"], "status": "importing"},
+            {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+    return counts
+
+async def get_owned_campaign(campaign_id: str, user_id: str) -> dict:
+    campaign = await db.campaigns.find_one({"id": campaign_id, "user_id": user_id}, {"_id": 0})
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return campaign
+
+@api_router.post("/v1/campaigns", status_code=201)
+async def api_create_campaign(
+    instance_id: str,
+    file: UploadFile = File(...),
+    name: Optional[str] = None,
+    format: Optional[str] = None,
+    start_paused: bool = False,
+    authorization: str = None
+):
+    """Create a billing campaign from a CSV or NDJSON upload of BillingNotificationSend rows"""
+    user, _ = await verify_api_key_header(authorization, "send_message")
+    
+    instance = await db.instances.find_one({"id": instance_id, "user_id": user["id"]})
+    if not instance:
+        raise HTTPException(status_code=404, detail="Instance not found")
+    if not instance.get("evolution_instance_name"):
+        raise HTTPException(status_code=400, detail="Instance not properly configured")
     
-    template = message_templates.get(billing_data.message_type, message_templates["payment_reminder"])
+    fmt = format or ("ndjson" if (file.filename or "").endswith((".ndjson", ".jsonl")) else "csv")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'csv' or 'ndjson'")
     
-    if billing_data.message_type == "confirmation":
-        buttons = [{"id": f"invoice_{billing_data.invoice_id}", "text": "View Invoice"}]
-    else:
-        buttons = [
-            {"id": f"paynow_{billing_data.invoice_id}", "text": "PayNow"},
-            {"id": f"invoice_{billing_data.invoice_id}", "text": "Invoice"}
-        ]
+    now = datetime.now(timezone.utc).isoformat()
+    campaign = {
+        "id": str(uuid.uuid4()),
+        "user_id": user["id"],
+        "instance_id": instance_id,
+        "name": name or file.filename or "Billing campaign",
+        "status": "importing",
+        "total": 0,
+        "invalid": 0,
+        "queued": 0,
+        "sent": 0,
+        "failed": 0,
+        "cancelled": 0,
+        "created_at": now,
+        "updated_at": now
+    }
+    await db.campaigns.insert_one(campaign)
     
     try:
-        await evolution_client.send_button_message(
-            instance["evolution_instance_name"],
-            billing_data.phone_number,
-            template["title"],
-            template["description"],
-            template["footer"],
-            buttons
-        )
+        counts = await import_campaign_rows(campaign, file, fmt)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
+        logger.error(f"Campaign {campaign['id']} import failed: {e}")
+        await db.campaigns.update_one({"id": campaign["id"]}, {"$set": {"status": "failed", "error": str(e)}})
+        raise HTTPException(status_code=400, detail=f"Could not read upload: {str(e)}")
+    
+    campaign.update(counts, status="paused" if start_paused else "running", updated_at=datetime.now(timezone.utc).isoformat())
+    result = await db.campaigns.update_one(
+        {"id": campaign["id"], "status": "importing"},
+        {"$set": {**counts, "status": campaign["status"], "updated_at": campaign["updated_at"]}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=409, detail="Campaign import took too long and was abandoned")
+    await log_activity(user["id"], "campaign.created", instance_id, {"campaign_id": campaign["id"], **counts})
     
-    # Store message
-    message_doc = {
-        "id": message_id,
-        "instance_id": instance_id,
-        "phone_number": billing_data.phone_number,
-        "message": f"{template['title']}\n{template['description']}",
-        "message_type": f"billing_{billing_data.message_type}",
-        "direction": "outgoing",
-        "status": "sent",
-        "billing_data": {
-            "customer_name": billing_data.customer_name,
-            "amount": billing_data.amount,
-            "currency": billing_data.currency,
-            "invoice_id": billing_data.invoice_id
-        },
-        "created_at": now
-    }
-    await db.messages.insert_one(message_doc)
+    campaign.pop("_id", None)
+    return campaign
+
+@api_router.get("/v1/campaigns/{campaign_id}")
+async def api_get_campaign(campaign_id: str, authorization: str = None):
+    """Campaign status and progress counters"""
+    user, _ = await verify_api_key_header(authorization, "send_message")
+    campaign = await get_owned_campaign(campaign_id, user["id"])
+    campaign["pending"] = campaign["total"] - campaign["invalid"] - campaign["queued"] - campaign["cancelled"]
+    return campaign
+
+async def set_campaign_status(campaign_id: str, authorization: Optional[str], from_statuses: List[str], to_status: str) -> dict:
+    user, _ = await verify_api_key_header(authorization, "send_message")
+    await get_owned_campaign(campaign_id, user["id"])
+    
+    campaign = await db.campaigns.find_one_and_update(
+        {"id": campaign_id, "status": {"$in": from_statuses}},
+        {"$set": {"status": to_status, "updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not campaign:
+        raise HTTPException(status_code=409, detail=f"Campaign cannot be {to_status} from its current status")
+    await log_activity(user["id"], f"campaign.{to_status}", campaign["instance_id"], {"campaign_id": campaign_id})
+    return campaign
+
+@api_router.post("/v1/campaigns/{campaign_id}/pause")
+async def api_pause_campaign(campaign_id: str, authorization: str = None):
+    return await set_campaign_status(campaign_id, authorization, ["running"], "paused")
+
+@api_router.post("/v1/campaigns/{campaign_id}/resume")
+async def api_resume_campaign(campaign_id: str, authorization: str = None):
+    return await set_campaign_status(campaign_id, authorization, ["paused"], "running")
+
+@api_router.post("/v1/campaigns/{campaign_id}/cancel")
+async def api_cancel_campaign(campaign_id: str, authorization: str = None):
+    """Stop a campaign: pending rows and sends still waiting in the outbound queue are cancelled"""
+    campaign = await set_campaign_status(campaign_id, authorization, ["running", "paused"], "cancelled")
+    now = datetime.now(timezone.utc)
+    
+    # Sends already claimed by a worker may still go out
+    queued_jobs = await db.outbound_jobs.find(
+        {"campaign_id": campaign_id, "status": "queued"}, {"_id": 0, "id": 1}
+    ).to_list(None)
+    await db.outbound_jobs.update_many(
+        {"id": {"$in": [job["id"] for job in queued_jobs]}, "status": "queued"},
+        {"$set": {"status": "cancelled", "updated_at": now}}
+    )
+    jobs = await db.outbound_jobs.find(
+        {"id": {"$in": [job["id"] for job in queued_jobs]}, "status": "cancelled"},
+        {"_id": 0, "message_id": 1, "campaign_row_id": 1}
+    ).to_list(None)
+    if jobs:
+        await db.messages.update_many(
+            {"id": {"$in": [job["message_id"] for job in jobs]}},
+            {"$set": {"status": "cancelled"}}
+        )
+        await db.campaign_rows.update_many(
+            {"id": {"$in": [job["campaign_row_id"] for job in jobs]}},
+            {"$set": {"status": "cancelled", "updated_at": now.isoformat()}}
+        )
     
-    return {"success": True, "message_id": message_id, "invoice_id": billing_data.invoice_id}
+    result = await db.campaign_rows.update_many(
+        {"campaign_id": campaign_id, "status": "pending"},
+        {"$set": {"status": "cancelled", "updated_at": now.isoformat()}}
+    )
+    cancelled = result.modified_count + len(jobs)
+    # Cancelled queue entries move from queued to cancelled so pending stays correct
+    await db.campaigns.update_one(
+        {"id": campaign_id},
+        {"$inc": {"cancelled": cancelled, "queued": -len(jobs)}}
+    )
+    campaign["queued"] -= len(jobs)
+    campaign["cancelled"] += cancelled
+    return campaign
+
+@api_router.get("/v1/campaigns/{campaign_id}/results")
+async def api_export_campaign_results(
+    campaign_id: str,
+    format: str = "csv",
+    status: Optional[str] = None,
+    compress: bool = False,
+    authorization: str = None
+):
+    """Stream the per-row outcome of a campaign as CSV or NDJSON"""
+    user, _ = await verify_api_key_header(authorization, "send_message")
+    await get_owned_campaign(campaign_id, user["id"])
+    
+    query = {"campaign_id": campaign_id}
+    if status:
+        query["status"] = status
+    return export_response(
+        db.campaign_rows, query, CAMPAIGN_EXPORT_FIELDS, format, compress,
+        f"campaign_{campaign_id}", sort=[("seq", ASCENDING)]
+    )
 
 # ===================== BOTPRESS INTEGRATION ROUTES =====================
 
@@ -1229,32 +4797,26 @@ async def forward_to_botpress(instance: dict, phone_number: str, message: str, m
     if not webhook_url:
         return None
     
+    payload = {
+        "type": "text",
+        "text": message,
+        "userId": phone_number,
+        "conversationId": f"{instance['id']}_{phone_number}",
+        "messageId": message_id,
+        "instance_id": instance["id"],
+        "phone_number": phone_number,
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+    
     try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}" if token else ""
-        }
-        
-        payload = {
-            "type": "text",
-            "text": message,
-            "userId": phone_number,
-            "conversationId": f"{instance['id']}_{phone_number}",
-            "messageId": message_id,
-            "instance_id": instance["id"],
-            "phone_number": phone_number,
-            "timestamp": datetime.now(timezone.utc).isoformat()
-        }
+        response = await botpress_dispatcher.post(instance["id"], webhook_url, token, payload)
+        logger.info(f"Botpress webhook response: {response.status_code}")
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(webhook_url, json=payload, headers=headers)
-            logger.info(f"Botpress webhook response: {response.status_code}")
-            
-            if response.status_code in [200, 201]:
-                return response.json()
-            else:
-                logger.error(f"Botpress webhook failed: {response.text}")
-                return None
+        if response.status_code in [200, 201]:
+            return response.json()
+        else:
+            logger.error(f"Botpress webhook failed: {response.text}")
+            return None
     except Exception as e:
         logger.error(f"Failed to forward to Botpress: {e}")
         return None
@@ -1282,6 +4844,7 @@ async def configure_botpress(
         {"$set": {"botpress_config": botpress_config, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
     
+    await invalidate_instance_cache(instance)
     await log_activity(current_user["id"], "botpress.configured", instance_id)
     
     return {
@@ -1336,6 +4899,7 @@ async def update_botpress_config(
         update_fields["updated_at"] = datetime.now(timezone.utc).isoformat()
         await db.instances.update_one({"id": instance_id}, {"$set": update_fields})
     
+    await invalidate_instance_cache(instance)
     await log_activity(current_user["id"], "botpress.updated", instance_id)
     
     return {"success": True, "message": "Botpress configuration updated"}
@@ -1355,6 +4919,7 @@ async def remove_botpress_config(
         {"$unset": {"botpress_config": ""}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
     )
     
+    await invalidate_instance_cache(instance)
     await log_activity(current_user["id"], "botpress.removed", instance_id)
     
     return {"success": True, "message": "Botpress integration removed"}
@@ -1377,11 +4942,6 @@ async def test_botpress_connection(
     token = botpress_config.get("token")
     
     try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}" if token else ""
-        }
-        
         test_payload = {
             "type": "test",
             "text": "Test connection from Telenexus",
@@ -1390,14 +4950,13 @@ async def test_botpress_connection(
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
         
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(webhook_url, json=test_payload, headers=headers)
-            
-            return {
-                "success": response.status_code in [200, 201, 202, 204],
-                "status_code": response.status_code,
-                "message": "Connection successful" if response.status_code in [200, 201, 202, 204] else f"Connection failed: {response.text[:200]}"
-            }
+        response = await botpress_dispatcher.post(instance_id, webhook_url, token, test_payload, timeout=10.0)
+        
+        return {
+            "success": response.status_code in [200, 201, 202, 204],
+            "status_code": response.status_code,
+            "message": "Connection successful" if response.status_code in [200, 201, 202, 204] else f"Connection failed: {response.text[:200]}"
+        }
     except httpx.TimeoutException:
         return {"success": False, "message": "Connection timeout - webhook URL not responding"}
     except Exception as e:
@@ -1425,35 +4984,30 @@ async def botpress_reply(
     if not instance.get("evolution_instance_name"):
         raise HTTPException(status_code=400, detail="Instance not properly configured")
     
-    # Send message via Evolution API
+    message_id = str(uuid.uuid4())
+    message_doc = {
+        "id": message_id,
+        "instance_id": message.instance_id,
+        "phone_number": message.phone_number,
+        "message": message.message,
+        "message_type": "botpress_reply",
+        "direction": "outgoing",
+        "status": "queued",
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    
+    # Queue it so a burst of bot replies is paced by the instance's send rate instead of
+    # failing; Botpress does not retry a rejected reply
     try:
-        await evolution_client.send_text_message(
-            instance["evolution_instance_name"],
-            message.phone_number,
-            message.message
-        )
-        
-        # Store message in database
-        message_id = str(uuid.uuid4())
-        now = datetime.now(timezone.utc).isoformat()
-        
-        message_doc = {
-            "id": message_id,
-            "instance_id": message.instance_id,
+        await outbound_queue.enqueue(instance, message_doc, "text", {
             "phone_number": message.phone_number,
-            "message": message.message,
-            "message_type": "botpress_reply",
-            "direction": "outgoing",
-            "status": "sent",
-            "created_at": now
-        }
-        
-        await db.messages.insert_one(message_doc)
-        
-        return {"success": True, "message_id": message_id}
+            "message": message.message
+        })
     except Exception as e:
-        logger.error(f"Failed to send Botpress reply: {e}")
+        logger.error(f"Failed to queue Botpress reply: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
+    
+    return {"success": True, "message_id": message_id, "status": "queued"}
 
 # ===================== WEBHOOK ROUTES =====================
 
@@ -1482,6 +5036,8 @@ async def create_webhook(
     }
     
     await db.webhooks.insert_one(webhook_doc)
+    webhook_subscriptions.add(webhook_doc)
+    await cache_invalidator.bump("webhooks")
     await log_activity(current_user["id"], "webhook.created", instance_id)
     
     return WebhookResponse(**{k: v for k, v in webhook_doc.items() if k not in ["_id", "user_id"]})
@@ -1505,6 +5061,8 @@ async def delete_webhook(webhook_id: str, current_user: dict = Depends(get_curre
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Webhook not found")
     
+    webhook_subscriptions.remove(webhook_id)
+    await cache_invalidator.bump("webhooks")
     await log_activity(current_user["id"], "webhook.deleted")
     return {"message": "Webhook deleted successfully"}
 
@@ -1515,12 +5073,10 @@ async def test_webhook(webhook_id: str, current_user: dict = Depends(get_current
         raise HTTPException(status_code=404, detail="Webhook not found")
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                webhook["url"],
-                json={"event": "test", "data": {"message": "This is a test webhook from Telenexus"}},
-                timeout=10.0
-            )
+        response = await webhook_engine.post(
+            webhook["url"],
+            {"event": "test", "data": {"message": "This is a test webhook from Telenexus"}}
+        )
         return {"success": True, "status_code": response.status_code}
     except Exception as e:
         return {"success": False, "error": str(e)}
@@ -1564,13 +5120,17 @@ async def get_api_keys(current_user: dict = Depends(get_current_user)):
 
 @api_router.delete("/api-keys/{key_id}")
 async def revoke_api_key(key_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.api_keys.update_one(
+    key_doc = await db.api_keys.find_one_and_update(
         {"id": key_id, "user_id": current_user["id"]},
-        {"$set": {"is_active": False}}
+        {"$set": {"is_active": False}},
+        projection={"_id": 0, "key": 1}
     )
-    if result.matched_count == 0:
+    if key_doc is None:
         raise HTTPException(status_code=404, detail="API key not found")
     
+    api_key_cache.invalidate(key_doc["key"])
+    await cache_invalidator.bump("api_keys")
+    
     await log_activity(current_user["id"], "api_key.revoked")
     return {"message": "API key revoked successfully"}
 
@@ -1578,17 +5138,49 @@ async def revoke_api_key(key_id: str, current_user: dict = Depends(get_current_u
 
 @api_router.get("/logs", response_model=List[LogResponse])
 async def get_logs(
+    response: Response,
     limit: int = 50,
+    offset: int = 0,
+    cursor: Optional[str] = None,
     instance_id: str = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
     current_user: dict = Depends(get_current_user)
 ):
+    """List activity newest first; pass X-Next-Cursor back as cursor for the next page"""
     query = {"user_id": current_user["id"]}
     if instance_id:
         query["instance_id"] = instance_id
     
-    logs = await db.logs.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    logs, next_cursor = await fetch_page(db.logs, query, limit, offset, cursor, since, until)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    
     return [LogResponse(**log) for log in logs]
 
+@api_router.get("/logs/export")
+async def export_logs(
+    format: str = "ndjson",
+    compress: bool = False,
+    instance_id: str = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream activity logs as NDJSON or CSV, optionally gzipped"""
+    query = {"user_id": current_user["id"]}
+    if instance_id:
+        query["instance_id"] = instance_id
+    
+    return export_response(
+        db.logs,
+        time_range_query(query, since, until),
+        list(LogResponse.model_fields),
+        format,
+        compress,
+        "activity_logs"
+    )
+
 # ===================== DASHBOARD ROUTES =====================
 
 @api_router.get("/dashboard/stats", response_model=DashboardStats)
@@ -1599,18 +5191,13 @@ async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
     instances = await db.instances.find({"user_id": user_id}, {"_id": 0}).to_list(1000)
     total_instances = len(instances)
     
-    # Update status from Evolution API and count connected
-    connected_instances = 0
-    for inst in instances:
-        if inst.get("evolution_instance_name"):
-            try:
-                state_response = await evolution_client.get_instance_connection_state(inst["evolution_instance_name"])
-                if state_response:
-                    state = state_response.get("instance", {}).get("state") or state_response.get("state", "close")
-                    if state == "open":
-                        connected_instances += 1
-            except:
-                pass
+    # Count connected from stored status while the reconciler keeps it fresh,
+    # otherwise refresh from Evolution
+    if evolution_reconciler.is_fresh():
+        statuses = [inst.get("status") for inst in instances]
+    else:
+        statuses = [status for status, _ in await refresh_instance_statuses(instances)]
+    connected_instances = sum(1 for status in statuses if status == "connected")
     
     # Get message stats
     total_messages = await db.messages.count_documents({
@@ -1639,14 +5226,14 @@ async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
 
 # ===================== PUBLIC API (Using API Key) =====================
 
-@api_router.post("/v1/send-message")
+@api_router.post("/v1/send-message", status_code=202)
 async def api_send_message(
     instance_id: str,
     message_data: MessageSend,
-    background_tasks: BackgroundTasks,
-    authorization: str = None
+    authorization: str = None,
+    idempotency_key: Optional[str] = Header(None)
 ):
-    """Public API endpoint for sending messages using API key"""
+    """Public API endpoint for sending messages using API key; an Idempotency-Key replays the first response"""
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="API key required")
     
@@ -1663,10 +5250,19 @@ async def api_send_message(
     if not instance.get("evolution_instance_name"):
         raise HTTPException(status_code=400, detail="Instance not properly configured")
     
+    return await idempotency_store.run(
+        idempotency_keys_for(
+            user["id"], "send-message", idempotency_key, {"instance_id": instance_id, **message_data.model_dump()}
+        ),
+        lambda: queue_api_message(instance, message_data)
+    )
+
+async def queue_api_message(instance: dict, message_data: MessageSend) -> dict:
+    instance_id = instance["id"]
+    
     # Check connection status
     try:
-        state_response = await evolution_client.get_instance_connection_state(instance["evolution_instance_name"])
-        state = state_response.get("instance", {}).get("state") or state_response.get("state", "close")
+        state = await get_cached_connection_state(instance["evolution_instance_name"])
         if state != "open":
             raise HTTPException(status_code=400, detail="Instance is not connected")
     except HTTPException:
@@ -1677,16 +5273,6 @@ async def api_send_message(
     message_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc).isoformat()
     
-    # Send message via Evolution API
-    try:
-        await evolution_client.send_text_message(
-            instance["evolution_instance_name"],
-            message_data.phone_number,
-            message_data.message
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
-    
     message_doc = {
         "id": message_id,
         "instance_id": instance_id,
@@ -1694,20 +5280,93 @@ async def api_send_message(
         "message": message_data.message,
         "message_type": message_data.message_type,
         "direction": "outgoing",
-        "status": "sent",
+        "status": "queued",
         "created_at": now
     }
     
-    await db.messages.insert_one(message_doc)
+    # Queue for the outbound workers; message.sent fires once Evolution accepts it
+    await outbound_queue.enqueue(instance, message_doc, "text", {
+        "phone_number": message_data.phone_number,
+        "message": message_data.message
+    })
     
-    background_tasks.add_task(
-        trigger_webhooks,
-        instance_id,
-        "message.sent",
-        {"message_id": message_id, "to": message_data.phone_number}
-    )
+    return {"success": True, "message_id": message_id, "status": "queued"}
+
+@api_router.post("/v1/send-messages/batch", status_code=202)
+async def api_send_messages_batch(
+    instance_id: str,
+    batch: BatchMessageSend,
+    authorization: str = None
+):
+    """Public API endpoint for queueing many messages through one instance in a single request.
+    
+    Every message is queued like /v1/send-message, so the instance's send rate paces
+    delivery instead of turning the rest of a large batch away.
+    """
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="API key required")
+    
+    api_key = authorization.replace("Bearer ", "")
+    user, key_doc = await verify_api_key(api_key)
+    
+    if "send_message" not in key_doc.get("permissions", []):
+        raise HTTPException(status_code=403, detail="Permission denied")
+    
+    if not batch.messages:
+        raise HTTPException(status_code=400, detail="No messages to send")
+    if len(batch.messages) > BATCH_SEND_MAX_MESSAGES:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {BATCH_SEND_MAX_MESSAGES} messages")
+    
+    instance = await db.instances.find_one({"id": instance_id, "user_id": user["id"]})
+    if not instance:
+        raise HTTPException(status_code=404, detail="Instance not found")
+    
+    if not instance.get("evolution_instance_name"):
+        raise HTTPException(status_code=400, detail="Instance not properly configured")
+    
+    # Check connection status once for the whole batch
+    try:
+        state = await get_cached_connection_state(instance["evolution_instance_name"])
+        if state != "open":
+            raise HTTPException(status_code=400, detail="Instance is not connected")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not verify connection status: {str(e)}")
+    
+    now = datetime.now(timezone.utc).isoformat()
+    items = [
+        ({
+            "id": str(uuid.uuid4()),
+            "instance_id": instance_id,
+            "phone_number": message_data.phone_number,
+            "message": message_data.message,
+            "message_type": message_data.message_type,
+            "direction": "outgoing",
+            "status": "queued",
+            "created_at": now
+        }, "text", {"phone_number": message_data.phone_number, "message": message_data.message})
+        for message_data in batch.messages
+    ]
+    # message.sent fires per message as the outbound workers deliver them
+    errors = await outbound_queue.enqueue_many(instance, items)
+    
+    results = []
+    for index, ((message_doc, _, _), error) in enumerate(zip(items, errors)):
+        result = {"index": index, "success": error is None, "phone_number": message_doc["phone_number"]}
+        if error is None:
+            result.update(message_id=message_doc["id"], status="queued")
+        else:
+            result["error"] = error
+        results.append(result)
+    failed = sum(1 for error in errors if error)
     
-    return {"success": True, "message_id": message_id}
+    return {
+        "success": failed == 0,
+        "queued": len(results) - failed,
+        "failed": failed,
+        "results": results
+    }
 
 @api_router.get("/v1/instance-status")
 async def api_get_status(instance_id: str, authorization: str = None):
@@ -1728,11 +5387,14 @@ async def api_get_status(instance_id: str, authorization: str = None):
     status = "disconnected"
     phone_number = instance.get("phone_number")
     
-    if instance.get("evolution_instance_name"):
+    if instance.get("evolution_instance_name") and evolution_reconciler.is_fresh():
+        status = instance.get("status", "disconnected")
+    elif instance.get("evolution_instance_name"):
         try:
             state_response = await evolution_client.get_instance_connection_state(instance["evolution_instance_name"])
             if state_response:
-                state = state_response.get("instance", {}).get("state") or state_response.get("state", "close")
+                state = extract_connection_state(state_response)
+                connection_state_cache.set(instance["evolution_instance_name"], state)
                 status = map_evolution_state_to_status(state)
         except:
             pass
@@ -1747,100 +5409,275 @@ async def api_get_status(instance_id: str, authorization: str = None):
 # ===================== EVOLUTION WEBHOOK RECEIVER =====================
 
 @api_router.post("/evolution/webhook")
-async def evolution_webhook_receiver(request: Request, background_tasks: BackgroundTasks):
-    """Receive webhooks from Evolution API"""
+async def evolution_webhook_receiver(request: Request):
+    """Receive webhooks from Evolution API and queue them for processing"""
     try:
         payload = await request.json()
-        logger.info(f"Received Evolution webhook: {json.dumps(payload, default=str)[:500]}")
+    except Exception as e:
+        logger.error(f"Invalid Evolution webhook payload: {e}")
+        return {"status": "error", "message": "invalid JSON payload"}
+    
+    if not isinstance(payload, dict):
+        return {"status": "ignored", "reason": "unexpected payload"}
+    logger.info(f"Received Evolution webhook: {json.dumps(payload, default=str)[:500]}")
+    
+    instance_data = payload.get("instance")
+    instance_name = payload.get("instanceName") or (instance_data.get("instanceName") if isinstance(instance_data, dict) else None)
+    
+    if not instance_name:
+        return {"status": "ignored", "reason": "no instance name"}
+    
+    # Names already known not to be ours are dropped without queueing
+    if instance_name_cache.get(instance_name) is False:
+        return {"status": "ignored", "reason": "instance not found"}
+    
+    try:
+        outcome = await evolution_events.submit(instance_name, payload)
+    except Exception as e:
+        # Inline processing or a failed spill: answer 200 so Evolution does not resend
+        logger.error(f"Error processing Evolution webhook: {e}")
+        return {"status": "error", "message": str(e)}
+    if outcome == "rejected":
+        return JSONResponse(
+            status_code=503,
+            content={"status": "rejected", "reason": "event queue full"},
+            headers={"Retry-After": str(int(INBOUND_RETRY_AFTER_SECONDS))}
+        )
+    return {"status": outcome}
+
+async def insert_new_messages(message_docs: List[dict]) -> List[dict]:
+    """insert_many incoming messages, dropping ones Evolution already delivered; returns those stored"""
+    try:
+        await db.messages.insert_many(message_docs, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        # Redeliveries hit the (instance_id, evolution_message_id) unique index; anything else is real
+        if any(error.get("code") != 11000 for error in errors):
+            raise
+        duplicates = {error["index"] for error in errors}
+        return [doc for index, doc in enumerate(message_docs) if index not in duplicates]
+    return message_docs
+
+async def process_evolution_event(instance_name: str, payload: dict):
+    """Apply one Evolution webhook event (runs on the event pipeline consumers)"""
+    # Find our instance by evolution_instance_name
+    instance = await get_instance_by_evolution_name(instance_name)
+    if not instance:
+        return
+    
+    now = datetime.now(timezone.utc).isoformat()
+    
+    # Handle different event types
+    event = payload.get("event")
+    if event == "connection.update":
+        state = payload.get("data", {}).get("state") or payload.get("state", "close")
+        status = map_evolution_state_to_status(state)
+        connection_state_cache.set(instance_name, state)
+        if state != "connecting":
+            # A QR is only meaningful while pairing
+            await qr_code_cache.pop(instance_name)
         
-        event = payload.get("event")
-        instance_data = payload.get("instance")
-        instance_name = payload.get("instanceName") or (instance_data.get("instanceName") if instance_data else None)
+        # Get phone number if connected
+        phone_number = instance.get("phone_number")
+        if status == "connected":
+            owner = payload.get("data", {}).get("owner")
+            if owner:
+                phone_number = owner.replace("@s.whatsapp.net", "")
         
-        if not instance_name:
-            return {"status": "ignored", "reason": "no instance name"}
+        await db.instances.update_one(
+            {"id": instance["id"]},
+            {"$set": {"status": status, "phone_number": phone_number, "updated_at": now}}
+        )
+        # Keep the cached document in step with what was just written
+        instance.update({"status": status, "phone_number": phone_number})
         
-        # Find our instance by evolution_instance_name
-        instance = await db.instances.find_one({"evolution_instance_name": instance_name}, {"_id": 0})
-        if not instance:
-            return {"status": "ignored", "reason": "instance not found"}
+        await event_broker.publish(instance["user_id"], "connection.update", {
+            "instance_id": instance["id"], "status": status, "phone_number": phone_number
+        })
         
-        now = datetime.now(timezone.utc).isoformat()
+        # Trigger user webhooks
+        spawn_background(trigger_webhooks(
+            instance["id"],
+            f"instance.{status}",
+            {"instance_id": instance["id"], "status": status}
+        ))
+    
+    elif event == "qrcode.updated":
+        data = payload.get("data")
+        data = data if isinstance(data, dict) else {}
+        qrcode = data.get("qrcode") if isinstance(data.get("qrcode"), dict) else data
+        if qrcode.get("base64"):
+            await qr_code_cache.set(instance_name, qrcode["base64"])
+        await event_broker.publish(instance["user_id"], "qrcode.updated", {
+            "instance_id": instance["id"],
+            "qr_code": qrcode.get("base64"),
+            "pairing_code": qrcode.get("pairingCode")
+        })
+    
+    elif event in ["messages.upsert", "messages.update"]:
+        # Handle incoming messages
+        messages = payload.get("data", [])
+        if not isinstance(messages, list):
+            messages = [messages] if messages else []
         
-        # Handle different event types
-        if event == "connection.update":
-            state = payload.get("data", {}).get("state") or payload.get("state", "close")
-            status = map_evolution_state_to_status(state)
+        message_docs = []
+        seen_keys = set()
+        for msg in messages:
+            key = msg.get("key", {})
+            if key.get("fromMe"):
+                continue  # Skip outgoing messages
+            if key.get("id"):
+                if key["id"] in seen_keys:
+                    continue
+                seen_keys.add(key["id"])
             
-            # Get phone number if connected
-            phone_number = instance.get("phone_number")
-            if status == "connected":
-                owner = payload.get("data", {}).get("owner")
-                if owner:
-                    phone_number = owner.replace("@s.whatsapp.net", "")
+            sender = key.get("remoteJid", "").replace("@s.whatsapp.net", "")
+            text = msg.get("message", {}).get("conversation") or msg.get("message", {}).get("extendedTextMessage", {}).get("text", "")
             
-            await db.instances.update_one(
-                {"id": instance["id"]},
-                {"$set": {"status": status, "phone_number": phone_number, "updated_at": now}}
-            )
+            if text:
+                doc = {
+                    "id": str(uuid.uuid4()),
+                    "instance_id": instance["id"],
+                    "phone_number": sender,
+                    "message": text,
+                    "message_type": "text",
+                    "direction": "incoming",
+                    "status": "received",
+                    "created_at": now
+                }
+                if key.get("id"):
+                    doc["evolution_message_id"] = key["id"]
+                message_docs.append(doc)
+        
+        # History syncs can carry hundreds of messages: store and dispatch them as one batch
+        if message_docs:
+            message_docs = await insert_new_messages(message_docs)
+        if message_docs:
+            
+            await event_broker.publish_many(instance["user_id"], [
+                ("message.received", {key: value for key, value in doc.items() if key != "_id"})
+                for doc in message_docs
+            ])
             
             # Trigger user webhooks
-            background_tasks.add_task(
-                trigger_webhooks,
+            spawn_background(trigger_webhooks_batch(
                 instance["id"],
-                f"instance.{status}",
-                {"instance_id": instance["id"], "status": status}
-            )
-        
-        elif event in ["messages.upsert", "messages.update"]:
-            # Handle incoming messages
-            messages = payload.get("data", [])
-            if not isinstance(messages, list):
-                messages = [messages] if messages else []
+                "message.received",
+                [{"message_id": doc["id"], "from": doc["phone_number"], "text": doc["message"]} for doc in message_docs]
+            ))
             
-            for msg in messages:
-                if msg.get("key", {}).get("fromMe"):
-                    continue  # Skip outgoing messages
-                
-                message_id = str(uuid.uuid4())
-                sender = msg.get("key", {}).get("remoteJid", "").replace("@s.whatsapp.net", "")
-                text = msg.get("message", {}).get("conversation") or msg.get("message", {}).get("extendedTextMessage", {}).get("text", "")
-                
-                if text:
-                    message_doc = {
-                        "id": message_id,
-                        "instance_id": instance["id"],
-                        "phone_number": sender,
-                        "message": text,
-                        "message_type": "text",
-                        "direction": "incoming",
-                        "status": "received",
-                        "created_at": now
-                    }
-                    await db.messages.insert_one(message_doc)
-                    
-                    # Trigger user webhooks
-                    background_tasks.add_task(
-                        trigger_webhooks,
-                        instance["id"],
-                        "message.received",
-                        {"message_id": message_id, "from": sender, "text": text}
-                    )
-                    
-                    # Forward to Botpress if configured
-                    if instance.get("botpress_config", {}).get("is_active"):
-                        background_tasks.add_task(
-                            forward_to_botpress,
-                            instance,
-                            sender,
-                            text,
-                            message_id
-                        )
-        
-        return {"status": "processed"}
-    except Exception as e:
-        logger.error(f"Error processing Evolution webhook: {e}")
-        return {"status": "error", "message": str(e)}
+            # Forward to Botpress if configured; the dispatcher keeps each conversation in order
+            if instance.get("botpress_config", {}).get("is_active"):
+                for doc in message_docs:
+                    botpress_dispatcher.enqueue(instance, doc["phone_number"], doc["message"], doc["id"])
+
+# ===================== EVENT STREAM =====================
+
+@api_router.post("/events/ticket")
+async def create_event_ticket(current_user: dict = Depends(get_current_user)):
+    """Single-use ticket for opening the event stream with EventSource.
+    
+    EventSource cannot send an Authorization header, and a JWT in the URL would end
+    up in access and proxy logs; the ticket is short-lived and burned on first use.
+    Fetch a new one before every (re)connect.
+    """
+    ticket = secrets.token_urlsafe(32)
+    await db.event_tickets.insert_one({
+        "_id": hashlib.sha256(ticket.encode()).hexdigest(),
+        "user_id": current_user["id"],
+        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=SSE_TICKET_TTL_SECONDS)
+    })
+    return {"ticket": ticket, "expires_in": int(SSE_TICKET_TTL_SECONDS)}
+
+async def redeem_event_ticket(ticket: str) -> str:
+    """user_id for an unexpired, unused ticket"""
+    doc = await db.event_tickets.find_one_and_delete({
+        "_id": hashlib.sha256(ticket.encode()).hexdigest(),
+        "expires_at": {"$gt": datetime.now(timezone.utc)}
+    })
+    if not doc:
+        raise HTTPException(status_code=401, detail="Invalid or expired ticket")
+    return doc["user_id"]
+
+@api_router.get("/events/stream")
+async def stream_events(request: Request, ticket: Optional[str] = None, authorization: Optional[str] = Header(None)):
+    """Server-Sent Events: connection.update, qrcode.updated and message.received for the user's instances.
+    
+    Authenticate with ?ticket= from POST /events/ticket (EventSource) or a Bearer token header.
+    """
+    if ticket:
+        user_id = await redeem_event_ticket(ticket)
+    elif authorization and authorization.startswith("Bearer "):
+        user_id = (await resolve_token_user(authorization[len("Bearer "):]))["id"]
+    else:
+        raise HTTPException(status_code=401, detail="Ticket or Bearer token required")
+    queue = event_broker.subscribe(user_id)
+    
+    async def events():
+        try:
+            yield f"retry: {int(SSE_HEARTBEAT_SECONDS * 1000)}\n\n"
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ": ping\n\n"
+                    continue
+                if item is None:
+                    break
+                event, data = item
+                yield f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+        finally:
+            event_broker.unsubscribe(user_id, queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ===================== ADMIN ROUTES =====================
+
+async def verify_admin_key(x_admin_key: str = Header(None)):
+    """Guard operational endpoints with the ADMIN_API_KEY"""
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=403, detail="Admin API is disabled")
+    if not x_admin_key or not secrets.compare_digest(x_admin_key, ADMIN_API_KEY):
+        raise HTTPException(status_code=401, detail="Invalid admin key")
+
+@api_router.get("/admin/metrics")
+async def get_admin_metrics(_: None = Depends(verify_admin_key)):
+    """Process-local runtime counters"""
+    return {
+        "evolution_http": evolution_client.stats(),
+        "send_rate_limiter": send_rate_limiter.stats(),
+        "admission": request_limiter.stats(),
+        "idempotency": idempotency_store.stats(),
+        "connection_state_cache": connection_state_cache.stats(),
+        "api_key_cache": api_key_cache.stats(),
+        "user_cache": {**user_cache.stats(), **user_cache_counters},
+        "webhook_subscriptions": webhook_subscriptions.stats(),
+        "instance_cache": instance_name_cache.stats(),
+        "qr_code_cache": qr_code_cache.stats(),
+        "billing_templates": billing_templates.stats(),
+        "campaign_runner": campaign_runner.stats(),
+        "message_scheduler": message_scheduler.stats(),
+        "cache_invalidation": cache_invalidator.stats(),
+        "evolution_reconciler": evolution_reconciler.stats(),
+        "webhook_delivery": webhook_engine.stats(),
+        "evolution_events": evolution_events.stats(),
+        "botpress": botpress_dispatcher.stats(),
+        "audit_log": audit_logger.stats(),
+        "event_stream": event_broker.stats(),
+        "outbound_queue": {**outbound_queue.stats(), "depth": await outbound_queue.depth()}
+    }
+
+@api_router.get("/admin/indexes")
+async def get_admin_indexes(_: None = Depends(verify_admin_key)):
+    """Declared vs. existing indexes, with usage counters"""
+    return await index_manager.report()
 
 # ===================== HEALTH CHECK =====================
 
@@ -1853,9 +5690,8 @@ async def health_check():
     # Check Evolution API connectivity
     evolution_status = "unknown"
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{EVOLUTION_API_URL}/", headers={"apikey": EVOLUTION_API_KEY})
-            evolution_status = "connected" if response.status_code == 200 else f"error: {response.status_code}"
+        response = await evolution_client.ping()
+        evolution_status = "connected" if response.status_code == 200 else f"error: {response.status_code}"
     except Exception as e:
         evolution_status = f"error: {str(e)}"
     
@@ -1865,6 +5701,67 @@ async def health_check():
         "evolution_api": evolution_status
     }
 
+# ===================== ADMISSION CONTROL =====================
+
+def request_api_key(request: Request) -> Optional[str]:
+    """The API key of a public API call (authorization query parameter or header)"""
+    authorization = request.query_params.get("authorization") or request.headers.get("authorization")
+    if authorization and authorization.startswith("Bearer "):
+        return authorization[len("Bearer "):]
+    return None
+
+def request_client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+# Public API endpoints that lead to Evolution sends; only these are shed under Evolution load
+ADMISSION_SHED_PATHS = {
+    "/api/v1/send-message",
+    "/api/v1/send-messages/batch",
+    "/api/v1/billing/send-notification",
+}
+
+def should_shed(request: Request) -> bool:
+    """Whether this worker's Evolution pool is too busy to take on another send request"""
+    return (
+        ADMISSION_MAX_EVOLUTION_IN_FLIGHT > 0
+        and request.method == "POST"
+        and request.url.path in ADMISSION_SHED_PATHS
+        and evolution_client.in_flight >= ADMISSION_MAX_EVOLUTION_IN_FLIGHT
+    )
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    """Per-key and per-IP quotas for the public /api/v1 API, and load shedding for its send endpoints"""
+    if not request.url.path.startswith("/api/v1/"):
+        return await call_next(request)
+    
+    if should_shed(request):
+        request_limiter.record_shed()
+        return JSONResponse(
+            {"detail": "Server is busy, retry later"},
+            status_code=503,
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)}
+        )
+    
+    checks = [("ip", request_client_ip(request), RATE_LIMIT_PER_IP_PER_MINUTE)]
+    api_key = request_api_key(request)
+    if api_key:
+        # Only a digest of the key is kept in memory and Mongo
+        checks.append(("key", hashlib.sha256(api_key.encode()).hexdigest()[:32], RATE_LIMIT_PER_KEY_PER_MINUTE))
+    
+    retry_after = request_limiter.check(checks)
+    if retry_after is not None:
+        return JSONResponse(
+            {"detail": "Rate limit exceeded"},
+            status_code=429,
+            headers={"Retry-After": str(retry_after)}
+        )
+    return await call_next(request)
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -1874,8 +5771,45 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Idempotent-Replayed"],
 )
 
+@app.on_event("startup")
+async def start_services():
+    await index_manager.start()
+    await evolution_client.start()
+    await audit_logger.start()
+    try:
+        await webhook_subscriptions.load()
+    except Exception as e:
+        # trigger_webhooks queries Mongo directly until the index is loaded
+        logger.error(f"Could not load webhook subscriptions: {e}")
+    await cache_invalidator.start()
+    await evolution_reconciler.start()
+    await api_key_cache.start()
+    await request_limiter.start()
+    await webhook_engine.start()
+    await outbound_queue.start()
+    await campaign_runner.start()
+    await message_scheduler.start()
+    await event_broker.start()
+    await evolution_events.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    event_broker.close()
+    await evolution_events.stop()
+    await event_broker.stop()
+    await botpress_dispatcher.stop()
+    await message_scheduler.stop()
+    await campaign_runner.stop()
+    await outbound_queue.stop()
+    await evolution_reconciler.stop()
+    await api_key_cache.stop()
+    await request_limiter.stop()
+    await cache_invalidator.stop()
+    await webhook_engine.stop()
+    await audit_logger.stop()
+    await index_manager.stop()
+    await evolution_client.close()
     client.close()
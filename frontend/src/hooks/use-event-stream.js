@@ -0,0 +1,53 @@
+import { useEffect, useRef } from 'react';
+import axios from 'axios';
+
+const API_URL = `${process.env.REACT_APP_BACKEND_URL}/api`;
+const RECONNECT_DELAY_MS = 5000;
+
+// Subscribes to the server-sent event stream while the component is mounted.
+// `handlers` maps event names (connection.update, qrcode.updated, message.received)
+// to callbacks that receive the parsed event data. Stream tickets are single-use,
+// so reconnects fetch a new ticket here instead of relying on EventSource's own retry.
+export function useEventStream(handlers) {
+  const handlersRef = useRef(handlers);
+  handlersRef.current = handlers;
+
+  useEffect(() => {
+    let source = null;
+    let retryTimer = null;
+    let closed = false;
+
+    const scheduleReconnect = () => {
+      if (!closed) {
+        retryTimer = setTimeout(connect, RECONNECT_DELAY_MS);
+      }
+    };
+
+    const connect = async () => {
+      try {
+        const { data } = await axios.post(`${API_URL}/events/ticket`);
+        if (closed) return;
+        source = new EventSource(`${API_URL}/events/stream?ticket=${encodeURIComponent(data.ticket)}`);
+        Object.keys(handlersRef.current).forEach((event) => {
+          source.addEventListener(event, (message) => {
+            const handler = handlersRef.current[event];
+            if (handler) handler(JSON.parse(message.data));
+          });
+        });
+        source.onerror = () => {
+          source.close();
+          scheduleReconnect();
+        };
+      } catch (error) {
+        scheduleReconnect();
+      }
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(retryTimer);
+      if (source) source.close();
+    };
+  }, []);
+}
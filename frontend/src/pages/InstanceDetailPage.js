@@ -29,6 +29,7 @@ import {
 } from 'lucide-react';
 import axios from 'axios';
 import { toast } from 'sonner';
+import { useEventStream } from '../hooks/use-event-stream';
 import { Button } from '../components/ui/button';
 import { Input } from '../components/ui/input';
 import { Label } from '../components/ui/label';
@@ -90,6 +91,21 @@ const InstanceDetailPage = () => {
     fetchBotpressConfig();
   }, [id]);
 
+  // Status, QR codes and incoming messages are pushed by the server instead of re-fetched
+  useEventStream({
+    'connection.update': (data) => {
+      if (data.instance_id !== id) return;
+      setInstance((current) => current && { ...current, status: data.status, phone_number: data.phone_number });
+      if (data.status === 'connected') setQrCode(null);
+    },
+    'qrcode.updated': (data) => {
+      if (data.instance_id === id && data.qr_code) setQrCode(data.qr_code);
+    },
+    'message.received': (data) => {
+      if (data.instance_id === id) setMessages((current) => [data, ...current]);
+    },
+  });
+
   const fetchBotpressConfig = async () => {
     try {
       const response = await axios.get(`${API_URL}/instances/${id}/botpress`);
@@ -15,6 +15,7 @@ import {
 } from 'lucide-react';
 import axios from 'axios';
 import { toast } from 'sonner';
+import { useEventStream } from '../hooks/use-event-stream';
 import { Button } from '../components/ui/button';
 import { Input } from '../components/ui/input';
 import { Label } from '../components/ui/label';
@@ -61,6 +62,17 @@ const InstancesPage = () => {
     fetchInstances();
   }, []);
 
+  // Keep the list's status badges current from the event stream
+  useEventStream({
+    'connection.update': (data) => {
+      setInstances((current) => current.map((instance) => (
+        instance.id === data.instance_id
+          ? { ...instance, status: data.status, phone_number: data.phone_number }
+          : instance
+      )));
+    },
+  });
+
   const fetchInstances = async () => {
     try {
       const response = await axios.get(`${API_URL}/instances`);
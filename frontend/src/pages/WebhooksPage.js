@@ -47,6 +47,7 @@ const API_URL = `${process.env.REACT_APP_BACKEND_URL}/api`;
 const WEBHOOK_EVENTS = [
   { id: 'message.sent', label: 'Message Sent' },
   { id: 'message.received', label: 'Message Received' },
+  { id: 'message.received.batch', label: 'Message Received (batched)' },
   { id: 'instance.connected', label: 'Instance Connected' },
   { id: 'instance.disconnected', label: 'Instance Disconnected' }
 ];
@@ -0,0 +1,139 @@
+import os
+import sys
+from pathlib import Path
+
+import httpx
+import mongomock
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from pymongo import ReturnDocument
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "telenexus_test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+_find_and_modify = mongomock.collection.Collection._find_and_modify
+
+
+def _find_and_modify_by_id(self, query, projection=None, update=None, upsert=False, sort=None,
+                           return_document=ReturnDocument.BEFORE, *args, **kwargs):
+    # mongomock re-reads the AFTER document with the original filter, which misses it when
+    # the projection drops _id and the update changes a filtered field; pin it by _id
+    if projection is not None and return_document is ReturnDocument.AFTER:
+        target = self.find_one(query, projection={"_id": 1}, sort=sort)
+        if target:
+            query = {"_id": target["_id"]}
+    return _find_and_modify(self, query, projection, update, upsert, sort, return_document, *args, **kwargs)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Point the server module at a fresh in-memory Mongo"""
+    monkeypatch.setattr(mongomock.collection.Collection, "_find_and_modify", _find_and_modify_by_id)
+    database = AsyncMongoMockClient()["telenexus_test"]
+    monkeypatch.setattr(server, "db", database)
+    # Process-local caches would otherwise carry documents over from earlier tests
+    server.instance_name_cache.clear()
+    server.connection_state_cache.clear()
+    server.user_cache.clear()
+    monkeypatch.setattr(server, "send_rate_limiter", server.SendRateLimiter("memory"))
+    monkeypatch.setattr(server, "api_key_cache", server.APIKeyCache(maxsize=100, ttl=60, flush_interval=60))
+    return database
+
+
+API_KEY = "tnx_test_key"
+
+
+@pytest.fixture
+async def api_auth(db):
+    """A user whose API key may send through a connected billing instance "i1"; returns the auth query params"""
+    await db.users.insert_one({"id": "u1", "email": "u1@example.com", "name": "U1"})
+    await db.api_keys.insert_one({
+        "id": "k1", "user_id": "u1", "key": API_KEY, "is_active": True, "permissions": ["send_message"]
+    })
+    await db.instances.insert_one({
+        "id": "i1", "user_id": "u1", "evolution_instance_name": "tnx_bill_i1",
+        "instance_type": "billing", "status": "connected"
+    })
+    server.connection_state_cache.set("tnx_bill_i1", "open")
+    return {"instance_id": "i1", "authorization": f"Bearer {API_KEY}"}
+
+
+@pytest.fixture
+def user_headers(api_auth):
+    """Dashboard (JWT) auth headers for the api_auth user"""
+    return {"Authorization": f"Bearer {server.create_access_token({'sub': 'u1'})}"}
+
+
+@pytest.fixture
+async def client():
+    """HTTP client calling the app in-process"""
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+
+class EvolutionSends(list):
+    """Recorded Evolution sends; set `fail` to an exception to make them raise"""
+    fail = None
+
+
+@pytest.fixture
+def sends(monkeypatch):
+    """Record (instance_name, phone_number, text or title) for Evolution text and button sends"""
+    calls = EvolutionSends()
+
+    async def send_text_message(instance_name, phone_number, message):
+        calls.append((instance_name, phone_number, message))
+        if calls.fail:
+            raise calls.fail
+        return {"key": {"id": "evo"}}
+
+    async def send_button_message(instance_name, phone_number, title, description, footer, buttons):
+        calls.append((instance_name, phone_number, title))
+        if calls.fail:
+            raise calls.fail
+        return {"key": {"id": "evo"}}
+
+    monkeypatch.setattr(server.evolution_client, "send_text_message", send_text_message)
+    monkeypatch.setattr(server.evolution_client, "send_button_message", send_button_message)
+    return calls
+
+
+@pytest.fixture
+def limiter(db, monkeypatch):
+    """A per-process send limiter allowing one billing send per second with a burst of two"""
+    monkeypatch.setattr(server, "SEND_RATE_BILLING_PER_MINUTE", 60)
+    monkeypatch.setattr(server, "SEND_RATE_BILLING_BURST", 2)
+    monkeypatch.setattr(server, "SEND_RATE_BOTPRESS_PER_MINUTE", 0)
+    limiter = server.SendRateLimiter("memory")
+    monkeypatch.setattr(server, "send_rate_limiter", limiter)
+    return limiter
+
+
+@pytest.fixture
+def fired(monkeypatch):
+    """Record (instance_id, event, data) for every webhook event instead of delivering it"""
+    calls = []
+
+    async def record(instance_id, event, data):
+        calls.append((instance_id, event, data))
+
+    def spawn(coro):
+        # The recorder never suspends, so one step runs it to completion
+        try:
+            coro.send(None)
+        except StopIteration:
+            pass
+
+    monkeypatch.setattr(server, "trigger_webhooks", record)
+    monkeypatch.setattr(server, "spawn_background", spawn)
+    return calls
@@ -0,0 +1,88 @@
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+WINDOW = server.SlidingWindowLimiter.WINDOW
+
+
+@pytest.fixture
+def limiter():
+    return server.SlidingWindowLimiter(sync_interval=60)
+
+
+def test_requests_over_the_limit_are_rejected(limiter):
+    checks = [("key", "k1", 3)]
+
+    assert [limiter.check(checks) for _ in range(3)] == [None, None, None]
+    retry_after = limiter.check(checks)
+
+    assert 1 <= retry_after <= WINDOW
+    assert limiter.stats()["limited"] == 1
+
+
+def test_rejected_request_counts_against_no_scope(limiter):
+    limiter.check([("ip", "10.0.0.1", 100), ("key", "k1", 1)])
+
+    assert limiter.check([("ip", "10.0.0.1", 100), ("key", "k1", 1)]) is not None
+    estimated, _ = limiter.estimate("ip", "10.0.0.1", server.time.time())
+    assert estimated == 1
+
+
+def test_identities_are_counted_separately(limiter):
+    limiter.check([("key", "k1", 1)])
+
+    assert limiter.check([("key", "k2", 1)]) is None
+
+
+def test_previous_window_is_weighted_by_its_overlap(limiter):
+    window = 10 * WINDOW
+    limiter._counts[("key", "k1", window - WINDOW)] = [40, 0]
+    limiter._counts[("key", "k1", window)] = [5, 0]
+
+    estimated, remaining = limiter.estimate("key", "k1", window + WINDOW / 4)
+
+    assert estimated == pytest.approx(5 + 40 * 0.75)
+    assert remaining == pytest.approx(WINDOW * 0.75)
+
+
+async def test_sync_shares_counts_between_workers(db, limiter):
+    other = server.SlidingWindowLimiter(sync_interval=60)
+    checks = [("key", "k1", 4)]
+    for _ in range(3):
+        limiter.check(checks)
+    other.check(checks)
+
+    await limiter.sync()
+    await other.sync()
+
+    assert other.check(checks) is not None
+    assert await db.rate_limit_counters.count_documents({}) == 1
+
+
+async def request(method, path):
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.request(method, path)
+
+
+@pytest.fixture
+def busy_evolution(db, monkeypatch):
+    monkeypatch.setattr(server, "request_limiter", server.SlidingWindowLimiter(sync_interval=60))
+    monkeypatch.setattr(server.evolution_client, "_in_flight", server.ADMISSION_MAX_EVOLUTION_IN_FLIGHT)
+
+
+async def test_send_endpoints_are_shed_while_evolution_is_busy(busy_evolution):
+    response = await request("POST", "/api/v1/send-message?instance_id=i1")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(server.ADMISSION_RETRY_AFTER_SECONDS)
+
+
+async def test_read_only_endpoints_are_not_shed(busy_evolution):
+    response = await request("GET", "/api/v1/instance-status?instance_id=i1")
+
+    # Reaches the endpoint, which wants an API key
+    assert response.status_code == 401
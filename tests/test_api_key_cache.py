@@ -0,0 +1,80 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+API_KEY = "tnx_test_key"  # the api_auth fixture's key
+
+
+async def test_verified_key_is_served_from_the_cache(api_auth, db):
+    await server.verify_api_key(API_KEY)
+    # Mongo is not consulted again while the entry is live
+    await db.api_keys.delete_many({})
+
+    user, key_doc = await server.verify_api_key(API_KEY)
+
+    assert (user["id"], key_doc["id"]) == ("u1", "k1")
+    assert server.api_key_cache.stats()["hits"] == 1
+
+
+async def test_revoked_key_is_rejected_at_once(api_auth, client, user_headers):
+    await server.verify_api_key(API_KEY)
+
+    response = await client.delete("/api/api-keys/k1", headers=user_headers)
+
+    assert response.status_code == 200
+    with pytest.raises(HTTPException) as exc:
+        await server.verify_api_key(API_KEY)
+    assert exc.value.status_code == 401
+
+
+async def test_revocation_on_another_worker_clears_the_cache(api_auth, db, monkeypatch):
+    monkeypatch.setattr(server.cache_invalidator, "_versions", {})
+    await server.cache_invalidator.poll(run_handlers=False)
+    await server.verify_api_key(API_KEY)
+
+    # Another worker revokes the key and bumps the shared version
+    await db.api_keys.update_one({"id": "k1"}, {"$set": {"is_active": False}})
+    await server.CacheInvalidator(60).bump("api_keys")
+    await server.cache_invalidator.poll()
+
+    with pytest.raises(HTTPException):
+        await server.verify_api_key(API_KEY)
+
+
+async def test_last_used_is_written_behind_in_one_flush(api_auth, db, monkeypatch):
+    bulk_writes = []
+    bulk_write = type(db.api_keys).bulk_write
+
+    async def record_bulk_write(self, requests, *args, **kwargs):
+        bulk_writes.append(len(requests))
+        return await bulk_write(self, requests, *args, **kwargs)
+
+    monkeypatch.setattr(type(db.api_keys), "bulk_write", record_bulk_write)
+    for _ in range(3):
+        await server.verify_api_key(API_KEY)
+    assert "last_used" not in await db.api_keys.find_one({"id": "k1"})
+
+    await server.api_key_cache.flush()
+
+    assert bulk_writes == [1]
+    assert (await db.api_keys.find_one({"id": "k1"}))["last_used"] is not None
+    assert server.api_key_cache.stats()["pending_last_used"] == 0
+
+
+async def test_failed_flush_keeps_last_used_for_the_next_one(api_auth, db, monkeypatch):
+    await server.verify_api_key(API_KEY)
+    bulk_write = type(db.api_keys).bulk_write
+
+    async def broken(self, *args, **kwargs):
+        raise RuntimeError("mongo down")
+
+    monkeypatch.setattr(type(db.api_keys), "bulk_write", broken)
+    await server.api_key_cache.flush()
+    assert server.api_key_cache.stats()["pending_last_used"] == 1
+
+    monkeypatch.setattr(type(db.api_keys), "bulk_write", bulk_write)
+    await server.api_key_cache.flush()
+    assert (await db.api_keys.find_one({"id": "k1"}))["last_used"] is not None
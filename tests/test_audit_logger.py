@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def entry(index):
+    return {"id": f"l{index}", "user_id": "u1", "action": "message.sent", "created_at": f"2026-01-01T00:00:{index:02d}"}
+
+
+async def logged(db, count, timeout=1.0):
+    """Wait until db.logs holds count entries"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while await db.logs.count_documents({}) < count and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    return await db.logs.count_documents({})
+
+
+async def test_full_batch_is_flushed_without_waiting_for_the_interval(db):
+    audit = server.AuditLogger(maxsize=100, flush_batch=3, flush_interval=60)
+    await audit.start()
+    try:
+        for index in range(2):
+            audit.append(entry(index))
+        await asyncio.sleep(0.05)
+        assert await db.logs.count_documents({}) == 0
+
+        audit.append(entry(2))
+        assert await logged(db, 3) == 3
+    finally:
+        await audit.stop()
+    assert audit.stats()["flushes"] == 1
+
+
+async def test_partial_batch_is_flushed_on_the_interval(db):
+    audit = server.AuditLogger(maxsize=100, flush_batch=50, flush_interval=0.05)
+    await audit.start()
+    try:
+        audit.append(entry(0))
+        assert await logged(db, 1) == 1
+    finally:
+        await audit.stop()
+
+
+async def test_stop_flushes_what_is_left(db):
+    audit = server.AuditLogger(maxsize=100, flush_batch=50, flush_interval=60)
+    await audit.start()
+    for index in range(5):
+        audit.append(entry(index))
+
+    await audit.stop()
+
+    assert [doc["id"] async for doc in db.logs.find({}).sort("created_at", 1)] == [f"l{index}" for index in range(5)]
+    assert audit.stats()["pending"] == 0
+
+
+async def test_failed_flush_keeps_the_entries_in_order(db, monkeypatch):
+    audit = server.AuditLogger(maxsize=100, flush_batch=2, flush_interval=60)
+    for index in range(3):
+        audit.append(entry(index))
+    insert_many = type(db.logs).insert_many
+
+    async def broken(self, *args, **kwargs):
+        raise RuntimeError("mongo down")
+
+    monkeypatch.setattr(type(db.logs), "insert_many", broken)
+    await audit.flush()
+    assert audit.stats()["pending"] == 3
+
+    monkeypatch.setattr(type(db.logs), "insert_many", insert_many)
+    await audit.flush()
+    assert [doc["id"] async for doc in db.logs.find({})] == ["l0", "l1", "l2"]
+
+
+def test_full_ring_drops_the_oldest_entry():
+    audit = server.AuditLogger(maxsize=2, flush_batch=50, flush_interval=60)
+    for index in range(3):
+        audit.append(entry(index))
+
+    assert [item["id"] for item in audit._buffer] == ["l1", "l2"]
+    assert audit.stats()["dropped"] == 1
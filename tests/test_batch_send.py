@@ -0,0 +1,44 @@
+import httpx
+import pytest
+from pymongo.errors import BulkWriteError
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def post_batch(params, count):
+    messages = [{"phone_number": f"2547000000{i:02d}", "message": f"hello {i}"} for i in range(count)]
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.post("/api/v1/send-messages/batch", params=params, json={"messages": messages})
+
+
+async def test_batch_larger_than_the_burst_is_fully_queued(api_auth, limiter, db):
+    response = await post_batch(api_auth, 12)
+
+    assert response.status_code == 202
+    body = response.json()
+    assert body["success"] is True
+    assert (body["queued"], body["failed"]) == (12, 0)
+    assert [result["index"] for result in body["results"]] == list(range(12))
+    assert await db.outbound_jobs.count_documents({"status": "queued"}) == 12
+    assert await db.messages.count_documents({"status": "queued"}) == 12
+
+
+async def test_items_whose_job_was_not_written_are_reported_failed(api_auth, db, monkeypatch):
+    original = type(db.outbound_jobs).insert_many
+
+    async def insert_many(self, documents, *args, **kwargs):
+        if self.name != "outbound_jobs":
+            return await original(self, documents, *args, **kwargs)
+        raise BulkWriteError({"writeErrors": [{"index": 1, "errmsg": "duplicate key"}]})
+
+    monkeypatch.setattr(type(db.outbound_jobs), "insert_many", insert_many)
+    response = await post_batch(api_auth, 3)
+
+    body = response.json()
+    assert (body["queued"], body["failed"]) == (2, 1)
+    assert body["results"][1] == {"index": 1, "success": False, "phone_number": "254700000001", "error": "duplicate key"}
+    # The failed item's message is not left behind as "queued"
+    assert await db.messages.count_documents({"phone_number": "254700000001"}) == 0
@@ -0,0 +1,101 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+INSTANCE = {"id": "i1", "user_id": "u1", "evolution_instance_name": "tnx_bill_i1", "instance_type": "billing"}
+
+
+@pytest.fixture
+def templates(db, monkeypatch):
+    registry = server.BillingTemplateRegistry()
+    monkeypatch.setattr(server, "billing_templates", registry)
+    return registry
+
+
+def notification(**fields):
+    return server.BillingNotificationSend(**{
+        "phone_number": "254700000001", "customer_name": "Jane", "amount": 1250.5,
+        "invoice_id": "INV-1", "due_date": "2026-02-01", **fields
+    })
+
+
+async def build(billing_data):
+    return await server.build_billing_message("u1", INSTANCE, billing_data, "m1", "sent", "2026-01-01T00:00:00+00:00")
+
+
+async def test_english_is_the_default(templates):
+    template, message_doc = await build(notification())
+
+    assert template["title"] == "Payment Due Reminder"
+    assert "KES 1,250.50 is due" in template["description"]
+    assert "Due Date: 2026-02-01" in template["description"]
+    assert [button["text"] for button in template["buttons"]] == ["PayNow", "Invoice"]
+    assert message_doc["billing_data"]["locale"] == "en"
+
+
+async def test_swahili_text_and_buttons(templates):
+    template, message_doc = await build(notification(locale="sw"))
+
+    assert template["title"] == "Kikumbusho cha Malipo"
+    assert template["description"].startswith("Mpendwa Jane,")
+    assert "Tarehe ya Mwisho: 2026-02-01" in template["description"]
+    assert [button["text"] for button in template["buttons"]] == ["PayNow", "Ankara"]
+    assert message_doc["message"].startswith("Kikumbusho cha Malipo\nMpendwa Jane,")
+
+
+async def test_swahili_confirmation_has_only_the_invoice_button(templates):
+    template, _ = await build(notification(locale="sw", message_type="confirmation"))
+
+    assert template["title"] == "Malipo Yamepokelewa"
+    assert template["buttons"] == [{"id": "invoice_INV-1", "text": "Angalia Ankara"}]
+
+
+async def test_missing_due_date_drops_the_due_line(templates):
+    template, _ = await build(notification(locale="sw", due_date=None))
+
+    assert "Tarehe ya Mwisho" not in template["description"]
+
+
+async def test_unknown_locale_falls_back_to_english(templates):
+    template, _ = await build(notification(locale="fr"))
+
+    assert template["title"] == "Payment Due Reminder"
+
+
+async def test_instance_override_wins_over_the_user_override(templates, db):
+    await db.billing_templates.insert_many([
+        {"id": "t1", "user_id": "u1", "instance_id": None, "locale": "sw", "message_type": "payment_reminder",
+         "title": "Kwa wateja wote", "footer": "Asante"},
+        {"id": "t2", "user_id": "u1", "instance_id": "i1", "locale": "sw", "message_type": "payment_reminder",
+         "title": "Kwa {customer_name}"},
+    ])
+
+    template, _ = await build(notification(locale="sw"))
+
+    assert (template["title"], template["footer"]) == ("Kwa Jane", "Asante")
+
+
+async def test_both_billing_endpoints_share_the_compiled_template(templates, api_auth, client, user_headers, sends, db, monkeypatch):
+    lookups = []
+    find = type(db.billing_templates).find
+
+    def record_find(self, *args, **kwargs):
+        if self.name == "billing_templates":
+            lookups.append(args[0]["locale"])
+        return find(self, *args, **kwargs)
+
+    monkeypatch.setattr(type(db.billing_templates), "find", record_find)
+    body = {"phone_number": "254700000001", "customer_name": "Jane", "amount": 100, "invoice_id": "INV-1", "locale": "sw"}
+
+    dashboard = await client.post("/api/instances/i1/messages/send-billing", headers=user_headers, json=body)
+    api = await client.post("/api/v1/billing/send-notification", params=api_auth, json={**body, "invoice_id": "INV-2"})
+
+    assert dashboard.status_code == 200
+    assert api.status_code == 202
+    assert lookups == ["sw"]
+    assert templates.stats()["cache"]["hits"] == 1
+    assert templates.stats()["renders"] == 2
+    job = await db.outbound_jobs.find_one({"message_id": api.json()["message_id"]})
+    assert job["payload"]["title"] == sends[0][2] == "Kikumbusho cha Malipo"
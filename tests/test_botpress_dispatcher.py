@@ -0,0 +1,117 @@
+import asyncio
+
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+RealClient = httpx.AsyncClient
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """httpx clients opened by BotpressDispatcher, all answering 200 through a mock transport"""
+    clients = []
+
+    def open_client(**kwargs):
+        client = RealClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json={})), **kwargs)
+        clients.append(client)
+        return client
+
+    monkeypatch.setattr(server.httpx, "AsyncClient", open_client)
+    return clients
+
+
+@pytest.fixture
+def forwarded(monkeypatch):
+    """(conversation, message) in the order they reach Botpress; the first message of each is slow"""
+    calls = []
+
+    async def forward(instance, phone_number, message, message_id):
+        if message == "boom":
+            raise RuntimeError("bad payload")
+        await asyncio.sleep(0.05 if message.endswith("1") else 0)
+        calls.append((phone_number, message))
+
+    monkeypatch.setattr(server, "forward_to_botpress", forward)
+    return calls
+
+
+async def drained(dispatcher):
+    while dispatcher._workers:
+        await asyncio.gather(*dispatcher._workers.values())
+
+
+async def test_conversation_messages_reach_botpress_in_order(forwarded):
+    dispatcher = server.BotpressDispatcher()
+    instance = {"id": "i1"}
+    for message in ("a1", "a2", "a3"):
+        dispatcher.enqueue(instance, "254700000001", message, message)
+    dispatcher.enqueue(instance, "254700000002", "b1", "b1")
+
+    await drained(dispatcher)
+
+    assert [message for phone, message in forwarded if phone == "254700000001"] == ["a1", "a2", "a3"]
+    # The other conversation was not held up behind the slow first message
+    assert forwarded.index(("254700000002", "b1")) < forwarded.index(("254700000001", "a2"))
+
+
+async def test_drained_conversation_is_dropped(forwarded):
+    dispatcher = server.BotpressDispatcher()
+    dispatcher.enqueue({"id": "i1"}, "254700000001", "boom", "m1")
+    dispatcher.enqueue({"id": "i1"}, "254700000001", "a2", "m2")
+
+    await drained(dispatcher)
+
+    assert forwarded == [("254700000001", "a2")]
+    assert dispatcher._conversations == {}
+    assert dispatcher.stats()["drain_errors"] == 1
+
+
+async def test_least_recently_used_client_is_closed_past_the_host_limit(opened, monkeypatch):
+    monkeypatch.setattr(server, "BOTPRESS_MAX_HOSTS", 2)
+    dispatcher = server.BotpressDispatcher()
+
+    for host in ("a", "b", "a", "c"):
+        await dispatcher.post("i1", f"https://{host}.example/hook", None, {})
+
+    assert list(dispatcher._clients) == ["https://a.example", "https://c.example"]
+    assert [client.is_closed for client in opened] == [False, True, False]
+    assert dispatcher.stats()["clients_evicted"] == 1
+    await dispatcher.stop()
+    assert all(client.is_closed for client in opened)
+
+
+async def test_idle_clients_are_closed(opened, monkeypatch):
+    dispatcher = server.BotpressDispatcher()
+    await dispatcher.post("i1", "https://a.example/hook", None, {})
+    monkeypatch.setattr(server, "BOTPRESS_CLIENT_IDLE_SECONDS", 0)
+
+    await dispatcher.post("i1", "https://b.example/hook", None, {})
+
+    assert dispatcher._clients == {}
+    assert all(client.is_closed for client in opened)
+
+
+async def test_client_in_use_is_not_closed(opened, monkeypatch):
+    monkeypatch.setattr(server, "BOTPRESS_MAX_HOSTS", 1)
+    dispatcher = server.BotpressDispatcher()
+    release = asyncio.Event()
+
+    async def slow(request):
+        await release.wait()
+        return httpx.Response(200)
+
+    slow_client = RealClient(transport=httpx.MockTransport(slow))
+    dispatcher._clients["https://slow.example"] = slow_client
+    dispatcher._last_used["https://slow.example"] = server.time.monotonic()
+    pending = asyncio.create_task(dispatcher.post("i1", "https://slow.example/hook", None, {}))
+    await asyncio.sleep(0)
+
+    await dispatcher.post("i1", "https://a.example/hook", None, {})
+    assert not slow_client.is_closed
+    release.set()
+    assert (await pending).status_code == 200
+    await dispatcher.stop()
@@ -0,0 +1,190 @@
+import io
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import UploadFile
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+INSTANCE = {"id": "i1", "user_id": "u1", "evolution_instance_name": "tnx_bill_i1", "instance_type": "billing"}
+CAMPAIGN = {"id": "c1", "user_id": "u1", "instance_id": "i1", "status": "running",
+            "queued": 0, "sent": 0, "failed": 0}
+
+
+class Enqueued(list):
+    """Recorded outbound_queue.enqueue calls; `on_enqueue` runs before each is recorded"""
+    on_enqueue = None
+
+
+@pytest.fixture
+async def campaign(db, monkeypatch):
+    await db.instances.insert_one(dict(INSTANCE))
+    await db.campaigns.insert_one(dict(CAMPAIGN))
+    await db.campaign_rows.insert_many([
+        {"id": f"r{seq}", "campaign_id": "c1", "seq": seq, "status": "pending", "error": None,
+         "phone_number": f"25470000000{seq}", "customer_name": "Jane", "amount": 100.0,
+         "invoice_id": f"INV-{seq}"}
+        for seq in (1, 2)
+    ])
+    server.connection_state_cache.set("tnx_bill_i1", "open")
+    return server.CampaignRunner()
+
+
+@pytest.fixture
+def enqueued(monkeypatch):
+    calls = Enqueued()
+
+    async def enqueue(instance, message_doc, kind, payload, campaign_row=None):
+        if calls.on_enqueue:
+            await calls.on_enqueue(campaign_row)
+        calls.append(campaign_row["id"])
+        return server.outbound_queue.build_job(instance, message_doc, kind, payload, campaign_row)
+
+    monkeypatch.setattr(server.outbound_queue, "enqueue", enqueue)
+    return calls
+
+
+async def test_tick_queues_pending_rows(campaign, enqueued, db):
+    await campaign.tick(dict(CAMPAIGN))
+
+    assert enqueued == ["r1", "r2"]
+    assert {row["status"] async for row in db.campaign_rows.find({})} == {"queued"}
+    assert (await db.campaigns.find_one({"id": "c1"}))["queued"] == 2
+
+
+async def test_tick_skips_rows_claimed_elsewhere(campaign, enqueued, db):
+    async def other_leader_takes_r2(row):
+        await db.campaign_rows.update_one({"id": "r2"}, {"$set": {"status": "queued"}})
+
+    enqueued.on_enqueue = other_leader_takes_r2
+    await campaign.tick(dict(CAMPAIGN))
+
+    assert enqueued == ["r1"]
+    assert (await db.campaigns.find_one({"id": "c1"}))["queued"] == 1
+
+
+async def test_tick_releases_row_when_enqueue_fails(campaign, enqueued, db):
+    async def fail_on_r2(row):
+        if row["id"] == "r2":
+            raise RuntimeError("mongo down")
+
+    enqueued.on_enqueue = fail_on_r2
+    with pytest.raises(RuntimeError):
+        await campaign.tick(dict(CAMPAIGN))
+
+    assert enqueued == ["r1"]
+    row = await db.campaign_rows.find_one({"id": "r2"})
+    assert row["status"] == "pending" and row["message_id"] is None
+    assert (await db.campaigns.find_one({"id": "c1"}))["queued"] == 1
+
+
+async def test_tick_waits_for_claimed_rows_before_completing(campaign, enqueued, db):
+    await db.campaign_rows.update_many({}, {"$set": {"status": "queued"}})
+
+    await campaign.tick(dict(CAMPAIGN))
+    assert (await db.campaigns.find_one({"id": "c1"}))["status"] == "running"
+
+    await db.campaign_rows.update_many({}, {"$set": {"status": "sent"}})
+    await campaign.tick(dict(CAMPAIGN))
+    assert (await db.campaigns.find_one({"id": "c1"}))["status"] == "completed"
+
+
+async def test_tick_clears_the_claim_once_the_job_exists(campaign, enqueued, db):
+    claims = []
+
+    async def record_claim(row):
+        claims.append((await db.campaign_rows.find_one({"id": row["id"]})).get("claim_expires_at"))
+
+    enqueued.on_enqueue = record_claim
+    await campaign.tick(dict(CAMPAIGN))
+
+    assert all(claims) and len(claims) == 2
+    assert await db.campaign_rows.count_documents({"claim_expires_at": {"$exists": True}}) == 0
+
+
+async def test_cancel_during_a_tick_withdraws_the_rows_it_queued(campaign, db, monkeypatch):
+    enqueue = server.outbound_queue.enqueue
+
+    async def enqueue_then_cancel(*args, **kwargs):
+        job = await enqueue(*args, **kwargs)
+        # The cancel endpoint swept the queue just before this job was inserted
+        await db.campaigns.update_one({"id": "c1"}, {"$set": {"status": "cancelled"}})
+        return job
+
+    monkeypatch.setattr(server.outbound_queue, "enqueue", enqueue_then_cancel)
+    await campaign.tick(dict(CAMPAIGN))
+
+    assert {job["status"] async for job in db.outbound_jobs.find({})} == {"cancelled"}
+    assert {row["status"] async for row in db.campaign_rows.find({})} == {"cancelled"}
+    assert {message["status"] async for message in db.messages.find({})} == {"cancelled"}
+    stored = await db.campaigns.find_one({"id": "c1"})
+    assert (stored["queued"], stored["cancelled"]) == (0, 2)
+
+
+async def test_recover_hands_back_rows_claimed_by_a_dead_leader(campaign, db):
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await db.campaign_rows.update_one(
+        {"id": "r1"}, {"$set": {"status": "queued", "message_id": "m1", "claim_expires_at": past}}
+    )
+    await db.campaign_rows.update_one(
+        {"id": "r2"}, {"$set": {"status": "queued", "message_id": "m2", "claim_expires_at": past}}
+    )
+    # The leader stored r1's message but died before its job; r2's job made it
+    await db.messages.insert_one({"id": "m1", "status": "queued"})
+    await db.outbound_jobs.insert_one({"id": "j2", "campaign_row_id": "r2", "status": "queued"})
+
+    await campaign.recover()
+
+    r1 = await db.campaign_rows.find_one({"id": "r1"})
+    assert (r1["status"], r1["message_id"], "claim_expires_at" in r1) == ("pending", None, False)
+    assert await db.messages.count_documents({}) == 0
+    r2 = await db.campaign_rows.find_one({"id": "r2"})
+    assert (r2["status"], r2["message_id"], "claim_expires_at" in r2) == ("queued", "m2", False)
+    assert campaign.stats()["rows_reclaimed"] == 1
+
+
+async def test_recover_cancels_claimed_rows_of_a_cancelled_campaign(campaign, db):
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await db.campaigns.update_one({"id": "c1"}, {"$set": {"status": "cancelled"}})
+    await db.campaign_rows.update_one(
+        {"id": "r1"}, {"$set": {"status": "queued", "message_id": "m1", "claim_expires_at": past}}
+    )
+
+    await campaign.recover()
+
+    assert (await db.campaign_rows.find_one({"id": "r1"}))["status"] == "cancelled"
+    assert (await db.campaigns.find_one({"id": "c1"}))["cancelled"] == 1
+
+
+async def test_recover_fails_imports_that_stopped_making_progress(db):
+    now = datetime.now(timezone.utc)
+    await db.campaigns.insert_many([
+        {"id": "dead", "status": "importing",
+         "updated_at": (now - timedelta(seconds=server.CAMPAIGN_IMPORT_STALE_SECONDS + 1)).isoformat()},
+        {"id": "busy", "status": "importing", "updated_at": now.isoformat()},
+    ])
+
+    await server.CampaignRunner().recover()
+
+    dead = await db.campaigns.find_one({"id": "dead"})
+    assert (dead["status"], dead["error"]) == ("failed", "Import was interrupted")
+    assert (await db.campaigns.find_one({"id": "busy"}))["status"] == "importing"
+
+
+async def test_import_validates_rows_in_batches(db, monkeypatch):
+    monkeypatch.setattr(server, "CAMPAIGN_IMPORT_BATCH_SIZE", 2)
+    upload = UploadFile(io.BytesIO(
+        b"phone_number,customer_name,amount,invoice_id\n"
+        b"254700000001,Jane,100,INV-1\n"
+        b"254700000002,John,oops,INV-2\n"
+        b"254700000003,Mary,300,INV-3\n"
+    ), filename="rows.csv")
+
+    counts = await server.import_campaign_rows({"id": "c1"}, upload, "csv")
+
+    assert counts == {"total": 3, "invalid": 1}
+    rows = await db.campaign_rows.find({}).sort("seq", 1).to_list(None)
+    assert [row["status"] for row in rows] == ["pending", "invalid", "pending"]
+    assert rows[1]["error"].startswith("amount")
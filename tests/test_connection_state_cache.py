@@ -0,0 +1,54 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def state_calls(monkeypatch):
+    """Instance names Evolution was asked about; it always answers "connecting" """
+    calls = []
+
+    async def get_instance_connection_state(instance_name):
+        calls.append(instance_name)
+        return {"instance": {"state": "connecting"}}
+
+    monkeypatch.setattr(server.evolution_client, "get_instance_connection_state", get_instance_connection_state)
+    return calls
+
+
+async def test_cached_state_is_served_without_evolution(db, state_calls):
+    server.connection_state_cache.set("tnx_a", "open")
+
+    assert await server.get_cached_connection_state("tnx_a") == "open"
+    assert state_calls == []
+
+
+async def test_miss_asks_evolution_once(db, state_calls):
+    assert await server.get_cached_connection_state("tnx_a") == "connecting"
+    assert await server.get_cached_connection_state("tnx_a") == "connecting"
+
+    assert state_calls == ["tnx_a"]
+
+
+async def test_expired_state_is_fetched_again(db, state_calls):
+    server.connection_state_cache.set("tnx_a", "open", ttl=0)
+
+    assert await server.get_cached_connection_state("tnx_a") == "connecting"
+    assert state_calls == ["tnx_a"]
+
+
+async def test_connection_update_webhook_refreshes_the_cache(db, fired, state_calls, monkeypatch):
+    monkeypatch.setattr(server, "event_broker", server.EventBroker(10, shared=False))
+    await db.instances.insert_one(
+        {"id": "a", "user_id": "u1", "evolution_instance_name": "tnx_a", "status": "connecting", "phone_number": None}
+    )
+    server.connection_state_cache.set("tnx_a", "connecting")
+
+    await server.process_evolution_event("tnx_a", {"event": "connection.update", "data": {"state": "open"}})
+    assert await server.get_cached_connection_state("tnx_a") == "open"
+
+    await server.process_evolution_event("tnx_a", {"event": "connection.update", "data": {"state": "close"}})
+    assert await server.get_cached_connection_state("tnx_a") == "close"
+    assert state_calls == []
@@ -0,0 +1,131 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_events_reach_streams_on_other_workers(db):
+    receiver = server.EventBroker(10, shared=True)
+    publisher = server.EventBroker(10, shared=True)
+    await receiver.start()
+    await publisher.start()
+    try:
+        queue = receiver.subscribe("u1")
+        await publisher.publish_many("u1", [("connection.update", {"status": "connected"}), ("qrcode.updated", {"n": 1})])
+
+        first = await asyncio.wait_for(queue.get(), timeout=3)
+        second = await asyncio.wait_for(queue.get(), timeout=3)
+    finally:
+        await receiver.stop()
+        await publisher.stop()
+
+    assert first == ("connection.update", {"status": "connected"})
+    assert second == ("qrcode.updated", {"n": 1})
+
+
+async def test_local_delivery_without_shared_stream(db):
+    broker = server.EventBroker(10, shared=False)
+    await broker.start()
+    queue = broker.subscribe("u1")
+    other = broker.subscribe("u2")
+
+    await broker.publish("u1", "connection.update", {"status": "connecting"})
+
+    assert queue.get_nowait() == ("connection.update", {"status": "connecting"})
+    assert other.empty()
+
+
+async def open_stream(query):
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.get(f"/api/events/stream{query}")
+
+
+async def test_token_in_query_string_is_rejected(db):
+    token = server.create_access_token({"sub": "u1"})
+    response = await open_stream(f"?token={token}")
+    assert response.status_code == 401
+
+
+async def test_ticket_is_single_use(db):
+    ticket = (await server.create_event_ticket({"id": "u1"}))["ticket"]
+
+    assert await server.redeem_event_ticket(ticket) == "u1"
+    with pytest.raises(server.HTTPException):
+        await server.redeem_event_ticket(ticket)
+
+
+async def test_expired_ticket_is_rejected(db):
+    ticket = (await server.create_event_ticket({"id": "u1"}))["ticket"]
+    await db.event_tickets.update_many({}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+
+    with pytest.raises(server.HTTPException):
+        await server.redeem_event_ticket(ticket)
+
+
+async def test_tail_delivers_an_event_inserted_late_with_a_lower_seq(db):
+    broker = server.EventBroker(10, shared=True)
+    await broker.start()
+    try:
+        queue = broker.subscribe("u1")
+        # Another worker took seq 1 first but inserted it after seq 2
+        await db.event_stream.insert_one({"seq": 2, "user_id": "u1", "event": "message.received", "data": {"n": 2}})
+        second = await asyncio.wait_for(queue.get(), timeout=3)
+        await db.event_stream.insert_one({"seq": 1, "user_id": "u1", "event": "message.received", "data": {"n": 1}})
+        first = await asyncio.wait_for(queue.get(), timeout=5)
+    finally:
+        await broker.stop()
+
+    assert (second, first) == (("message.received", {"n": 2}), ("message.received", {"n": 1}))
+    assert queue.empty()
+
+
+def test_tail_delivers_each_seq_once():
+    broker = server.EventBroker(10, shared=True)
+
+    assert [broker._accept(seq) for seq in (1, 3, 3, 2, 2, 1)] == [True, True, False, True, False, False]
+    assert broker._resume_filter() == {"seq": {"$gt": 3}}
+
+
+def test_skipped_seqs_are_given_up_after_the_reorder_window(monkeypatch):
+    broker = server.EventBroker(10, shared=True)
+    broker._accept(3)
+
+    assert broker._resume_filter() == {"$or": [{"seq": {"$gt": 3}}, {"seq": {"$in": [1, 2]}}]}
+    monkeypatch.setattr(server.EventBroker, "REORDER_SECONDS", 0)
+    assert broker._resume_filter() == {"seq": {"$gt": 3}}
+
+
+class Disconnected:
+    """Minimal Request stand-in for the stream generator"""
+
+    async def is_disconnected(self):
+        return True
+
+
+async def test_ticket_opens_a_stream_of_the_users_events(client, user_headers, monkeypatch):
+    broker = server.EventBroker(10, shared=False)
+    monkeypatch.setattr(server, "event_broker", broker)
+    ticket = (await client.post("/api/events/ticket", headers=user_headers)).json()["ticket"]
+
+    response = await server.stream_events(Disconnected(), ticket=ticket)
+    chunks = response.body_iterator
+    assert (await chunks.__anext__()).startswith("retry: ")
+    await broker.publish("u1", "connection.update", {"instance_id": "i1", "status": "connected"})
+    await broker.publish("u2", "connection.update", {"instance_id": "i9", "status": "connected"})
+    event = await chunks.__anext__()
+    broker.close()
+    rest = [chunk async for chunk in chunks]
+
+    assert response.media_type == "text/event-stream"
+    assert event == 'event: connection.update\ndata: {"instance_id": "i1", "status": "connected"}\n\n'
+    assert rest == []
+    assert broker.stats()["streams"] == 0
+    # The ticket was burned by the first connection
+    with pytest.raises(server.HTTPException):
+        await server.stream_events(Disconnected(), ticket=ticket)
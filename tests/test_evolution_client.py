@@ -0,0 +1,59 @@
+import asyncio
+
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """httpx clients opened by EvolutionAPIClient, all answering 200 through a mock transport"""
+    clients = []
+    real_client = httpx.AsyncClient
+
+    def open_client(**kwargs):
+        kwargs.pop("http2", None)
+        client = real_client(transport=httpx.MockTransport(lambda request: httpx.Response(200, json={})), **kwargs)
+        clients.append(client)
+        return client
+
+    monkeypatch.setattr(server.httpx, "AsyncClient", open_client)
+    return clients
+
+
+async def test_concurrent_first_requests_share_one_client(opened):
+    evolution = server.EvolutionAPIClient()
+
+    responses = await asyncio.gather(*(evolution.ping() for _ in range(10)))
+    await evolution.ping()
+
+    assert [response.status_code for response in responses] == [200] * 10
+    assert len(opened) == 1
+    assert evolution.stats()["requests"] == 11
+    await evolution.close()
+
+
+async def test_start_is_idempotent_and_close_closes_the_client(opened):
+    evolution = server.EvolutionAPIClient()
+
+    await asyncio.gather(evolution.start(), evolution.start())
+    await evolution.close()
+
+    assert len(opened) == 1
+    assert opened[0].is_closed
+    assert evolution.in_flight == 0
+
+
+async def test_requests_after_close_open_a_new_client(opened):
+    evolution = server.EvolutionAPIClient()
+    await evolution.ping()
+    await evolution.close()
+
+    await evolution.ping()
+
+    assert len(opened) == 2
+    assert opened[0].is_closed and not opened[1].is_closed
+    await evolution.close()
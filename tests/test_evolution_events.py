@@ -0,0 +1,72 @@
+import asyncio
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def post_event(payload):
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.post("/api/evolution/webhook", json=payload)
+
+
+async def test_inline_processing_errors_are_acknowledged(db, monkeypatch):
+    async def broken(instance_name, payload):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(server, "process_evolution_event", broken)
+    monkeypatch.setattr(server, "evolution_events", server.EvolutionEventPipeline(0, 10))
+
+    response = await post_event({"event": "connection.update", "instanceName": "tnx_x"})
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "error"
+
+
+async def spill(db, instance_name="tnx_x"):
+    await db.inbound_events.insert_one({
+        "worker_id": server.WORKER_ID,
+        "seq": 1,
+        "instance_name": instance_name,
+        "payload": {"event": "messages.upsert"},
+        "created_at": datetime.now(timezone.utc),
+    })
+
+
+async def drain_briefly(pipeline):
+    task = asyncio.create_task(pipeline._drain_spilled())
+    await asyncio.sleep(0.05)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+async def test_spilled_events_are_deleted_once_queued(db):
+    pipeline = server.EvolutionEventPipeline(1, 10)
+    pipeline._queues = [asyncio.Queue()]
+    await spill(db)
+
+    await drain_briefly(pipeline)
+
+    _, instance_name, payload = pipeline._queues[0].get_nowait()
+    assert (instance_name, payload) == ("tnx_x", {"event": "messages.upsert"})
+    assert await db.inbound_events.count_documents({}) == 0
+
+
+async def test_spilled_event_survives_a_failed_hand_off(db):
+    pipeline = server.EvolutionEventPipeline(1, 10)
+
+    class BrokenQueue(asyncio.Queue):
+        async def put(self, item):
+            raise RuntimeError("worker dying")
+
+    pipeline._queues = [BrokenQueue()]
+    await spill(db)
+
+    await drain_briefly(pipeline)
+
+    assert await db.inbound_events.count_documents({}) == 1
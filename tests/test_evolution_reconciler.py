@@ -0,0 +1,94 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_reconcile_announces_written_transitions(db, fired, monkeypatch):
+    await db.instances.insert_many([
+        {"id": "a", "evolution_instance_name": "tnx_a", "status": "connecting", "phone_number": None},
+        {"id": "b", "evolution_instance_name": "tnx_b", "status": "connected", "phone_number": "254700000001"},
+    ])
+
+    async def fetch_instances(strict=False):
+        return [
+            {"instance": {"instanceName": "tnx_a", "status": "open", "owner": "254700000002@s.whatsapp.net"}},
+            {"instance": {"instanceName": "tnx_b", "status": "open"}},
+        ]
+
+    monkeypatch.setattr(server.evolution_client, "fetch_instances", fetch_instances)
+    await server.EvolutionReconciler(30).reconcile_once()
+
+    assert fired == [("a", "instance.connected", {"instance_id": "a", "status": "connected"})]
+    stored = await db.instances.find_one({"id": "a"})
+    assert stored["status"] == "connected"
+    assert stored["phone_number"] == "254700000002"
+
+
+class StaticCursor:
+    def __init__(self, docs):
+        self._docs = iter(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+async def test_reconcile_skips_events_when_a_webhook_won_the_race(db, fired, monkeypatch):
+    await db.instances.insert_one(
+        {"id": "a", "evolution_instance_name": "tnx_a", "status": "connecting", "phone_number": None}
+    )
+    # The reconciler reads the instance while it is still connecting...
+    stale = await db.instances.find_one({"id": "a"}, {"_id": 0})
+    monkeypatch.setattr(type(db.instances), "find", lambda self, *args, **kwargs: StaticCursor([stale]))
+    # ...then a connection.update webhook moves it before the guarded write
+    await db.instances.update_one({"id": "a"}, {"$set": {"status": "connected"}})
+
+    async def fetch_instances(strict=False):
+        return [{"instance": {"instanceName": "tnx_a", "status": "close"}}]
+
+    monkeypatch.setattr(server.evolution_client, "fetch_instances", fetch_instances)
+    await server.EvolutionReconciler(30).reconcile_once()
+
+    assert fired == []
+    assert (await db.instances.find_one({"id": "a"}))["status"] == "connected"
+
+
+async def test_reconcile_disconnects_instances_evolution_no_longer_lists(db, fired, monkeypatch):
+    await db.instances.insert_many([
+        {"id": "a", "evolution_instance_name": "tnx_a", "status": "connected", "phone_number": "254700000001"},
+        {"id": "b", "evolution_instance_name": "tnx_b", "status": "connected", "phone_number": "254700000002"},
+    ])
+
+    async def fetch_instances(strict=False):
+        return [{"instance": {"instanceName": "tnx_b", "status": "open"}}]
+
+    monkeypatch.setattr(server.evolution_client, "fetch_instances", fetch_instances)
+    await server.EvolutionReconciler(30).reconcile_once()
+
+    assert fired == [("a", "instance.disconnected", {"instance_id": "a", "status": "disconnected"})]
+    assert (await db.instances.find_one({"id": "a"}))["status"] == "disconnected"
+    assert (await db.instances.find_one({"id": "b"}))["status"] == "connected"
+    assert server.connection_state_cache.get("tnx_a") == "close"
+
+
+async def test_reconcile_leaves_instances_alone_when_evolution_errors(db, fired, monkeypatch):
+    await db.instances.insert_one(
+        {"id": "a", "evolution_instance_name": "tnx_a", "status": "connected", "phone_number": "254700000001"}
+    )
+
+    async def request(method, path, kind, **kwargs):
+        return server.httpx.Response(502, request=server.httpx.Request(method, "http://evolution" + path))
+
+    monkeypatch.setattr(server.evolution_client, "_request", request)
+    with pytest.raises(server.httpx.HTTPStatusError):
+        await server.EvolutionReconciler(30).reconcile_once()
+
+    assert fired == []
+    assert (await db.instances.find_one({"id": "a"}))["status"] == "connected"
@@ -0,0 +1,77 @@
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+TRICKY = 'She said "pay, now"\nthen left; ñ €'
+
+
+@pytest.fixture
+async def messages(db, api_auth):
+    await db.messages.insert_many([
+        {"id": f"m{index}", "instance_id": "i1", "phone_number": "254700000001", "message": text,
+         "message_type": "text", "direction": "incoming", "status": "received",
+         "created_at": f"2026-01-01T00:00:0{index}+00:00"}
+        for index, text in enumerate(["plain", TRICKY, "last"])
+    ])
+
+
+async def export(client, user_headers, **params):
+    return await client.get("/api/instances/i1/messages/export", params=params, headers=user_headers)
+
+
+async def test_ndjson_has_one_record_per_line(messages, client, user_headers):
+    response = await export(client, user_headers, format="ndjson")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.headers["content-disposition"] == 'attachment; filename="messages_i1.ndjson"'
+    lines = response.text.splitlines()
+    assert [json.loads(line)["message"] for line in lines] == ["plain", TRICKY, "last"]
+    assert set(json.loads(lines[0])) == set(server.MessageResponse.model_fields)
+
+
+async def test_csv_quotes_commas_quotes_and_newlines(messages, client, user_headers):
+    response = await export(client, user_headers, format="csv")
+
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == list(server.MessageResponse.model_fields)
+    assert [row[rows[0].index("message")] for row in rows[1:]] == ["plain", TRICKY, "last"]
+
+
+async def test_nested_values_are_json_in_csv_cells(db):
+    await db.logs.insert_one({"id": "l1", "created_at": "2026-01-01", "details": {"to": "a,b", "n": 1}})
+
+    chunks = [chunk async for chunk in server.export_rows(db.logs, {}, ["id", "details", "missing"], "csv", False)]
+
+    rows = list(csv.reader(io.StringIO(b"".join(chunks).decode())))
+    assert rows == [["id", "details", "missing"], ["l1", '{"to": "a,b", "n": 1}', ""]]
+
+
+async def test_export_streams_one_chunk_per_batch(messages, db, monkeypatch):
+    monkeypatch.setattr(server, "EXPORT_BATCH_SIZE", 2)
+
+    chunks = [chunk async for chunk in server.export_rows(db.messages, {}, ["id"], "ndjson", False)]
+
+    assert [chunk.decode().count("\n") for chunk in chunks] == [2, 1]
+
+
+async def test_compressed_export_is_gzip(messages, client, user_headers):
+    response = await export(client, user_headers, format="csv", compress="true")
+
+    assert response.headers["content-type"] == "application/gzip"
+    assert response.headers["content-disposition"] == 'attachment; filename="messages_i1.csv.gz"'
+    assert len(list(csv.reader(io.StringIO(gzip.decompress(response.content).decode())))) == 4
+
+
+async def test_unknown_format_is_rejected(messages, client, user_headers):
+    response = await export(client, user_headers, format="xml")
+
+    assert response.status_code == 400
@@ -0,0 +1,165 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+BODY = {"instance_id": "i1", "phone_number": "254700000001", "message": "hello"}
+
+
+@pytest.fixture
+def store(db):
+    return server.IdempotencyStore(maxsize=100, ttl=3600)
+
+
+class Handler(list):
+    """Counts calls and answers with a response naming the call; set `fail` to make it raise"""
+    fail = None
+
+    async def __call__(self):
+        self.append(len(self) + 1)
+        if self.fail:
+            raise self.fail
+        return {"success": True, "call": len(self)}
+
+
+@pytest.fixture
+def handler():
+    return Handler()
+
+
+def keys(body=BODY, idempotency_key="k1"):
+    return server.idempotency_keys_for("u1", "send-message", idempotency_key, body)
+
+
+async def test_repeated_key_replays_the_first_response(store, handler):
+    first = await store.run(keys(), handler)
+    replay = await store.run(keys(), handler)
+
+    assert first == {"success": True, "call": 1}
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert replay.body == b'{"success":true,"call":1}'
+    assert handler == [1]
+
+
+async def test_replay_survives_a_cold_cache(db, store, handler):
+    await store.run(keys(), handler)
+
+    replay = await server.IdempotencyStore(maxsize=100, ttl=3600).run(keys(), handler)
+
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert handler == [1]
+
+
+async def test_key_reused_with_a_different_body_is_rejected(db, store, handler):
+    await store.run(keys(), handler)
+
+    for other in (store, server.IdempotencyStore(maxsize=100, ttl=3600)):
+        with pytest.raises(HTTPException) as exc:
+            await other.run(keys({**BODY, "message": "goodbye"}), handler)
+        assert exc.value.status_code == 422
+    assert handler == [1]
+
+
+async def test_dedupe_keys_ignore_the_body(store, handler):
+    await store.run([("invoice:i1:INV-1:invoice", 3600, None)], handler)
+    replay = await store.run([("invoice:i1:INV-1:invoice", 3600, None)], handler)
+
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert handler == [1]
+
+
+async def test_request_in_progress_gets_409(db, store, handler):
+    key, _, request_hash = keys()[0]
+    now = datetime.now(timezone.utc)
+    await db.idempotency_keys.insert_one({
+        "_id": key, "state": "pending", "request_hash": request_hash,
+        "created_at": now, "expires_at": now + timedelta(seconds=60)
+    })
+
+    with pytest.raises(HTTPException) as exc:
+        await store.run(keys(), handler)
+
+    assert exc.value.status_code == 409
+    assert handler == []
+
+
+async def test_lapsed_pending_lease_is_taken_over(db, store, handler):
+    key, _, _ = keys()[0]
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await db.idempotency_keys.insert_one({
+        "_id": key, "state": "pending", "request_hash": "from-a-dead-request",
+        "created_at": past, "expires_at": past
+    })
+
+    assert await store.run(keys(), handler) == {"success": True, "call": 1}
+    assert store.stats()["reclaimed"] == 1
+
+
+async def test_pending_lease_is_short_and_done_keeps_the_full_ttl(db, store, handler, monkeypatch):
+    monkeypatch.setattr(server, "IDEMPOTENCY_PENDING_SECONDS", 30)
+    key, _, _ = keys()[0]
+    leases = []
+
+    async def record_lease():
+        leases.append(await db.idempotency_keys.find_one({"_id": key}))
+        return {"success": True}
+
+    # Mongo keeps milliseconds only
+    before = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await store.run(keys(), record_lease)
+
+    lease = server.as_utc(leases[0]["expires_at"])
+    assert leases[0]["state"] == "pending"
+    assert lease <= before + timedelta(seconds=32)
+    done = await db.idempotency_keys.find_one({"_id": key})
+    assert done["state"] == "done"
+    assert server.as_utc(done["expires_at"]) >= before + timedelta(seconds=server.IDEMPOTENCY_TTL_SECONDS)
+
+
+async def test_failed_request_releases_its_keys(db, store, handler):
+    handler.fail = RuntimeError("mongo down")
+    with pytest.raises(RuntimeError):
+        await store.run(keys(), handler)
+
+    handler.fail = None
+    assert await store.run(keys(), handler) == {"success": True, "call": 2}
+
+
+async def test_no_key_means_no_deduplication(store, handler):
+    await store.run(keys(idempotency_key=None), handler)
+    await store.run(keys(idempotency_key=None), handler)
+
+    assert handler == [1, 2]
+
+
+async def test_response_store_failure_keeps_the_keys_and_retries(db, store, handler, monkeypatch):
+    monkeypatch.setattr(server, "IDEMPOTENCY_PENDING_SECONDS", 30)
+    bulk_write = type(db.idempotency_keys).bulk_write
+    failures = [RuntimeError("mongo blip")]
+
+    async def flaky_bulk_write(self, *args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return await bulk_write(self, *args, **kwargs)
+
+    spawned = []
+    monkeypatch.setattr(type(db.idempotency_keys), "bulk_write", flaky_bulk_write)
+    monkeypatch.setattr(server, "spawn_background", spawned.append)
+
+    # The send went out, so the caller gets its response despite the failed write
+    assert await store.run(keys(), handler) == {"success": True, "call": 1}
+
+    # Another worker sees the key still held rather than free for a second send
+    with pytest.raises(HTTPException) as exc:
+        await server.IdempotencyStore(maxsize=100, ttl=3600).run(keys(), handler)
+    assert exc.value.status_code == 409
+
+    await spawned[0]
+    replay = await server.IdempotencyStore(maxsize=100, ttl=3600).run(keys(), handler)
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert handler == [1]
+    assert store.stats()["store_retries"] == 1
@@ -0,0 +1,64 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+NOW = "2026-01-01T00:00:00+00:00"
+
+
+@pytest.fixture
+async def instances(db, api_auth):
+    await db.instances.update_one({"id": "i1"}, {"$set": {"name": "Billing", "created_at": NOW, "updated_at": NOW}})
+    await db.instances.insert_many([
+        {"id": name, "user_id": "u1", "name": name, "evolution_instance_name": f"tnx_{name}",
+         "instance_type": "billing", "status": "disconnected", "phone_number": None,
+         "created_at": NOW, "updated_at": NOW}
+        for name in ("a", "b")
+    ])
+
+
+class EvolutionCalls(list):
+    """("fetch",) and ("state", instance_name) calls made to Evolution"""
+
+
+@pytest.fixture
+def evolution_calls(monkeypatch):
+    calls = EvolutionCalls()
+
+    async def fetch_instances(strict=False):
+        calls.append(("fetch",))
+        # "b" is missing from the listing
+        return [
+            {"instance": {"instanceName": "tnx_bill_i1", "status": "close"}},
+            {"instance": {"instanceName": "tnx_a", "status": "open", "owner": "254700000009@s.whatsapp.net"}},
+        ]
+
+    async def get_instance_connection_state(instance_name):
+        calls.append(("state", instance_name))
+        return {"instance": {"state": "connecting"}}
+
+    monkeypatch.setattr(server.evolution_client, "fetch_instances", fetch_instances)
+    monkeypatch.setattr(server.evolution_client, "get_instance_connection_state", get_instance_connection_state)
+    return calls
+
+
+async def test_one_fetch_instances_call_feeds_the_whole_list(instances, evolution_calls, client, user_headers, db):
+    response = await client.get("/api/instances", headers=user_headers)
+
+    assert response.status_code == 200
+    listed = {inst["id"]: (inst["status"], inst["phone_number"]) for inst in response.json()}
+    assert listed == {"i1": ("disconnected", None), "a": ("connected", "254700000009"), "b": ("connecting", None)}
+    # Only the instance the listing left out needed its own call
+    assert evolution_calls == [("fetch",), ("state", "tnx_b")]
+    stored = {inst["id"]: inst["status"] async for inst in db.instances.find({})}
+    assert stored == {"i1": "disconnected", "a": "connected", "b": "connecting"}
+
+
+async def test_fresh_reconciler_state_is_served_without_evolution(instances, evolution_calls, client, user_headers, monkeypatch):
+    monkeypatch.setattr(server.evolution_reconciler, "is_fresh", lambda: True)
+
+    response = await client.get("/api/instances", headers=user_headers)
+
+    assert [inst["status"] for inst in response.json()] == ["connected", "disconnected", "disconnected"]
+    assert evolution_calls == []
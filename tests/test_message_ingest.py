@@ -0,0 +1,111 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def upsert(*messages):
+    return {"event": "messages.upsert", "data": [
+        {"key": {"id": key_id, "remoteJid": f"{phone}@s.whatsapp.net", "fromMe": from_me},
+         "message": {"conversation": text}}
+        for key_id, phone, text, from_me in messages
+    ]}
+
+
+@pytest.fixture
+async def ingest(db, monkeypatch):
+    """Records insert_many batches, message.received batches and Botpress hand-offs"""
+    await db.instances.insert_one({
+        "id": "i1", "user_id": "u1", "evolution_instance_name": "tnx_bot_i1",
+        "botpress_config": {"is_active": True, "webhook_url": "http://bot.example/hook"}
+    })
+    await db.messages.create_index(
+        [("instance_id", 1), ("evolution_message_id", 1)], unique=True,
+        partialFilterExpression={"evolution_message_id": {"$exists": True}}
+    )
+    calls = {"insert_many": [], "webhooks": [], "botpress": []}
+    insert_many = type(db.messages).insert_many
+
+    async def record_insert_many(self, documents, *args, **kwargs):
+        if self.name == "messages":
+            calls["insert_many"].append(len(documents))
+        return await insert_many(self, documents, *args, **kwargs)
+
+    async def trigger_webhooks_batch(instance_id, event, items):
+        calls["webhooks"].append([item["text"] for item in items])
+
+    def spawn(coro):
+        try:
+            coro.send(None)
+        except StopIteration:
+            pass
+
+    monkeypatch.setattr(type(db.messages), "insert_many", record_insert_many)
+    monkeypatch.setattr(server, "trigger_webhooks_batch", trigger_webhooks_batch)
+    monkeypatch.setattr(server, "spawn_background", spawn)
+    monkeypatch.setattr(server, "event_broker", server.EventBroker(10, shared=False))
+    monkeypatch.setattr(server.botpress_dispatcher, "enqueue",
+                        lambda instance, phone, text, message_id: calls["botpress"].append((phone, text)))
+    return calls
+
+
+async def test_payload_is_stored_and_dispatched_as_one_batch(ingest, db):
+    await server.process_evolution_event("tnx_bot_i1", upsert(
+        ("k1", "254700000001", "hi", False),
+        ("k2", "254700000002", "hello", False),
+        ("k3", "254700000001", "sent by us", True),
+        ("k4", "254700000001", "again", False),
+    ))
+
+    assert ingest["insert_many"] == [3]
+    assert ingest["webhooks"] == [["hi", "hello", "again"]]
+    assert ingest["botpress"] == [("254700000001", "hi"), ("254700000002", "hello"), ("254700000001", "again")]
+    stored = await db.messages.find({}, {"_id": 0, "evolution_message_id": 1, "direction": 1}).to_list(None)
+    assert stored == [{"evolution_message_id": key, "direction": "incoming"} for key in ("k1", "k2", "k4")]
+
+
+async def test_redelivered_messages_are_stored_and_dispatched_once(ingest, db):
+    await server.process_evolution_event("tnx_bot_i1", upsert(("k1", "254700000001", "hi", False)))
+
+    # Evolution retries the webhook with one new message added
+    await server.process_evolution_event("tnx_bot_i1", upsert(
+        ("k1", "254700000001", "hi", False),
+        ("k2", "254700000001", "new", False),
+    ))
+
+    assert await db.messages.count_documents({}) == 2
+    assert ingest["webhooks"] == [["hi"], ["new"]]
+    assert ingest["botpress"] == [("254700000001", "hi"), ("254700000001", "new")]
+
+
+async def test_repeated_key_within_a_payload_is_stored_once(ingest, db):
+    await server.process_evolution_event("tnx_bot_i1", upsert(
+        ("k1", "254700000001", "hi", False),
+        ("k1", "254700000001", "hi", False),
+    ))
+
+    assert ingest["insert_many"] == [1]
+    assert await db.messages.count_documents({}) == 1
+
+
+async def test_full_redelivery_dispatches_nothing(ingest, db):
+    payload = upsert(("k1", "254700000001", "hi", False))
+    await server.process_evolution_event("tnx_bot_i1", payload)
+
+    await server.process_evolution_event("tnx_bot_i1", payload)
+
+    assert ingest["webhooks"] == [["hi"]]
+    assert len(ingest["botpress"]) == 1
+
+
+async def test_instance_lookup_is_served_from_the_cache(ingest, db, monkeypatch):
+    await server.process_evolution_event("tnx_bot_i1", upsert(("k1", "254700000001", "hi", False)))
+
+    async def no_mongo(self, *args, **kwargs):
+        raise AssertionError("instance looked up in Mongo again")
+
+    monkeypatch.setattr(type(db.instances), "find_one", no_mongo)
+    await server.process_evolution_event("tnx_bot_i1", upsert(("k2", "254700000001", "hello", False)))
+
+    assert ingest["webhooks"] == [["hi"], ["hello"]]
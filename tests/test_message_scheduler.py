@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+INSTANCE = {"id": "i1", "user_id": "u1", "evolution_instance_name": "tnx_bill_i1", "instance_type": "billing"}
+
+
+@pytest.fixture
+async def scheduler(db):
+    await db.instances.insert_one(dict(INSTANCE))
+    # The unique ids a repeated handoff collides on
+    await db.messages.create_index("id", unique=True)
+    await db.outbound_jobs.create_index("id", unique=True)
+    return server.MessageScheduler(window_seconds=300, window_size=10)
+
+
+def scheduled(job_id, due_in, **fields):
+    return {
+        "id": job_id, "user_id": "u1", "instance_id": "i1", "kind": "text",
+        "phone_number": "254700000001", "payload": {"phone_number": "254700000001", "message": job_id},
+        "due_at": datetime.now(timezone.utc) + timedelta(seconds=due_in), "status": "scheduled",
+        "claimed_by": None, "claimed_until": None, "message_id": None, "error": None, **fields
+    }
+
+
+async def test_due_job_is_claimed_and_queued_once(scheduler, db):
+    await db.scheduled_messages.insert_one(scheduled("s1", -1))
+
+    await scheduler.fire("s1")
+    await server.MessageScheduler(window_seconds=300, window_size=10).fire("s1")
+
+    stored = await db.scheduled_messages.find_one({"id": "s1"})
+    assert stored["status"] == "dispatched"
+    jobs = await db.outbound_jobs.find({}).to_list(None)
+    assert [(job["id"], job["message_id"]) for job in jobs] == [("s1", stored["message_id"])]
+    assert scheduler.stats()["dispatched"] == 1
+
+
+async def test_job_is_not_fired_before_it_is_due(scheduler, db):
+    await db.scheduled_messages.insert_one(scheduled("s1", 60))
+
+    await scheduler.fire("s1")
+
+    assert (await db.scheduled_messages.find_one({"id": "s1"}))["status"] == "scheduled"
+    assert await db.outbound_jobs.count_documents({}) == 0
+
+
+async def test_window_holds_due_jobs_in_due_order(scheduler, db):
+    await db.scheduled_messages.insert_many([
+        scheduled("later", 120), scheduled("first", -5), scheduled("next", 30),
+        scheduled("outside", 600), scheduled("gone", -10, status="cancelled"),
+    ])
+
+    await scheduler.reload()
+
+    popped = [server.heapq.heappop(scheduler._heap)[1] for _ in range(len(scheduler._heap))]
+    assert popped == ["first", "next", "later"]
+    assert scheduler.in_window(datetime.now(timezone.utc) + timedelta(seconds=200))
+    assert not scheduler.in_window(datetime.now(timezone.utc) + timedelta(seconds=600))
+
+
+async def test_expired_claim_is_refired_without_a_second_send(scheduler, db):
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    doc = scheduled("s1", -60, status="claimed", claimed_by="dead-worker", claimed_until=past)
+    await db.scheduled_messages.insert_one(doc)
+    # The dead worker handed it to the outbound queue but never recorded that
+    await scheduler.dispatch(doc)
+
+    await scheduler.reload()
+    await scheduler.fire("s1")
+
+    assert (await db.scheduled_messages.find_one({"id": "s1"}))["status"] == "dispatched"
+    assert await db.outbound_jobs.count_documents({}) == 1
+    assert await db.messages.count_documents({}) == 1
+
+
+async def test_refire_completes_a_handoff_that_stored_only_the_message(scheduler, db):
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await db.scheduled_messages.insert_one(
+        scheduled("s1", -60, status="claimed", claimed_by="dead-worker", claimed_until=past)
+    )
+    # The dead worker stored the message and died before inserting its job
+    message_id = str(server.uuid.uuid5(server.uuid.NAMESPACE_OID, "s1"))
+    await db.messages.insert_one({"id": message_id, "status": "queued"})
+
+    await scheduler.reload()
+    await scheduler.fire("s1")
+
+    job = await db.outbound_jobs.find_one({"id": "s1"})
+    assert (job["status"], job["message_id"]) == ("queued", message_id)
+    assert await db.messages.count_documents({}) == 1
+    assert (await db.scheduled_messages.find_one({"id": "s1"}))["status"] == "dispatched"
@@ -0,0 +1,174 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+INSTANCE = {"id": "i1", "user_id": "u1", "evolution_instance_name": "tnx_bill_i1", "instance_type": "billing"}
+
+
+def message_doc(message_id="m1"):
+    return {
+        "id": message_id,
+        "instance_id": "i1",
+        "phone_number": "254700000001",
+        "message": "hello",
+        "message_type": "text",
+        "direction": "outgoing",
+        "status": "queued",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+@pytest.fixture
+def queue(db, fired):
+    return server.OutboundQueue(workers=0)
+
+
+async def enqueue(queue, message_id="m1"):
+    return await queue.enqueue(INSTANCE, message_doc(message_id), "text",
+                               {"phone_number": "254700000001", "message": "hello"})
+
+
+async def test_enqueue_writes_message_and_job(queue, db):
+    job = await enqueue(queue)
+
+    assert (await db.messages.find_one({"id": "m1"}))["status"] == "queued"
+    stored = await db.outbound_jobs.find_one({"id": job["id"]})
+    assert stored["status"] == "queued"
+    assert stored["message_id"] == "m1"
+
+
+async def test_enqueue_rolls_back_message_when_job_insert_fails(queue, db, monkeypatch):
+    async def broken_insert(self, document, *args, **kwargs):
+        raise RuntimeError("mongo down")
+
+    monkeypatch.setattr(type(db.outbound_jobs), "insert_one", broken_insert, raising=False)
+    with pytest.raises(RuntimeError):
+        await enqueue(queue)
+
+    assert await db.messages.find_one({"id": "m1"}) is None
+
+
+async def test_job_is_claimed_once(queue, db):
+    await enqueue(queue)
+
+    first = await queue.claim()
+    second = await queue.claim()
+
+    assert first["status"] == "processing"
+    assert first["attempts"] == 1
+    assert first["locked_by"] == server.WORKER_ID
+    assert second is None
+
+
+async def test_expired_lock_is_reclaimed(queue, db):
+    job = await enqueue(queue)
+    await queue.claim()
+    await db.outbound_jobs.update_one(
+        {"id": job["id"]},
+        {"$set": {"locked_until": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+
+    reclaimed = await queue.claim()
+
+    assert reclaimed["id"] == job["id"]
+    assert reclaimed["attempts"] == 2
+
+
+async def test_future_jobs_are_not_claimed(queue, db):
+    job = await enqueue(queue)
+    await db.outbound_jobs.update_one(
+        {"id": job["id"]},
+        {"$set": {"next_attempt_at": datetime.now(timezone.utc) + timedelta(minutes=1)}}
+    )
+
+    assert await queue.claim() is None
+
+
+async def test_successful_send_marks_job_and_message_sent(queue, db, sends, fired):
+    await enqueue(queue)
+    await queue.process(await queue.claim())
+
+    assert sends == [("tnx_bill_i1", "254700000001", "hello")]
+    assert (await db.outbound_jobs.find_one({"message_id": "m1"}))["status"] == "sent"
+    assert (await db.messages.find_one({"id": "m1"}))["status"] == "sent"
+    assert [event for _, event, _ in fired] == ["message.sent"]
+
+
+async def test_transient_failure_is_retried_later(queue, db, sends):
+    sends.fail = HTTPException(status_code=503, detail="busy")
+    await enqueue(queue)
+    await queue.process(await queue.claim())
+
+    job = await db.outbound_jobs.find_one({"message_id": "m1"})
+    assert job["status"] == "queued"
+    assert job["locked_until"] is None
+    assert server.as_utc(job["next_attempt_at"]) > datetime.now(timezone.utc)
+    assert (await db.messages.find_one({"id": "m1"}))["status"] == "queued"
+
+
+async def test_rejected_send_fails_without_retry(queue, db, sends, fired):
+    sends.fail = HTTPException(status_code=400, detail="bad number")
+    await enqueue(queue)
+    await queue.process(await queue.claim())
+
+    assert (await db.outbound_jobs.find_one({"message_id": "m1"}))["status"] == "failed"
+    assert (await db.messages.find_one({"id": "m1"}))["status"] == "failed"
+    assert [event for _, event, _ in fired] == ["message.failed"]
+
+
+async def test_last_attempt_fails_the_job(queue, db, sends):
+    sends.fail = HTTPException(status_code=503, detail="busy")
+    job = await enqueue(queue)
+    await db.outbound_jobs.update_one({"id": job["id"]}, {"$set": {"attempts": job["max_attempts"] - 1}})
+    await queue.process(await queue.claim())
+
+    assert (await db.outbound_jobs.find_one({"id": job["id"]}))["status"] == "failed"
+
+
+async def test_worker_that_lost_its_lock_does_not_overwrite(queue, db, sends):
+    job = await enqueue(queue)
+    claimed = await queue.claim()
+    # Another worker re-claimed the job after our lock expired
+    await db.outbound_jobs.update_one({"id": job["id"]}, {"$set": {"locked_by": "other-worker"}})
+    await queue.process(claimed)
+
+    assert (await db.outbound_jobs.find_one({"id": job["id"]}))["status"] == "processing"
+
+
+async def test_queue_parks_job_until_its_slot(queue, limiter, db, sends):
+    for _ in range(2):
+        await limiter.reserve("tnx_bill_i1", "billing")
+    job = await enqueue(queue)
+
+    await queue.process(await queue.claim())
+
+    stored = await db.outbound_jobs.find_one({"id": job["id"]})
+    assert sends == []
+    assert stored["status"] == "queued"
+    assert stored["attempts"] == 0
+    assert stored["locked_until"] is None
+    assert server.as_utc(stored["next_attempt_at"]) > datetime.now(timezone.utc)
+    assert stored["rate_slot_at"] == stored["next_attempt_at"]
+
+
+async def test_parked_job_sends_on_its_reserved_slot(queue, limiter, db, sends):
+    for _ in range(2):
+        await limiter.reserve("tnx_bill_i1", "billing")
+    job = await enqueue(queue)
+    await queue.process(await queue.claim())
+    # The slot comes up while the bucket is still booked by other senders
+    await db.outbound_jobs.update_one(
+        {"id": job["id"]},
+        {"$set": {"next_attempt_at": datetime.now(timezone.utc) - timedelta(seconds=1),
+                  "rate_slot_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+
+    await queue.process(await queue.claim())
+
+    assert len(sends) == 1
+    assert (await db.outbound_jobs.find_one({"id": job["id"]}))["status"] == "sent"
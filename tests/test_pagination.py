@@ -0,0 +1,72 @@
+import base64
+import json
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+# Three messages per timestamp, so pages have to break ties on id
+TIMESTAMPS = ["2026-01-01T10:00:00+00:00", "2026-01-01T10:00:01+00:00", "2026-01-01T10:00:02+00:00"]
+
+
+@pytest.fixture
+async def messages(db, api_auth):
+    docs = [
+        {"id": f"m{index:02d}", "instance_id": "i1", "phone_number": "254700000001", "message": "hi",
+         "message_type": "text", "direction": "incoming", "status": "received",
+         "created_at": TIMESTAMPS[index % 3]}
+        for index in range(9)
+    ]
+    await db.messages.insert_many([dict(doc) for doc in docs])
+    return sorted(docs, key=lambda doc: (doc["created_at"], doc["id"]), reverse=True)
+
+
+async def test_pages_cover_every_message_once_across_tied_timestamps(messages, client, user_headers):
+    seen, cursor, pages = [], None, 0
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = await client.get("/api/instances/i1/messages", params=params, headers=user_headers)
+        assert response.status_code == 200
+        seen += [message["id"] for message in response.json()]
+        pages += 1
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert seen == [doc["id"] for doc in messages]
+    assert pages == 5
+
+
+async def test_message_inserted_after_the_first_page_does_not_shift_later_pages(messages, db):
+    first, cursor = await server.fetch_page(db.messages, {"instance_id": "i1"}, 4)
+    await db.messages.insert_one({**messages[0], "id": "m99", "created_at": TIMESTAMPS[-1]})
+
+    second, _ = await server.fetch_page(db.messages, {"instance_id": "i1"}, 4, cursor=cursor)
+
+    assert [doc["id"] for doc in first + second] == [doc["id"] for doc in messages[:8]]
+
+
+def tampered(cursor, created_at, doc_id):
+    """The cursor with its position rewritten but the original signature kept"""
+    raw = json.dumps([created_at, doc_id], separators=(",", ":")).encode()
+    return f"{base64.urlsafe_b64encode(raw).decode().rstrip('=')}.{cursor.split('.')[1]}"
+
+
+@pytest.mark.parametrize("make_cursor", [
+    lambda cursor: tampered(cursor, "2030-01-01T00:00:00+00:00", "m00"),
+    lambda cursor: cursor.split(".")[0],
+    lambda cursor: "not-a-cursor",
+])
+async def test_tampered_cursor_is_rejected(messages, client, user_headers, make_cursor):
+    first = await client.get("/api/instances/i1/messages", params={"limit": 2}, headers=user_headers)
+
+    response = await client.get(
+        "/api/instances/i1/messages",
+        params={"limit": 2, "cursor": make_cursor(first.headers["X-Next-Cursor"])},
+        headers=user_headers
+    )
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor"
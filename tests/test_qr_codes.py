@@ -0,0 +1,105 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+USER = {"id": "u1"}
+
+
+@pytest.fixture
+async def instance(db):
+    doc = {"id": "i1", "user_id": "u1", "evolution_instance_name": "tnx_bill_i1", "status": "disconnected"}
+    await db.instances.insert_one(dict(doc))
+    return doc
+
+
+class ConnectCalls(list):
+    response = None
+
+
+@pytest.fixture
+def connect_calls(monkeypatch):
+    calls = ConnectCalls()
+
+    async def get_qr_code(instance_name):
+        calls.append(instance_name)
+        return calls.response
+
+    monkeypatch.setattr(server.evolution_client, "get_qr_code", get_qr_code)
+    return calls
+
+
+async def test_connect_always_calls_evolution(instance, connect_calls):
+    await server.qr_code_cache.set("tnx_bill_i1", "old-qr")
+    connect_calls.response = {"base64": "new-qr"}
+
+    result = await server.connect_instance("i1", USER)
+
+    assert connect_calls == ["tnx_bill_i1"]
+    assert result["qr_code"] == "new-qr"
+    assert await server.qr_code_cache.get("tnx_bill_i1") == "new-qr"
+
+
+async def test_connect_falls_back_to_the_cached_qr(instance, connect_calls):
+    await server.qr_code_cache.set("tnx_bill_i1", "current-qr")
+    connect_calls.response = {"pairingCode": None, "count": 1}
+
+    result = await server.connect_instance("i1", USER)
+
+    assert connect_calls == ["tnx_bill_i1"]
+    assert result["qr_code"] == "current-qr"
+
+
+async def test_qr_written_by_one_worker_is_served_by_another(db):
+    await server.QRCodeCache(45).set("tnx_bill_i1", "qr-1")
+    assert await server.QRCodeCache(45).get("tnx_bill_i1") == "qr-1"
+
+
+async def test_qrcode_update_with_non_dict_data_is_ignored(instance, monkeypatch):
+    monkeypatch.setattr(server, "event_broker", server.EventBroker(10, shared=False))
+
+    await server.process_evolution_event("tnx_bill_i1", {"event": "qrcode.updated", "data": "unexpected"})
+
+    assert await server.qr_code_cache.get("tnx_bill_i1") is None
+
+
+@pytest.fixture
+async def pairing(db, api_auth, monkeypatch):
+    """api_auth's instance waiting to be paired, with a QR already cached"""
+    await db.instances.update_one({"id": "i1"}, {"$set": {"status": "disconnected"}})
+    server.connection_state_cache.set("tnx_bill_i1", "close")
+    await server.qr_code_cache.set("tnx_bill_i1", "qr-1")
+    monkeypatch.setattr(server, "event_broker", server.EventBroker(10, shared=False))
+
+
+async def test_qr_carries_an_etag(pairing, client, user_headers):
+    response = await client.get("/api/instances/i1/qr", headers=user_headers)
+
+    assert response.status_code == 200
+    assert response.json() == {"qr_code": "qr-1"}
+    assert response.headers["ETag"].startswith('"') and response.headers["ETag"].endswith('"')
+    assert response.headers["Cache-Control"] == "private, no-cache"
+
+
+async def test_unchanged_qr_answers_if_none_match_with_304(pairing, client, user_headers):
+    etag = (await client.get("/api/instances/i1/qr", headers=user_headers)).headers["ETag"]
+
+    response = await client.get("/api/instances/i1/qr", headers={**user_headers, "If-None-Match": f'"other", {etag}'})
+
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+
+async def test_etag_changes_after_a_qrcode_update(pairing, client, user_headers):
+    etag = (await client.get("/api/instances/i1/qr", headers=user_headers)).headers["ETag"]
+
+    await server.process_evolution_event(
+        "tnx_bill_i1", {"event": "qrcode.updated", "data": {"qrcode": {"base64": "qr-2"}}}
+    )
+    response = await client.get("/api/instances/i1/qr", headers={**user_headers, "If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.json() == {"qr_code": "qr-2"}
+    assert response.headers["ETag"] != etag
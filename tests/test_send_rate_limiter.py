@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def test_limits_follow_instance_type(limiter):
+    assert limiter.limits_for("billing") == (1.0, 2)
+    assert limiter.limits_for("botpress")[0] == 0.0
+
+
+async def test_reserve_queues_slots_one_interval_apart(limiter):
+    waits = [await limiter.reserve("tnx_bill_i1", "billing") for _ in range(4)]
+
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == pytest.approx(1.0, abs=0.05)
+    assert waits[3] == pytest.approx(2.0, abs=0.05)
+    assert limiter.stats()["deferred"] == 2
+
+
+async def test_buckets_are_per_instance(limiter):
+    for _ in range(2):
+        await limiter.reserve("tnx_bill_i1", "billing")
+
+    assert await limiter.reserve("tnx_bill_i2", "billing") == 0.0
+
+
+async def test_disabled_rate_never_limits(limiter):
+    assert [await limiter.reserve("tnx_bot_i1", "botpress") for _ in range(50)] == [0.0] * 50
+
+
+async def use_burst(limiter):
+    for _ in range(2):
+        await limiter.reserve("tnx_bill_i1", "billing")
+
+
+async def test_send_over_the_limit_waits_for_a_near_slot(limiter, client, user_headers, sends, db, monkeypatch):
+    # One send per 100ms, so the next slot is well within the inline wait
+    monkeypatch.setattr(server, "SEND_RATE_BILLING_PER_MINUTE", 600)
+    await use_burst(limiter)
+
+    response = await client.post("/api/instances/i1/messages/send", headers=user_headers,
+                                 json={"phone_number": "254700000001", "message": "hello"})
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "sent"
+    assert sends == [("tnx_bill_i1", "254700000001", "hello")]
+
+
+async def test_send_over_the_limit_is_queued_and_delivered(limiter, client, user_headers, sends, db, fired, monkeypatch):
+    monkeypatch.setattr(server, "SEND_RATE_INLINE_WAIT_SECONDS", 0)
+    await use_burst(limiter)
+
+    response = await client.post("/api/instances/i1/messages/send", headers=user_headers,
+                                 json={"phone_number": "254700000001", "message": "hello"})
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "queued"
+    assert sends == []
+    job = await db.outbound_jobs.find_one({"message_id": response.json()["id"]})
+    assert job["rate_slot_at"] == job["next_attempt_at"]
+    assert server.as_utc(job["rate_slot_at"]) > datetime.now(timezone.utc)
+
+    # The reserved slot comes up; the worker sends without reserving again
+    past = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await db.outbound_jobs.update_one({"id": job["id"]}, {"$set": {"next_attempt_at": past, "rate_slot_at": past}})
+    await server.outbound_queue.process(await server.outbound_queue.claim())
+
+    assert sends == [("tnx_bill_i1", "254700000001", "hello")]
+    assert (await db.messages.find_one({"id": job["message_id"]}))["status"] == "sent"
+
+
+async def test_billing_send_over_the_limit_is_queued(limiter, client, user_headers, sends, db, monkeypatch):
+    monkeypatch.setattr(server, "SEND_RATE_INLINE_WAIT_SECONDS", 0)
+    await use_burst(limiter)
+
+    response = await client.post("/api/instances/i1/messages/send-billing", headers=user_headers, json={
+        "phone_number": "254700000001", "customer_name": "Jane", "amount": 100, "invoice_id": "INV-1"
+    })
+
+    assert response.json()["status"] == "queued"
+    job = await db.outbound_jobs.find_one({"message_id": response.json()["message_id"]})
+    assert job["kind"] == "buttons"
+    assert job["payload"]["buttons"][0]["id"] == "paynow_INV-1"
+
+
+async def test_botpress_replies_are_queued(limiter, client, api_auth, sends, db):
+    await use_burst(limiter)
+
+    responses = [
+        await client.post("/api/botpress/reply", json={"instance_id": "i1", "phone_number": "254700000001", "message": f"reply {i}"})
+        for i in range(3)
+    ]
+
+    assert [response.json()["status"] for response in responses] == ["queued"] * 3
+    assert await db.outbound_jobs.count_documents({"status": "queued"}) == 3
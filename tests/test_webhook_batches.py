@@ -0,0 +1,41 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def deliveries(monkeypatch):
+    calls = []
+
+    async def dispatch(instance_id, event, data, webhooks):
+        calls.append((event, data, [webhook["id"] for webhook in webhooks]))
+
+    monkeypatch.setattr(server.webhook_engine, "dispatch", dispatch)
+    return calls
+
+
+@pytest.fixture
+def subscriptions(monkeypatch):
+    index = server.WebhookSubscriptionIndex()
+    index.loaded = True
+    index.add({"id": "single", "instance_id": "i1", "url": "http://a", "events": ["message.received"]})
+    index.add({"id": "batched", "instance_id": "i1", "url": "http://b", "events": ["message.received.batch"]})
+    monkeypatch.setattr(server, "webhook_subscriptions", index)
+    return index
+
+
+async def test_batch_keeps_single_message_shape_for_existing_subscribers(deliveries, subscriptions):
+    items = [{"message_id": "m1"}, {"message_id": "m2"}]
+    await server.trigger_webhooks_batch("i1", "message.received", items)
+
+    assert ("message.received", {"message_id": "m1"}, ["single"]) in deliveries
+    assert ("message.received", {"message_id": "m2"}, ["single"]) in deliveries
+    assert ("message.received.batch", {"count": 2, "items": items}, ["batched"]) in deliveries
+    assert len(deliveries) == 3
+
+
+async def test_empty_batch_delivers_nothing(deliveries, subscriptions):
+    await server.trigger_webhooks_batch("i1", "message.received", [])
+    assert deliveries == []
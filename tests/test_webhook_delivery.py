@@ -0,0 +1,120 @@
+import asyncio
+
+import httpx
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+WEBHOOK = {"id": "w1", "url": "http://hooks.example/w1"}
+PAYLOAD = {"event": "message.sent", "data": {"message_id": "m1"}}
+
+
+class Endpoint:
+    """Answers webhook POSTs with the queued status codes (then 200); `hold` parks requests until set"""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.requests = 0
+        self.hold = None
+
+    async def __call__(self, request):
+        self.requests += 1
+        if self.hold is not None:
+            await self.hold.wait()
+        return httpx.Response(self.statuses.pop(0) if self.statuses else 200)
+
+
+@pytest.fixture
+def engine(db, monkeypatch):
+    monkeypatch.setattr(server, "WEBHOOK_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(server, "WEBHOOK_BREAKER_THRESHOLD", 2)
+    backoffs = []
+
+    def jitter(low, high):
+        backoffs.append(high)
+        return 0
+
+    monkeypatch.setattr(server.random, "uniform", jitter)
+    engine = server.WebhookDeliveryEngine()
+    engine.backoffs = backoffs
+    return engine
+
+
+def serve(engine, endpoint):
+    engine._client = httpx.AsyncClient(transport=httpx.MockTransport(endpoint))
+    return endpoint
+
+
+def reopen_after_cooldown(engine):
+    engine._breakers[WEBHOOK["url"]]["open_until"] = 0.0
+
+
+async def test_server_errors_are_retried_with_growing_backoff(engine, monkeypatch):
+    monkeypatch.setattr(server, "WEBHOOK_BREAKER_THRESHOLD", 10)
+    endpoint = serve(engine, Endpoint(503, 500))
+
+    assert await engine.deliver("i1", WEBHOOK, PAYLOAD) is True
+
+    assert endpoint.requests == 3
+    assert engine.backoffs == [server.WEBHOOK_RETRY_BASE_SECONDS, server.WEBHOOK_RETRY_BASE_SECONDS * 2]
+    # A success resets the failure count
+    assert WEBHOOK["url"] not in engine._breakers
+    assert "w1" in engine._last_triggered
+
+
+async def test_client_errors_are_dead_lettered_without_retry(engine, db):
+    endpoint = serve(engine, Endpoint(404))
+
+    assert await engine.deliver("i1", WEBHOOK, PAYLOAD) is False
+
+    assert endpoint.requests == 1
+    dead = await db.webhook_deliveries.find_one({"webhook_id": "w1"})
+    assert (dead["error"], dead["attempts"], dead["status"], dead["payload"]) == ("HTTP 404", 1, "dead", PAYLOAD)
+
+
+async def test_breaker_opens_at_the_threshold_and_short_circuits(engine, db):
+    endpoint = serve(engine, Endpoint(500, 500, 500))
+
+    assert await engine.deliver("i1", WEBHOOK, PAYLOAD) is False
+    assert await engine.deliver("i1", WEBHOOK, PAYLOAD) is False
+
+    # Two failed attempts opened it; the second delivery never reached the endpoint
+    assert endpoint.requests == 2
+    assert engine.stats()["open_circuits"] == 1
+    assert engine.stats()["short_circuited"] == 1
+    errors = [doc["error"] async for doc in db.webhook_deliveries.find({})]
+    assert errors == ["HTTP 500", "circuit open"]
+
+
+async def test_half_open_breaker_lets_exactly_one_probe_through(engine):
+    endpoint = serve(engine, Endpoint(500, 500))
+    await engine.deliver("i1", WEBHOOK, PAYLOAD)
+    reopen_after_cooldown(engine)
+    endpoint.hold = asyncio.Event()
+
+    probe = asyncio.create_task(engine.deliver("i1", WEBHOOK, PAYLOAD))
+    await asyncio.sleep(0.01)
+    others = await asyncio.gather(*(engine.deliver("i1", WEBHOOK, PAYLOAD) for _ in range(3)))
+    endpoint.hold.set()
+
+    assert await probe is True
+    assert others == [False, False, False]
+    assert endpoint.requests == 3
+    # The probe closed the breaker
+    assert WEBHOOK["url"] not in engine._breakers
+    assert await engine.deliver("i1", WEBHOOK, PAYLOAD) is True
+
+
+async def test_failed_probe_reopens_the_breaker(engine):
+    endpoint = serve(engine, Endpoint(500, 500, 500))
+    await engine.deliver("i1", WEBHOOK, PAYLOAD)
+    reopen_after_cooldown(engine)
+
+    assert await engine.deliver("i1", WEBHOOK, PAYLOAD) is False
+
+    # One probe attempt, no retries, and the cooldown starts over
+    assert endpoint.requests == 3
+    assert engine._is_open(WEBHOOK["url"])
+    assert engine._breakers[WEBHOOK["url"]]["probing"] is False
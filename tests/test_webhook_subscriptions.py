@@ -0,0 +1,65 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def index(db, monkeypatch):
+    index = server.WebhookSubscriptionIndex()
+    await index.load()
+    monkeypatch.setattr(server, "webhook_subscriptions", index)
+    monkeypatch.setattr(server.cache_invalidator, "_versions", {})
+    return index
+
+
+async def create(client, user_headers, events, is_active=True):
+    response = await client.post(
+        "/api/instances/i1/webhooks",
+        json={"url": "http://hooks.example/a", "events": events, "is_active": is_active},
+        headers=user_headers
+    )
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+async def test_created_webhook_is_found_without_a_reload(index, client, user_headers):
+    webhook_id = await create(client, user_headers, ["message.received", "message.sent"])
+
+    assert [target["id"] for target in await server.webhook_targets("i1", "message.received")] == [webhook_id]
+    assert [target["id"] for target in await server.webhook_targets("i1", "message.sent")] == [webhook_id]
+    assert await server.webhook_targets("i1", "instance.connected") == []
+
+
+async def test_inactive_webhook_is_not_indexed(index, client, user_headers):
+    await create(client, user_headers, ["message.received"], is_active=False)
+
+    assert await server.webhook_targets("i1", "message.received") == []
+
+
+async def test_deleted_webhook_is_dropped_from_the_index(index, client, user_headers):
+    kept = await create(client, user_headers, ["message.received"])
+    deleted = await create(client, user_headers, ["message.received"])
+
+    response = await client.delete(f"/api/webhooks/{deleted}", headers=user_headers)
+
+    assert response.status_code == 200
+    assert [target["id"] for target in await server.webhook_targets("i1", "message.received")] == [kept]
+    assert index.stats() == {"loaded": True, "webhooks": 1, "keys": 1}
+
+
+async def test_other_workers_rebuild_their_index_on_the_version_bump(index, client, user_headers):
+    other = server.WebhookSubscriptionIndex()
+    await other.load()
+    invalidator = server.CacheInvalidator(60)
+    invalidator.register("webhooks", other.load)
+    await invalidator.poll(run_handlers=False)
+
+    webhook_id = await create(client, user_headers, ["message.received"])
+    await invalidator.poll()
+    assert [target["id"] for target in other.lookup("i1", "message.received")] == [webhook_id]
+
+    await client.delete(f"/api/webhooks/{webhook_id}", headers=user_headers)
+    await invalidator.poll()
+    assert other.lookup("i1", "message.received") == []